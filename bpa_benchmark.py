@@ -0,0 +1,633 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Medições de desempenho do exportador BPA-I.
+Cada comando imprime o resultado em JSON e sai com código 1 quando um limite é violado,
+para poder rodar em agendamentos ou antes de publicar uma versão.
+"""
+
+import os
+import sys
+import json
+import time
+import datetime
+import hashlib
+import argparse
+import tempfile
+import subprocess
+
+DIRETORIO = os.path.dirname(os.path.abspath(__file__))
+
+# Módulos pesados que não podem ser carregados só por importar o núcleo do exportador
+MODULOS_PROIBIDOS_NA_IMPORTACAO = ('tkinter', 'tkcalendar', 'pandas', 'sqlalchemy')
+
+# ~10^6 linhas: o maior arquivo que cabe no cbc_lin de 6 dígitos do cabeçalho
+LINHAS_ESCRITA_PADRAO = 999_999
+
+
+def medir_importacao(modulo='bpa_exporter', repeticoes=5):
+    """Roda `python -X importtime -c "import <modulo>"` em processos novos.
+
+    Retorna {'modulo', 'tempo_ms' (menor tempo acumulado), 'proibidos' (módulos pesados importados)}.
+    """
+    melhor_us = None
+    carregados = set()
+    for _ in range(repeticoes):
+        processo = subprocess.run([sys.executable, '-X', 'importtime', '-c', f'import {modulo}'],
+                                  cwd=DIRETORIO, capture_output=True, text=True)
+        if processo.returncode != 0:
+            raise RuntimeError(f"Falha ao importar {modulo}:\n{processo.stderr}")
+        for linha in processo.stderr.splitlines():
+            if not linha.startswith('import time:') or '|' not in linha:
+                continue
+            _, acumulado, nome = [parte.strip() for parte in linha[len('import time:'):].split('|')]
+            if not acumulado.isdigit():
+                continue # linha de título
+            carregados.add(nome.split('.')[0])
+            if nome == modulo:
+                melhor_us = int(acumulado) if melhor_us is None else min(melhor_us, int(acumulado))
+    return {
+        'modulo': modulo,
+        'tempo_ms': round((melhor_us or 0) / 1000, 1),
+        'proibidos': sorted(m for m in MODULOS_PROIBIDOS_NA_IMPORTACAO if m in carregados),
+    }
+
+
+def _formatar_linha_referencia(reg_dict):
+    """Montagem original da linha BPA-I (uma concatenação por campo), mantida como referência de bytes."""
+    linha_reg_str = (
+        str(reg_dict.get('prd_ident', '03')).ljust(2) + str(reg_dict.get('prd_cnes', ' ' * 7)).ljust(7) +
+        str(reg_dict.get('prd_cmp', ' ' * 6)).ljust(6) + str(reg_dict.get('prd_cnsmed', ' ' * 15)).ljust(15) +
+        str(reg_dict.get('prd_cbo', ' ' * 6)).ljust(6) + str(reg_dict.get('prd_dtaten', ' ' * 8)).ljust(8) +
+        str(reg_dict.get('prd_flh', '000')).zfill(3) + str(reg_dict.get('prd_seq', '00')).zfill(2) +
+        str(reg_dict.get('prd_pa', ' ' * 10)).ljust(10) + str(reg_dict.get('prd_cnspac', ' ' * 15)).ljust(15) +
+        str(reg_dict.get('prd_sexo', ' ')).ljust(1) + str(reg_dict.get('prd_ibge', ' ' * 6)).ljust(6) +
+        str(reg_dict.get('prd_cid', ' ' * 4)).ljust(4) + str(reg_dict.get('prd_ldade', '000')).zfill(3) +
+        str(reg_dict.get('prd_qt', '000000')).zfill(6) + str(reg_dict.get('prd_caten', '  ')).ljust(2) +
+        str(reg_dict.get('prd_naut', ' ' * 13)).ljust(13) + str(reg_dict.get('prd_org', '   ')).ljust(3) +
+        str(reg_dict.get('prd_nmpac', ' ' * 30)).ljust(30) + str(reg_dict.get('prd_dtnasc', ' ' * 8)).ljust(8) +
+        str(reg_dict.get('prd_raca', '  ')).ljust(2) + str(reg_dict.get('prd_etnia', '    ')).ljust(4) +
+        str(reg_dict.get('prd_nac', '   ')).ljust(3) + str(reg_dict.get('prd_srv', '   ')).ljust(3) +
+        str(reg_dict.get('prd_clf', '   ')).ljust(3) + str(reg_dict.get('prd_equipe_Seq', ' ' * 8)).ljust(8) +
+        str(reg_dict.get('prd_equipe_Area', ' ' * 4)).ljust(4) + str(reg_dict.get('prd_cnpj', ' ' * 14)).ljust(14) +
+        str(reg_dict.get('prd_cep_pcnte', ' ' * 8)).ljust(8) + str(reg_dict.get('prd_lograd_pcnte', '   ')).ljust(3) +
+        str(reg_dict.get('prd_end_pcnte', ' ' * 30)).ljust(30) + str(reg_dict.get('prd_compl_pcnte', ' ' * 10)).ljust(10) +
+        str(reg_dict.get('prd_num_pcnte', ' ' * 5)).ljust(5) + str(reg_dict.get('prd_bairro_pcnte', ' ' * 30)).ljust(30) +
+        str(reg_dict.get('prd_ddtel_pcnte', ' ' * 11)).ljust(11) + str(reg_dict.get('prd_email_pcnte', ' ' * 40)).ljust(40) +
+        str(reg_dict.get('prd_ine', ' ' * 10)).ljust(10) + str(reg_dict.get('prd_cpf_pcnte', ' ' * 11)).ljust(11) +
+        str(reg_dict.get('prd_situacao_rua', ' ')).ljust(1)
+    )
+    return linha_reg_str.ljust(350)[:350]
+
+
+def _gravar_referencia(exporter, competencia, registros, caminho):
+    """Escrita original: texto latin-1, um write por linha, cabeçalho reescrito ao final."""
+    provisorio = exporter._linha_header_bpa(exporter._montar_header_bpa(competencia, 0, exporter.calcular_controle([], total=0)))
+    num_linhas = total_controle = 0
+    with open(caminho, 'w', newline='', encoding='latin-1') as f:
+        f.write(provisorio + '\r\n')
+        for reg in registros:
+            f.write(_formatar_linha_referencia(reg) + '\r\n')
+            num_linhas += 1
+            total_controle += exporter._parcela_controle(reg)
+        f.seek(0)
+        f.write(exporter._linha_header_bpa(exporter._montar_header_bpa(
+            competencia, num_linhas, exporter.calcular_controle([], total=total_controle))))
+
+
+def registros_sinteticos(quantidade, distintos=1000):
+    """Gera `quantidade` registros BPA-I, reaproveitando `distintos` objetos para não medir alocação.
+
+    Inclui os casos de borda do formato: campos ausentes, None, valores maiores que a largura e inteiros.
+    """
+    from bpa_registro import RegistroBPAI
+    base = []
+    for i in range(distintos):
+        reg = RegistroBPAI(
+            prd_ident='03', prd_cnes='2560372', prd_cmp='202405', prd_cnsmed=f'{700000000000000 + i % 37:<15}',
+            prd_cbo='225125', prd_dtaten='20240515', prd_flh=str(i // 99 + 1).zfill(3), prd_seq=str(i % 99 + 1).zfill(2),
+            prd_pa='0301070024', prd_cnspac=f'{898000000000000 + i}', prd_sexo='MF'[i % 2], prd_ibge='172100',
+            prd_cid='F840', prd_ldade=str(i % 90), prd_qt=(i % 3) + 1 if i % 5 == 0 else '000001',
+            prd_caten='01', prd_naut=' ' * 13, prd_org='BPA', prd_nmpac=('PACIENTE COM NOME BEM MAIS LONGO QUE O CAMPO ' if i % 97 == 0 else f'PACIENTE {i}'),
+            prd_dtnasc='19800101', prd_raca='03', prd_etnia='    ', prd_nac='010', prd_srv='135', prd_clf='004',
+            prd_equipe_Seq=' ' * 8, prd_equipe_Area=' ' * 4, prd_cnpj='25062282000182', prd_cep_pcnte='77000000',
+            prd_lograd_pcnte='081', prd_end_pcnte='RUA ÁGUA MARINHA', prd_compl_pcnte=None if i % 11 == 0 else 'CASA',
+            prd_num_pcnte='123', prd_bairro_pcnte='CENTRO', prd_ddtel_pcnte='63999999999', prd_email_pcnte='',
+            prd_ine='0000000000', prd_cpf_pcnte='00000000000', prd_situacao_rua=' ', _id_lancamento_original=i,
+        )
+        if i % 13 == 0:
+            del reg.prd_ine # campo ausente: usa o valor padrão do layout
+        base.append(reg)
+    return [base[i % distintos] for i in range(quantidade)]
+
+
+def medir_escrita(linhas=LINHAS_ESCRITA_PADRAO, competencia='202405'):
+    """Grava o mesmo lote de registros com a escrita original e com gerar_arquivo_txt_streaming.
+
+    Retorna os tempos, a vazão e se os dois arquivos têm os mesmos bytes (sha256).
+    """
+    import contextlib
+    from bpa_exporter import BPAExporter
+    exporter = BPAExporter()
+    registros = registros_sinteticos(linhas)
+    with tempfile.TemporaryDirectory() as diretorio:
+        caminho_ref = os.path.join(diretorio, 'referencia.MAI')
+        inicio = time.perf_counter()
+        _gravar_referencia(exporter, competencia, registros, caminho_ref)
+        tempo_ref = time.perf_counter() - inicio
+
+        inicio = time.perf_counter()
+        with contextlib.redirect_stdout(sys.stderr):
+            gravadas = exporter.gerar_arquivo_txt_streaming(competencia, registros, os.path.join(diretorio, 'novo'))
+        tempo_novo = time.perf_counter() - inicio
+        caminho_novo = exporter._caminho_arquivo_bpa(competencia, os.path.join(diretorio, 'novo'))
+
+        resumos = []
+        for caminho in (caminho_ref, caminho_novo):
+            with open(caminho, 'rb') as f:
+                resumos.append(hashlib.file_digest(f, 'sha256').hexdigest() if hasattr(hashlib, 'file_digest')
+                               else hashlib.sha256(f.read()).hexdigest())
+    return {
+        'linhas': linhas,
+        'gravadas': gravadas,
+        'referencia_s': round(tempo_ref, 3),
+        'novo_s': round(tempo_novo, 3),
+        'linhas_por_s': round(linhas / tempo_novo) if tempo_novo else None,
+        'aceleracao': round(tempo_ref / tempo_novo, 2) if tempo_novo else None,
+        'bytes_identicos': resumos[0] == resumos[1],
+    }
+
+
+def linhas_bd_sinteticas(quantidade, semente=42):
+    """Linhas brutas no formato da consulta principal, com os casos de borda das regras do BPA-I
+    (None, '', espaços, datas ausentes, aniversário no dia, telefones com máscara, CID com ponto...).
+
+    Retorna (linhas, mapeamento_proc, tabela_proc_cid).
+    """
+    import random
+    import datetime
+    aleatorio = random.Random(semente)
+    escolher = aleatorio.choice
+    mapeamento_proc = {str(i): f'{i:02d}' for i in range(1, 40)}
+    mapeamento_proc['72'] = '72'
+    tabela_proc_cid = {
+        f'{i:02d}': {'codigo_sigtap': f'03010{i:05d}', 'servico': escolher(['135', '21', '164']),
+                     'classificacao': escolher(['001', '3', '007']), 'cid_obrigatorio': i % 3 == 0,
+                     'cid_sugestao': escolher([None, '', '  ', 'F84.0', 'g80'])}
+        for i in range(1, 30) # 30-39 ficam sem entrada: vão para o log de mapeamentos faltantes
+    }
+    inicio = datetime.date(2024, 5, 1)
+    linhas = []
+    for i in range(quantidade):
+        atendimento = escolher([inicio + datetime.timedelta(days=aleatorio.randrange(31)), None,
+                                datetime.datetime(2024, 5, 15, 10, 30)])
+        nascimento = escolher([datetime.date(aleatorio.randrange(1920, 2024), aleatorio.randrange(1, 13), aleatorio.randrange(1, 29)),
+                               None, datetime.date(2000, 5, 15), datetime.date(2000, 5, 16)])
+        linhas.append({
+            'id_lancamento': i + 1, 'cod_proc': escolher([str(aleatorio.randrange(1, 40)), aleatorio.randrange(1, 40), None, '', '72', 'X']),
+            'cns_med': escolher([f'{700000000000000 + aleatorio.randrange(50)}', None, '  123  ']),
+            'tp_funcao': escolher([aleatorio.randrange(1, 45), str(aleatorio.randrange(1, 45)), None, '', 'abc', 3.0]),
+            'nm_paciente': escolher([f'PACIENTE {i}', None, '', '   ', 'NOME COMPLETO MUITO MAIS LONGO QUE TRINTA POSICOES']),
+            'data_nasc': nascimento, 'data_atendimento': atendimento,
+            'conta_dt_inicio': escolher([inicio, None]),
+            'cnspac_paciente': escolher([f'{898000000000000 + i}', None, '']), 'cnspac_ficha': escolher([None, '700123456789012']),
+            'sexo': escolher(['3', 3, '1', None, ' 3 ']), 'mun_num_ibge': escolher(['172100', 172100, None, '1721000']),
+            'cod_raca': escolher(['4', '33', 19, '19', '99', None, ' 22 ']),
+            'cod_etnia_paciente': escolher([None, '12', 7, '']),
+            'cpf_paciente': escolher(['123.456.789-00', None, ' 12345678900 ', '']),
+            'e_pac_cep': escolher(['77.000-000', '7700', None, 77000000]),
+            'e_pac_tp_logradouro': escolher(['RUA', 'avenida', '81', 'ALAMEDA', None, 1]),
+            'e_pac_logradouro_nome': escolher(['RUA ÁGUA MARINHA', None, 'X' * 40]),
+            'e_complemento': escolher([None, 'CASA', 'APARTAMENTO 1203']), 'e_numero': escolher(['123', None, 'S/N', 1500]),
+            'e_pac_bairro_nome': escolher(['CENTRO', None]),
+            'fone_cel_1': escolher(['(63) 99999-9999', None, '', '0800 ²12']), 'fone_res_1': escolher([None, '6332221111']),
+            'email_paciente': escolher([None, 'paciente@exemplo.com']),
+            'lanc_cod_cid': escolher([None, '', '  ', 'f84.0', 'G80']), 'diagnostico': escolher([None, 'Z76.8', '']),
+            'conta_numero_guia': escolher([None, '12345']), 'numero_guia': escolher([None, 999]),
+            'ine_da_equipe_no_banco': escolher([None, '0001234567', 12]),
+        })
+    return linhas, mapeamento_proc, tabela_proc_cid
+
+
+def medir_motores(linhas=200_000, competencia='202405'):
+    """Motor por linha x vetorizado (motor_processamento) nas mesmas linhas sintéticas, pelo mesmo
+    _construir_registros_em_serie que processar_registros_bpa_i_completo usa.
+
+    Retorna os tempos (melhor de 3) e se os registros (na mesma ordem) e o log de mapeamentos
+    faltantes são idênticos.
+    """
+    import gc
+    from bpa_exporter import BPAExporter
+    linhas_bd, mapeamento_proc, tabela_proc_cid = linhas_bd_sinteticas(linhas)
+    resultados = {}
+    for motor in BPAExporter.MOTORES_PROCESSAMENTO:
+        exporter = BPAExporter()
+        exporter.config.update({'indicador_destino': 'E', 'cgc_cpf': '25062282000182', 'motor_processamento': motor})
+        tempos = []
+        for _ in range(3):
+            exporter.mapeamentos_faltantes_log.clear()
+            gc.collect()
+            inicio = time.perf_counter()
+            registros = exporter._construir_registros_em_serie(linhas_bd, competencia, mapeamento_proc, tabela_proc_cid)
+            tempos.append(time.perf_counter() - inicio)
+        resultados[motor] = (min(tempos), registros, set(exporter.mapeamentos_faltantes_log))
+
+    tempo_linhas, por_linha, faltantes_linhas = resultados['linhas']
+    tempo_vetorizado, vetorizado, faltantes_vetorizado = resultados['vetorizado']
+    divergentes = sum(1 for a, b in zip(por_linha, vetorizado) if a.como_dict() != b.como_dict())
+    divergentes += abs(len(por_linha) - len(vetorizado))
+    return {
+        'linhas': linhas,
+        'linhas_s': round(tempo_linhas, 3),
+        'vetorizado_s': round(tempo_vetorizado, 3),
+        'aceleracao': round(tempo_linhas / tempo_vetorizado, 2) if tempo_vetorizado else None,
+        'registros_divergentes': divergentes,
+        'log_faltantes_identico': faltantes_linhas == faltantes_vetorizado,
+    }
+
+
+def medir_motores_bd(config, data_inicio, data_fim, competencia, criterio='lancamento'):
+    """Paridade dos motores no banco do config.ini: as mesmas linhas do período passam por
+    processar_registros_bpa_i_completo com motor_processamento = 'linhas' e = 'vetorizado'.
+    """
+    import contextlib
+    from bpa_exporter import BPAExporter
+
+    exporter = BPAExporter()
+    with contextlib.redirect_stdout(sys.stderr):
+        params_bd = exporter.carregar_config_ini(config)
+        exporter.config['usar_cache_consultas'] = False
+        if not exporter.conectar_bd(**params_bd):
+            raise RuntimeError("Falha ao conectar ao banco de dados.")
+        with exporter.conexao():
+            sql, params, competencia = exporter._montar_consulta_completa(
+                datetime.date.fromisoformat(data_inicio), datetime.date.fromisoformat(data_fim), competencia, criterio)
+            linhas_bd = [linha for lote in exporter._iterar_lotes_bd(sql, params) for linha in lote]
+
+            resultados = {}
+            for motor in BPAExporter.MOTORES_PROCESSAMENTO:
+                exporter.config['motor_processamento'] = motor
+                exporter.mapeamentos_faltantes_log.clear()
+                inicio = time.perf_counter()
+                # Cópia: processar_registros_bpa_i_completo ordena a lista recebida
+                registros = exporter.processar_registros_bpa_i_completo(list(linhas_bd), competencia)
+                resultados[motor] = (time.perf_counter() - inicio, registros, set(exporter.mapeamentos_faltantes_log))
+        exporter.desconectar()
+
+    tempo_linhas, por_linha, faltantes_linhas = resultados['linhas']
+    tempo_vetorizado, vetorizado, faltantes_vetorizado = resultados['vetorizado']
+    divergentes = sum(1 for a, b in zip(por_linha, vetorizado) if a.como_dict() != b.como_dict())
+    divergentes += abs(len(por_linha) - len(vetorizado))
+    return {
+        'criterio': criterio,
+        'linhas': len(linhas_bd),
+        'linhas_s': round(tempo_linhas, 3),
+        'vetorizado_s': round(tempo_vetorizado, 3),
+        'registros_divergentes': divergentes,
+        'log_faltantes_identico': faltantes_linhas == faltantes_vetorizado,
+    }
+
+
+def _mapeamentos_referencia(exporter):
+    """De-paras como eram calculados antes da memorização (normalização + busca a cada linha)."""
+    def cbo(tp_funcao):
+        if tp_funcao is None or str(tp_funcao).strip() == '':
+            return "225142"
+        try:
+            if isinstance(tp_funcao, str) and tp_funcao.isdigit():
+                chave = int(tp_funcao)
+            elif isinstance(tp_funcao, (int, float)):
+                chave = int(tp_funcao)
+            else:
+                chave = str(tp_funcao).strip()
+        except (ValueError, TypeError):
+            return "225142"
+        return exporter.MAPEAMENTO_CBO.get(chave, "225142")
+
+    def raca(valor):
+        return exporter.MAPEAMENTO_RACA_BD_PARA_BPA.get(str(valor or '').strip(), '99')
+
+    def logradouro(valor):
+        if not valor: return "000"
+        val_str = str(valor).strip()
+        if val_str.isdigit() and len(val_str) <= 3: return val_str.zfill(3)
+        return exporter.MAPEAMENTO_TIPO_LOGRADOURO.get(val_str.upper(), "000").zfill(3)
+
+    return {'cbo': cbo, 'raca': raca, 'tipo_logradouro': logradouro}
+
+
+def medir_mapeamentos(linhas=200_000):
+    """Custo por linha dos de-paras de CBO, raça e tipo de logradouro: cálculo a cada linha x memorizado.
+
+    Usa as colunas tp_funcao, cod_raca e e_pac_tp_logradouro das linhas sintéticas e confere que os
+    resultados são os mesmos. Retorna {mapeamento: {'antes_ns', 'depois_ns', 'identicos'}}.
+    """
+    from bpa_exporter import BPAExporter
+    linhas_bd, _, _ = linhas_bd_sinteticas(linhas)
+    exporter = BPAExporter()
+    referencia = _mapeamentos_referencia(exporter)
+    casos = {
+        'cbo': ('tp_funcao', exporter.obter_cbo_por_funcao),
+        'raca': ('cod_raca', exporter._obter_codigo_raca),
+        'tipo_logradouro': ('e_pac_tp_logradouro', exporter._obter_codigo_tipo_logradouro),
+    }
+    resultado = {}
+    for nome, (coluna, memorizado) in casos.items():
+        valores = [reg.get(coluna) for reg in linhas_bd]
+        inicio = time.perf_counter()
+        antes = list(map(referencia[nome], valores))
+        tempo_antes = time.perf_counter() - inicio
+        inicio = time.perf_counter()
+        depois = list(map(memorizado, valores))
+        tempo_depois = time.perf_counter() - inicio
+        resultado[nome] = {
+            'antes_ns': round(tempo_antes / linhas * 1e9),
+            'depois_ns': round(tempo_depois / linhas * 1e9),
+            'identicos': antes == depois,
+        }
+    return resultado
+
+
+def medir_deduplicacao(linhas=200_000, competencia='202405'):
+    """Cada método de deduplicação em memória x em disco (limite_deduplicacao_memoria = 1) nas mesmas linhas.
+
+    Retorna {metodo: {'memoria_s', 'disco_s', 'registros', 'identicos'}}; identicos compara registros e ordem.
+    """
+    import contextlib
+    import io
+    from bpa_exporter import BPAExporter
+    from bpa_deduplicacao import ESPECIFICACOES
+    linhas_bd, mapeamento_proc, tabela_proc_cid = linhas_bd_sinteticas(linhas)
+    exporter = BPAExporter()
+    resultado = {}
+    for metodo in ESPECIFICACOES:
+        tempos, saidas = [], []
+        for limite in (0, 1):
+            exporter.config['limite_deduplicacao_memoria'] = limite
+            registros = [exporter._construir_registro_bpa_i(reg, competencia, mapeamento_proc, tabela_proc_cid) for reg in linhas_bd]
+            inicio = time.perf_counter()
+            with contextlib.redirect_stdout(io.StringIO()):
+                unicos = exporter.aplicar_deduplicacao(registros, metodo)
+            tempos.append(time.perf_counter() - inicio)
+            saidas.append([registro.como_dict() for registro in unicos])
+        resultado[metodo] = {
+            'memoria_s': round(tempos[0], 3),
+            'disco_s': round(tempos[1], 3),
+            'registros': len(saidas[0]),
+            'identicos': saidas[0] == saidas[1],
+        }
+    return resultado
+
+
+def _numerar_referencia(registros):
+    """Numeração original (contador reiniciado a cada troca de CNS): [(prd_flh, prd_seq), ...]."""
+    numeracao = []
+    cns_atual, folha, sequencia = None, 0, 0
+    for registro in registros:
+        cns = registro.get('prd_cnsmed', ' ').strip()
+        if cns != cns_atual:
+            cns_atual, folha, sequencia = cns, 1, 1
+        else:
+            sequencia += 1
+            if sequencia > 99:
+                folha, sequencia = folha + 1, 1
+        numeracao.append((str(folha).zfill(3), str(sequencia).zfill(2)))
+    return numeracao
+
+
+def medir_numeracao(linhas=200_000, competencia='202405'):
+    """Numeração de folha/sequência em registros já ordenados (comparada com a original) e fora de ordem
+    (ordenação em memória x externa, com limite_ordenacao_memoria = linhas // 7).
+
+    Retorna os tempos, 'ordenado_identico', 'externa_identica' e 'valida' (saída agrupada por
+    profissional, sem folha/sequência repetida e no máximo 99 por folha).
+    """
+    import contextlib
+    import io
+    from bpa_exporter import BPAExporter
+    from bpa_numeracao import agrupado_por_profissional, profissional
+    linhas_bd, mapeamento_proc, tabela_proc_cid = linhas_bd_sinteticas(linhas)
+    exporter = BPAExporter()
+
+    def construir():
+        return [exporter._construir_registro_bpa_i(reg, competencia, mapeamento_proc, tabela_proc_cid) for reg in linhas_bd]
+
+    ordenados = sorted(construir(), key=profissional)
+    referencia = _numerar_referencia(ordenados)
+    inicio = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        numerados = exporter._atribuir_folha_sequencia_final(ordenados)
+    tempo_ordenado = time.perf_counter() - inicio
+    ordenado_identico = [(r.prd_flh, r.prd_seq) for r in numerados] == referencia
+
+    tempos, saidas = [], []
+    for limite in (0, linhas // 7):
+        exporter.config['limite_ordenacao_memoria'] = limite
+        registros = construir()
+        inicio = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            numerados = list(exporter.iterar_folha_sequencia(registros, ordenados=False))
+        tempos.append(time.perf_counter() - inicio)
+        saidas.append([registro.como_dict() for registro in numerados])
+
+    numeracoes = [(profissional(r), r['prd_flh'], r['prd_seq']) for r in saidas[1]]
+    valida = (agrupado_por_profissional(saidas[1]) and len(set(numeracoes)) == len(numeracoes)
+              and all(1 <= int(seq) <= 99 for _, _, seq in numeracoes))
+    return {
+        'ordenado_s': round(tempo_ordenado, 3),
+        'fora_de_ordem_memoria_s': round(tempos[0], 3),
+        'fora_de_ordem_externa_s': round(tempos[1], 3),
+        'registros': len(saidas[0]),
+        'ordenado_identico': ordenado_identico,
+        'externa_identica': saidas[0] == saidas[1],
+        'valida': valida,
+    }
+
+
+def medir_processos(linhas=200_000, processos=None, competencia='202405'):
+    """Montagem dos registros em série x em pool de processos (processos_construcao) nas mesmas linhas.
+
+    O pool roda com `processos` (padrão: um por núcleo, no mínimo 2) mesmo onde a exportação ficaria em
+    série, para medir o ponto de equilíbrio; 'pool_na_exportacao' diz se _processos_construcao o usaria.
+    Retorna os tempos e se os registros (na mesma ordem) e o log de mapeamentos faltantes são idênticos.
+    """
+    from bpa_exporter import BPAExporter
+    linhas_bd, mapeamento_proc, tabela_proc_cid = linhas_bd_sinteticas(linhas)
+    exporter = BPAExporter()
+    nucleos = exporter._nucleos_disponiveis()
+    exporter.config.update({'indicador_destino': 'E', 'cgc_cpf': '25062282000182',
+                            'processos_construcao': processos or 0})
+    pool_na_exportacao = exporter._processos_construcao(len(linhas_bd)) > 1
+    processos = processos or max(2, nucleos)
+
+    exporter.mapeamentos_faltantes_log.clear()
+    inicio = time.perf_counter()
+    em_serie = exporter._construir_registros_em_serie(linhas_bd, competencia, mapeamento_proc, tabela_proc_cid)
+    tempo_serie = time.perf_counter() - inicio
+    faltantes_serie = set(exporter.mapeamentos_faltantes_log)
+
+    exporter.mapeamentos_faltantes_log.clear()
+    inicio = time.perf_counter()
+    em_processos = exporter._construir_registros_em_processos(linhas_bd, competencia, mapeamento_proc, tabela_proc_cid, processos)
+    tempo_processos = time.perf_counter() - inicio
+    faltantes_processos = set(exporter.mapeamentos_faltantes_log)
+
+    divergentes = sum(1 for a, b in zip(em_serie, em_processos) if a.como_dict() != b.como_dict())
+    divergentes += abs(len(em_serie) - len(em_processos))
+    return {
+        'linhas': linhas,
+        'processos': processos,
+        'nucleos': nucleos,
+        'pool_na_exportacao': pool_na_exportacao,
+        'serie_s': round(tempo_serie, 3),
+        'processos_s': round(tempo_processos, 3),
+        'aceleracao': round(tempo_serie / tempo_processos, 2) if tempo_processos else None,
+        'registros_divergentes': divergentes,
+        'log_faltantes_identico': faltantes_serie == faltantes_processos,
+    }
+
+
+def medir_formatacao_sql(config, data_inicio, data_fim, competencia, criterio='lancamento'):
+    """Paridade, no banco do config.ini, da consulta com os campos formatados no PostgreSQL
+    (formatar_no_sql=True) com a montagem em Python, sobre as mesmas linhas do período.
+
+    Compara registro a registro (mesma ordem, mesmos campos prd_*) e o log de mapeamentos faltantes;
+    depois, para cada método de deduplicação (inclusive os do config.ini), a deduplicação no SQL (_sql_deduplicacao) com
+    bpa_deduplicacao.deduplicar aplicado aos registros montados em Python (registros, ordem, prd_qt
+    somado e o log de faltantes das linhas descartadas).
+    Retorna as contagens, as divergências por campo e alguns id_lancamento divergentes de exemplo.
+    """
+    import contextlib
+    from bpa_exporter import BPAExporter
+    from bpa_registro import CAMPOS_SEM_NUMERACAO
+    from bpa_deduplicacao import deduplicar
+
+    data_inicio = datetime.date.fromisoformat(data_inicio)
+    data_fim = datetime.date.fromisoformat(data_fim)
+    exporter = BPAExporter()
+    with contextlib.redirect_stdout(sys.stderr):
+        params_bd = exporter.carregar_config_ini(config)
+        # As duas consultas precisam ler o banco, não o resultado guardado de uma execução anterior
+        exporter.config['usar_cache_consultas'] = False
+        if not exporter.conectar_bd(**params_bd):
+            raise RuntimeError("Falha ao conectar ao banco de dados.")
+
+        def consultar(**opcoes):
+            exporter.mapeamentos_faltantes_log.clear()
+            registros = exporter.consultar_dados_completo(data_inicio, data_fim, competencia, criterio, **opcoes)
+            return registros, set(exporter.mapeamentos_faltantes_log)
+
+        em_python, faltantes_python = consultar()
+        no_sql, faltantes_sql = consultar(formatar_no_sql=True)
+
+        deduplicacao = {}
+        for metodo in exporter.metodos_deduplicacao():
+            especificacao = exporter.especificacao_deduplicacao(metodo)
+            if especificacao is None:
+                continue
+            referencia = list(deduplicar(em_python, especificacao))
+            deduplicados_sql, faltantes_dedup = consultar(formatar_no_sql=True, metodo_dedup=metodo)
+            deduplicacao[metodo] = {
+                'python': len(referencia),
+                'sql': len(deduplicados_sql),
+                'identicos': ([r.como_dict() for r in referencia] == [r.como_dict() for r in deduplicados_sql]
+                              and faltantes_dedup == faltantes_python),
+            }
+
+    divergencias = {}
+    exemplos = []
+    for registro_python, registro_sql in zip(em_python, no_sql):
+        campos = [campo for campo in CAMPOS_SEM_NUMERACAO if registro_python.get(campo) != registro_sql.get(campo)]
+        for campo in campos:
+            divergencias[campo] = divergencias.get(campo, 0) + 1
+        if campos and len(exemplos) < 10:
+            exemplos.append(registro_python.get('_id_lancamento_original'))
+    return {
+        'criterio': criterio,
+        'registros_python': len(em_python),
+        'registros_sql': len(no_sql),
+        'divergencias_por_campo': divergencias,
+        'exemplos_id_lancamento': exemplos,
+        'log_faltantes_identico': faltantes_python == faltantes_sql,
+        'deduplicacao': deduplicacao,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Medições de desempenho do exportador BPA-I.')
+    subparsers = parser.add_subparsers(dest='comando', required=True)
+    p_importacao = subparsers.add_parser('importacao', help='Tempo de importação do núcleo (python -X importtime).')
+    p_importacao.add_argument('--modulo', default='bpa_exporter')
+    p_importacao.add_argument('--repeticoes', type=int, default=5)
+    p_importacao.add_argument('--limite-ms', type=float, default=150.0, help='Falha se a importação passar deste tempo')
+    p_escrita = subparsers.add_parser('escrita', help='Escrita do TXT BPA-I: codificador compilado x montagem original.')
+    p_escrita.add_argument('--linhas', type=int, default=LINHAS_ESCRITA_PADRAO)
+    p_motores = subparsers.add_parser('motores', help='Motor por linha x vetorizado: paridade e tempo (linhas sintéticas ou, com --config, o banco).')
+    p_motores.add_argument('--linhas', type=int, default=200_000)
+    p_motores.add_argument('--config', help='config.ini do banco: compara processar_registros_bpa_i_completo nas linhas do período')
+    p_motores.add_argument('--inicio', help='AAAA-MM-DD (com --config)')
+    p_motores.add_argument('--fim', help='AAAA-MM-DD (com --config)')
+    p_motores.add_argument('--competencia', help='AAAAMM (com --config)')
+    p_motores.add_argument('--criterio', default='lancamento', choices=['lancamento', 'conta', 'atendimento', 'competencia'])
+    p_mapeamentos = subparsers.add_parser('mapeamentos', help='Custo por linha dos de-paras de CBO, raça e logradouro (antes x memorizado).')
+    p_mapeamentos.add_argument('--linhas', type=int, default=200_000)
+    p_deduplicacao = subparsers.add_parser('deduplicacao', help='Deduplicação em memória x em disco (SQLite): paridade e tempo.')
+    p_deduplicacao.add_argument('--linhas', type=int, default=200_000)
+    p_numeracao = subparsers.add_parser('numeracao', help='Folha/sequência: ordem do banco x ordenação em memória e externa.')
+    p_numeracao.add_argument('--linhas', type=int, default=200_000)
+    p_processos = subparsers.add_parser('processos', help='Montagem em série x em pool de processos: paridade e tempo.')
+    p_processos.add_argument('--linhas', type=int, default=200_000)
+    p_processos.add_argument('--processos', type=int, help='Padrão: um por núcleo')
+    p_formatacao = subparsers.add_parser('formatacao_sql', help='Campos formatados no SQL x montagem em Python (e deduplicação no SQL) no banco do config.ini.')
+    p_formatacao.add_argument('--config', default=os.path.join(DIRETORIO, 'config.ini'))
+    p_formatacao.add_argument('--inicio', required=True, help='AAAA-MM-DD')
+    p_formatacao.add_argument('--fim', required=True, help='AAAA-MM-DD')
+    p_formatacao.add_argument('--competencia', required=True, help='AAAAMM')
+    p_formatacao.add_argument('--criterio', default='lancamento', choices=['lancamento', 'conta', 'atendimento', 'competencia'])
+    args = parser.parse_args()
+
+    if args.comando == 'importacao':
+        resultado = medir_importacao(args.modulo, args.repeticoes)
+        resultado['limite_ms'] = args.limite_ms
+        resultado['ok'] = not resultado['proibidos'] and resultado['tempo_ms'] <= args.limite_ms
+        print(json.dumps(resultado, ensure_ascii=False))
+        sys.exit(0 if resultado['ok'] else 1)
+    elif args.comando == 'escrita':
+        resultado = medir_escrita(args.linhas)
+        print(json.dumps(resultado, ensure_ascii=False))
+        sys.exit(0 if resultado['bytes_identicos'] and resultado['gravadas'] == args.linhas else 1)
+    elif args.comando == 'motores':
+        if args.config:
+            if not (args.inicio and args.fim and args.competencia):
+                parser.error('motores com --config requer --inicio, --fim e --competencia')
+            resultado = medir_motores_bd(args.config, args.inicio, args.fim, args.competencia, args.criterio)
+        else:
+            resultado = medir_motores(args.linhas)
+        print(json.dumps(resultado, ensure_ascii=False))
+        sys.exit(0 if resultado['registros_divergentes'] == 0 and resultado['log_faltantes_identico'] else 1)
+    elif args.comando == 'mapeamentos':
+        resultado = medir_mapeamentos(args.linhas)
+        print(json.dumps(resultado, ensure_ascii=False))
+        sys.exit(0 if all(medida['identicos'] for medida in resultado.values()) else 1)
+    elif args.comando == 'deduplicacao':
+        resultado = medir_deduplicacao(args.linhas)
+        print(json.dumps(resultado, ensure_ascii=False))
+        sys.exit(0 if all(medida['identicos'] for medida in resultado.values()) else 1)
+    elif args.comando == 'numeracao':
+        resultado = medir_numeracao(args.linhas)
+        print(json.dumps(resultado, ensure_ascii=False))
+        sys.exit(0 if resultado['ordenado_identico'] and resultado['externa_identica'] and resultado['valida'] else 1)
+    elif args.comando == 'processos':
+        resultado = medir_processos(args.linhas, args.processos)
+        print(json.dumps(resultado, ensure_ascii=False))
+        sys.exit(0 if resultado['registros_divergentes'] == 0 and resultado['log_faltantes_identico'] else 1)
+    elif args.comando == 'formatacao_sql':
+        resultado = medir_formatacao_sql(args.config, args.inicio, args.fim, args.competencia, args.criterio)
+        print(json.dumps(resultado, ensure_ascii=False))
+        identicos = (not resultado['divergencias_por_campo'] and resultado['log_faltantes_identico']
+                     and resultado['registros_python'] == resultado['registros_sql']
+                     and all(medida['identicos'] for medida in resultado['deduplicacao'].values()))
+        sys.exit(0 if identicos else 1)
+
+if __name__ == "__main__":
+    main()
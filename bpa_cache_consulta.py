@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Cache em disco do resultado bruto da consulta principal do BPA-I.
+Cada entrada é indexada pelo sha256 do SQL + parâmetros e guarda as linhas em forma colunar
+(nomes das colunas uma vez, depois lotes de tuplas em pickle). A entrada só é reaproveitada
+enquanto a sonda de atualização do banco (max(id_lancamento)) não mudar, ou seja, só inserts em
+sigh.lancamentos a invalidam: UPDATE/DELETE passam despercebidos até a validade expirar.
+As entradas têm dados de pacientes; o diretório é criado só para o usuário (0700).
+"""
+
+import os
+import time
+import pickle
+import hashlib
+import tempfile
+
+# Só max(id_lancamento): a chave primária responde com uma leitura do fim do índice. Um max() de
+# data_hora_criacao sem filtro não usa o índice parcial de BPAExporter.INDICES_RECOMENDADOS e varria a tabela toda.
+SQL_SONDA_ATUALIZACAO = "SELECT max(id_lancamento) FROM sigh.lancamentos"
+VERSAO_FORMATO = 1
+EXTENSAO = '.pkl'
+
+
+def diretorio_padrao():
+    base = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(base, 'cer4exporter', 'consultas')
+
+
+def chave_consulta(sql, params):
+    """sha256 do SQL e dos parâmetros (ordenados por nome)."""
+    conteudo = sql + '\n' + repr(sorted((str(k), repr(v)) for k, v in (params or {}).items()))
+    return hashlib.sha256(conteudo.encode('utf-8')).hexdigest()
+
+
+def sondar_atualizacao(conn):
+    """Consulta barata (fim do índice da chave primária de sigh.lancamentos) que muda quando há lançamentos novos."""
+    from sqlalchemy import text
+    row = conn.execute(text(SQL_SONDA_ATUALIZACAO)).fetchone()
+    return tuple(str(v) for v in row) if row is not None else ()
+
+
+class CacheConsultas:
+    """Guarda e relê os lotes brutos de uma consulta; validade_horas=None não expira por idade."""
+
+    def __init__(self, diretorio=None, validade_horas=24):
+        self.diretorio = diretorio or diretorio_padrao()
+        self.validade_horas = validade_horas
+
+    def _caminho(self, chave):
+        return os.path.join(self.diretorio, chave + EXTENSAO)
+
+    def ler(self, chave, sonda):
+        """Devolve um gerador de lotes (listas de dicts) se houver entrada válida; senão None."""
+        caminho = self._caminho(chave)
+        try:
+            arquivo = open(caminho, 'rb')
+        except FileNotFoundError:
+            return None
+        try:
+            cabecalho = pickle.load(arquivo)
+        except Exception:
+            arquivo.close()
+            self._remover(caminho)
+            return None
+        expirado = (self.validade_horas is not None
+                    and time.time() - cabecalho.get('criado_em', 0) > self.validade_horas * 3600)
+        if cabecalho.get('versao') != VERSAO_FORMATO or cabecalho.get('sonda') != sonda or expirado:
+            arquivo.close()
+            self._remover(caminho)
+            return None
+        return self._iterar_lotes(arquivo, cabecalho['colunas'])
+
+    @staticmethod
+    def _iterar_lotes(arquivo, colunas):
+        with arquivo:
+            while True:
+                try:
+                    linhas = pickle.load(arquivo)
+                except EOFError:
+                    return
+                yield [dict(zip(colunas, linha)) for linha in linhas]
+
+    def gravar(self, chave, sonda, lotes):
+        """Repassa os lotes (listas de dicts) gravando-os; a entrada só é publicada se o consumo chegar ao fim."""
+        os.makedirs(self.diretorio, mode=0o700, exist_ok=True)
+        fd, caminho_tmp = tempfile.mkstemp(dir=self.diretorio, suffix='.tmp')
+        concluido = False
+        try:
+            with os.fdopen(fd, 'wb') as arquivo:
+                colunas = None
+                for lote in lotes:
+                    if lote:
+                        if colunas is None:
+                            colunas = list(lote[0].keys())
+                            pickle.dump({'versao': VERSAO_FORMATO, 'sonda': sonda, 'colunas': colunas,
+                                         'criado_em': time.time()}, arquivo, pickle.HIGHEST_PROTOCOL)
+                        pickle.dump([tuple(reg[c] for c in colunas) for reg in lote], arquivo, pickle.HIGHEST_PROTOCOL)
+                    yield lote
+                if colunas is None:
+                    pickle.dump({'versao': VERSAO_FORMATO, 'sonda': sonda, 'colunas': [],
+                                 'criado_em': time.time()}, arquivo, pickle.HIGHEST_PROTOCOL)
+            os.replace(caminho_tmp, self._caminho(chave))
+            concluido = True
+        finally:
+            if not concluido:
+                self._remover(caminho_tmp)
+
+    def limpar(self):
+        """Remove todas as entradas do diretório de cache. Retorna quantas foram removidas."""
+        if not os.path.isdir(self.diretorio):
+            return 0
+        removidos = 0
+        for nome in os.listdir(self.diretorio):
+            if nome.endswith(EXTENSAO) or nome.endswith('.tmp'):
+                self._remover(os.path.join(self.diretorio, nome))
+                removidos += 1
+        return removidos
+
+    @staticmethod
+    def _remover(caminho):
+        try:
+            os.remove(caminho)
+        except OSError:
+            pass
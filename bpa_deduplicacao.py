@@ -0,0 +1,208 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Deduplicação dos registros BPA-I.
+Cada método é uma especificação declarativa (campos da chave + política para as repetições) e um
+único motor em streaming aplica qualquer uma delas, numa passada: a chave de cada registro é lida
+uma vez (attrgetter dos campos, que já chegam com a largura fixa do layout) e as quantidades somadas
+ficam em inteiros; o '000003' do arquivo só é montado na gravação.
+Acima de um limite de chaves únicas, o estado passa para um SQLite temporário (memória externa),
+com o mesmo resultado e a mesma ordem.
+"""
+
+import os
+import pickle
+import sqlite3
+import operator
+import tempfile
+import collections
+
+from bpa_registro import CAMPOS_SEM_NUMERACAO, RegistroBPAI, quantidade
+
+# Políticas para registros com a mesma chave
+MANTER_PRIMEIRO = 'manter_primeiro' # repassa o primeiro registro de cada chave e descarta os demais
+SOMAR = 'somar' # guarda o primeiro registro de cada chave e soma nele o prd_qt dos demais
+POLITICAS = (MANTER_PRIMEIRO, SOMAR)
+
+
+class EspecificacaoDeduplicacao(collections.namedtuple('EspecificacaoDeduplicacao',
+                                                       ('campos', 'politica', 'descartar_chave_nula'), defaults=(False,))):
+    """Campos da chave, política (MANTER_PRIMEIRO/SOMAR) e se registros com algum campo da chave None são descartados."""
+    __slots__ = ()
+
+
+ESPECIFICACOES = {
+    'completo': EspecificacaoDeduplicacao(
+        ('prd_cnes', 'prd_cmp', 'prd_cnsmed', 'prd_cbo', 'prd_dtaten', 'prd_pa', 'prd_cnspac', 'prd_cid'), SOMAR),
+    'simples': EspecificacaoDeduplicacao(('prd_cnspac', 'prd_pa', 'prd_dtaten'), SOMAR),
+    # Um registro por paciente/profissional/dia (CNES, competência, CBO, data, CNS do paciente)
+    'novo_manter_primeiro': EspecificacaoDeduplicacao(
+        ('prd_cnes', 'prd_cmp', 'prd_cbo', 'prd_dtaten', 'prd_cnspac'), MANTER_PRIMEIRO),
+    'por_id_lancamento': EspecificacaoDeduplicacao(('_id_lancamento_original',), MANTER_PRIMEIRO, descartar_chave_nula=True),
+}
+SEM_DEDUPLICACAO = 'nenhum'
+
+# Campos que podem compor uma chave: folha/sequência só existem depois da deduplicação
+CAMPOS_CHAVE_VALIDOS = CAMPOS_SEM_NUMERACAO
+
+
+def especificacao_de_texto(texto):
+    """Especificação escrita no config.ini ([DEDUPLICACAO]): 'campo1, campo2, ...; politica'.
+
+    Sem política, vale SOMAR (como o método completo). Levanta ValueError se um campo ou a política não existir.
+    """
+    campos_texto, _, politica = texto.partition(';')
+    campos = tuple(campo.strip() for campo in campos_texto.split(',') if campo.strip())
+    politica = politica.strip().lower() or SOMAR
+    if not campos:
+        raise ValueError(f"Deduplicação sem campos de chave: {texto!r}")
+    invalidos = [campo for campo in campos if campo not in CAMPOS_CHAVE_VALIDOS]
+    if invalidos:
+        raise ValueError(f"Campos de deduplicação inválidos: {', '.join(invalidos)}")
+    if politica not in POLITICAS:
+        raise ValueError(f"Política de deduplicação inválida: {politica} (use {', '.join(POLITICAS)})")
+    return EspecificacaoDeduplicacao(campos, politica)
+
+
+def deduplicar(registros, especificacao, limite_memoria=None, diretorio=None):
+    """Gera os registros (RegistroBPAI) sem repetição de chave, numa única passada.
+
+    MANTER_PRIMEIRO repassa cada registro assim que a chave aparece pela primeira vez; SOMAR guarda uma
+    cópia do primeiro registro de cada chave, com prd_qt como inteiro, acumula nela a quantidade dos
+    demais e entrega as cópias ao final, na ordem em que as chaves apareceram. Os registros de entrada
+    não são alterados.
+    limite_memoria: chaves únicas mantidas em memória; acima disso o estado vai para um SQLite
+    temporário em `diretorio` (None = pasta temporária do sistema). None ou 0 = sempre em memória.
+    """
+    chave_de = operator.attrgetter(*especificacao.campos)
+    descartar_nula = especificacao.descartar_chave_nula
+    if len(especificacao.campos) == 1:
+        nula = lambda chave: chave is None
+    else:
+        nula = lambda chave: None in chave
+    limite = limite_memoria or float('inf')
+    registros = iter(registros)
+    disco = None
+
+    try:
+        if especificacao.politica == MANTER_PRIMEIRO:
+            vistas = set()
+            adicionar = vistas.add
+            for registro in registros:
+                chave = chave_de(registro)
+                if chave not in vistas:
+                    if descartar_nula and nula(chave):
+                        continue
+                    adicionar(chave)
+                    yield registro
+                    if len(vistas) > limite:
+                        disco = ChavesEmDisco(diretorio)
+                        disco.receber_chaves(vistas)
+                        vistas = None
+                        break
+            if disco is not None:
+                for registro in registros:
+                    chave = chave_de(registro)
+                    if descartar_nula and nula(chave):
+                        continue
+                    if disco.adicionar(chave):
+                        yield registro
+            return
+
+        unicos = {}
+        for registro in registros:
+            chave = chave_de(registro)
+            existente = unicos.get(chave)
+            if existente is None:
+                if descartar_nula and nula(chave):
+                    continue
+                registro = registro.copy()
+                registro.prd_qt = quantidade(registro.prd_qt)
+                unicos[chave] = registro
+                if len(unicos) > limite:
+                    disco = ChavesEmDisco(diretorio)
+                    disco.receber_registros(unicos)
+                    unicos = None
+                    break
+            else:
+                existente.prd_qt += quantidade(registro.prd_qt)
+        if disco is None:
+            yield from unicos.values()
+            return
+        for registro in registros:
+            chave = chave_de(registro)
+            if descartar_nula and nula(chave):
+                continue
+            disco.somar(chave, registro)
+        yield from disco.registros()
+    finally:
+        if disco is not None:
+            disco.fechar()
+
+
+class ChavesEmDisco:
+    """Estado da deduplicação num SQLite temporário: as chaves já vistas e, na política SOMAR, o registro
+    único de cada chave com a quantidade acumulada, na ordem de chegada (rowid).
+
+    As chaves (tuplas de texto/inteiros) são gravadas como repr(), que é igual para chaves iguais.
+    """
+
+    # Campos gravados de cada registro: a deduplicação acontece antes da numeração (folha/sequência)
+    CAMPOS_GRAVADOS = CAMPOS_CHAVE_VALIDOS
+    LINHAS_POR_LEITURA = 10000
+
+    def __init__(self, diretorio=None):
+        descritor, self.caminho = tempfile.mkstemp(prefix='bpa_dedup_', suffix='.sqlite', dir=diretorio)
+        os.close(descritor)
+        self.conn = sqlite3.connect(self.caminho)
+        # Arquivo descartável: sem journal nem fsync
+        self.conn.execute("PRAGMA journal_mode = OFF")
+        self.conn.execute("PRAGMA synchronous = OFF")
+        self.conn.execute("PRAGMA cache_size = -65536") # 64 MB de cache de páginas
+        self.conn.execute("CREATE TABLE unicos (chave TEXT PRIMARY KEY, registro BLOB, quantidade INTEGER)")
+        self._valores = operator.attrgetter(*self.CAMPOS_GRAVADOS)
+        print(f"Deduplicação passando para o disco (memória externa): {self.caminho}")
+
+    def _registro_gravado(self, registro):
+        return pickle.dumps(self._valores(registro), pickle.HIGHEST_PROTOCOL)
+
+    def receber_chaves(self, chaves):
+        """Grava as chaves vistas até aqui (política MANTER_PRIMEIRO)."""
+        self.conn.executemany("INSERT INTO unicos (chave) VALUES (?)", ((repr(chave),) for chave in chaves))
+
+    def receber_registros(self, unicos):
+        """Grava {chave: registro} na ordem do dict (política SOMAR)."""
+        self.conn.executemany(
+            "INSERT INTO unicos (chave, registro, quantidade) VALUES (?, ?, ?)",
+            ((repr(chave), self._registro_gravado(registro), registro.prd_qt) for chave, registro in unicos.items()))
+
+    def adicionar(self, chave):
+        """True se a chave é nova (e passa a constar como vista)."""
+        return self.conn.execute("INSERT OR IGNORE INTO unicos (chave) VALUES (?)", (repr(chave),)).rowcount == 1
+
+    def somar(self, chave, registro):
+        """Soma o prd_qt do registro ao da chave, ou grava o registro se a chave é nova."""
+        chave_texto = repr(chave)
+        qtd = quantidade(registro.prd_qt)
+        if self.conn.execute("UPDATE unicos SET quantidade = quantidade + ? WHERE chave = ?", (qtd, chave_texto)).rowcount == 0:
+            self.conn.execute("INSERT INTO unicos (chave, registro, quantidade) VALUES (?, ?, ?)",
+                              (chave_texto, self._registro_gravado(registro), qtd))
+
+    def registros(self):
+        """Gera os registros únicos na ordem de chegada, com a quantidade acumulada."""
+        cursor = self.conn.execute("SELECT registro, quantidade FROM unicos ORDER BY rowid")
+        while True:
+            linhas = cursor.fetchmany(self.LINHAS_POR_LEITURA)
+            if not linhas:
+                return
+            lote = RegistroBPAI.de_linhas(self.CAMPOS_GRAVADOS, [pickle.loads(registro) for registro, _ in linhas])
+            for registro, (_, qtd) in zip(lote, linhas):
+                registro.prd_qt = qtd
+            yield from lote
+
+    def fechar(self):
+        self.conn.close()
+        try:
+            os.remove(self.caminho)
+        except OSError:
+            pass
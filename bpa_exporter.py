@@ -1,25 +1,125 @@
 import os
-import pandas as pd
-from sqlalchemy import create_engine, MetaData, Table, select, and_, func, text
-from sqlalchemy.orm import sessionmaker
 import datetime
 import math
-import configparser # Mantido, embora config seja gerenciada internamente na classe por enquanto
-import tkinter as tk
-from tkinter import ttk, filedialog, messagebox
-from tkcalendar import DateEntry
+import bisect
+import re
+import json
+import heapq
+import queue
+import threading
+import configparser
+import sys
+import time
 import csv
+import inspect
+import functools
+import contextlib
+import collections
+import operator
+import itertools
+
+from bpa_registro import RegistroBPAI, formatar_quantidade
+from bpa_numeracao import agrupado_por_profissional, numerar, ordenar_por_profissional, profissional
+from bpa_deduplicacao import ESPECIFICACOES as ESPECIFICACOES_DEDUPLICACAO, SEM_DEDUPLICACAO, SOMAR, deduplicar, especificacao_de_texto
+from bpa_layout import (TAMANHO_LINHA_BPA, REGISTRO_BPA_I_LAYOUT, PADROES_REGISTRO_BPA_I, CAMPOS_HEADER,
+                        compilar_codificador)
+
+
+def _com_conexao(metodo):
+    """Executa o método (ou gerador) dentro de BPAExporter.conexao(): uma conexão do pool por operação."""
+    if inspect.isgeneratorfunction(metodo):
+        @functools.wraps(metodo)
+        def gerador(self, *args, **kwargs):
+            with self.conexao():
+                yield from metodo(self, *args, **kwargs)
+        return gerador
+
+    @functools.wraps(metodo)
+    def envolvido(self, *args, **kwargs):
+        with self.conexao():
+            return metodo(self, *args, **kwargs)
+    return envolvido
+
+
+def _memorizado_por_valor(metodo):
+    """Guarda o resultado do método por valor bruto do banco, em um memo por exportador (self._memo_mapeamentos).
+
+    Para de-paras de colunas de baixa cardinalidade: cada valor distinto é calculado uma vez.
+    Valores não hashable são calculados sem memo.
+    """
+    nome = metodo.__name__
+
+    @functools.wraps(metodo)
+    def memorizado(self, valor):
+        memo = self._memo_mapeamentos[nome]
+        try:
+            return memo[valor]
+        except KeyError:
+            resultado = memo[valor] = metodo(self, valor)
+            return resultado
+        except TypeError:
+            return metodo(self, valor)
+    return memorizado
+
+
+class OperacaoCancelada(Exception):
+    """Levantada quando BPAExporter.cancelar() interrompe uma consulta ou exportação em andamento."""
+
 
 class BPAExporter:
-   
+
+    # CBO por tipo de função do profissional (prestadores.cod_tp_funcao)
+    MAPEAMENTO_CBO = {
+        1: "422105", 2: "351305", 3: "223208", 4: "225125", 5: "410105", 
+        6: "223208", 7: "413115", 8: "223405", 9: "223415", 10: "251605", 
+        11: "225270", 12: "411005", 13: "223710", 14: "521140", 15: "414105", 
+        16: "514320", 17: "514320", 18: "142105", 19: "225320", 20: "317210", 
+        21: "317210", 22: "225170", 23: "223810", 24: "223605", 25: "223905", 
+        26: "251510", 27: "225150", 28: "225160", 29: "223910", 30: "225145",
+        31: "223505", 32: "225135", 33: "225140", 34: "225130", 35: "224110",
+        36: "239215", 37: "225125", 38: "322205",
+    }
+
+    # De-para de raça/cor do SIGH para o código BPA-I
+    MAPEAMENTO_RACA_BD_PARA_BPA = {
+        # Chave: "Valor Origem BD" (da sua tabela de-para)
+        # Valor: "Valor Final" (código de 2 dígitos para o BPA-I)
+        # Certifique-se que os VALORES ('01', '02', etc.) são os códigos OFICIAIS do BPA-I
+        # (01-Branca, 02-Preta, 03-Parda, 04-Amarela, 05-Indígena, 99-Sem informação)
+        '4': '01',  # BRANCA (Ex: BD valor '4' -> BPA '01')
+        '33': '02', # PRETA  (Ex: BD valor '33' -> BPA '02')
+        '22': '03', # PARDA  (Ex: BD valor '22' -> BPA '03')
+        '16': '03', # MULATO -> Parda (Ex: BD valor '16' -> BPA '03')
+        '27': '03', # PARDA (variação) -> Parda (Ex: BD valor '27' -> BPA '03')
+        '20': '03', # MISTO -> Parda (Ex: BD valor '20' -> BPA '03', ou '99' se preferir)
+        '29': '04', # AMARELA (Ex: BD valor '29' -> BPA '04')
+        '26': '04', # AMAREL -> Amarela (Ex: BD valor '26' -> BPA '04')
+        '19': '05', # INDIGENA (Ex: BD valor '19' -> BPA '05')
+        '18': '05', # INDIA -> Indígena (Ex: BD valor '18' -> BPA '05')
+        '7':  '02', # NEGRO -> Preta (Ex: BD valor '7' -> BPA '02')
+        '31': '99', # NÃO INFORMADA (Ex: BD valor '31' -> BPA '99')
+    }
+
+    MAPEAMENTO_TIPO_LOGRADOURO = {"RUA": "001", "AVENIDA": "002", "TRAVESSA": "003", "PRACA": "004", "RODOVIA": "005"}
+
+    # Seções do config.ini que acrescentam/sobrepõem entradas dos de-paras acima (chave de self.config, tabela da classe)
+    SECOES_MAPEAMENTO = {
+        'MAPEAMENTO_CBO': ('mapeamento_cbo', 'MAPEAMENTO_CBO'),
+        'MAPEAMENTO_RACA': ('mapeamento_raca', 'MAPEAMENTO_RACA_BD_PARA_BPA'),
+        'MAPEAMENTO_TIPO_LOGRADOURO': ('mapeamento_tipo_logradouro', 'MAPEAMENTO_TIPO_LOGRADOURO'),
+    }
+
     def __init__(self):
         # Configurações iniciais
         self.engine = None
         self.metadata = None
-        self.conn = None
-        self.session = None
+        self._local = threading.local() # Conexão da operação em andamento, por thread (ver conexao())
         self.mapeamentos_faltantes_log = set() # Para armazenar códigos curtos faltantes
         self.gui_log_callback = None # Placeholder para a função de log da GUI
+        self.progresso_callback = None # f(etapa, feitos, total) com etapa 'buscados', 'processados' ou 'gravados'
+        self._cancelamento = threading.Event()
+        self._conexoes_em_consulta = set() # Conexões DBAPI com consulta em andamento (alvo de cancelar())
+        self._lock_conexoes = threading.Lock()
 
         # Configurações do BPA (padrão, podem ser sobrescritas pela GUI)
         self.config = {
@@ -32,77 +132,254 @@ class BPAExporter:
             'cnes': '0000000',
             'default_ibge_paciente': '000000', 
             'default_cep_paciente': '00000000', 
-            'default_ine': '0000000000' 
+            'default_ine': '0000000000',
+            'tamanho_lote_consulta': 5000, # Linhas por lote no cursor do servidor (modo streaming)
+            'arquivo_procedimentos': None, # CSV/SQLite de-para de procedimentos (None = procedimentos_bpa.csv)
+            'tabela_procedimentos_bd': None, # Ex.: 'bpa.procedimentos_bpa' para ler o de-para do banco
+            'cache_procedimentos_max_itens': 50000, # Cache LRU id_procedimento -> codigo_procedimento
+            'cache_procedimentos_ttl_segundos': 3600, # None = sem expiração
+            'tamanho_bloco_ids_procedimento': 1000, # ids por consulta ANY(array) em sigh.procedimentos
+            'usar_cache_consultas': False, # Reaproveita o resultado bruto da consulta; só inserts em sigh.lancamentos o invalidam
+            'diretorio_cache_consultas': None, # None = ~/.cache/cer4exporter/consultas
+            'validade_cache_consultas_horas': 24,
+            'diagnostico_datas_completo': False, # True = varre sigh.lancamentos (debug_datas_tabela) a cada consulta
+            'predicado_data': 'sargavel', # 'legado' = OR com cast ::date (como validado originalmente no SIGH)
+            'estrategia_endereco': 'distinct_on', # 'row_number' (original), 'lateral' (pede índice em enderecos.cod_paciente) ou 'distinct_on'
+            'particoes_extracao': 1, # > 1: consulta em streaming dividida em partições de id_lancamento, em paralelo
+            'motor_processamento': 'linhas', # 'vetorizado' = regras aplicadas por coluna (bpa_vetorizado, requer NumPy)
+            'processos_construcao': 1, # > 1: registros montados em processos paralelos (None ou 0 = um por núcleo); só compensa com 4+ núcleos
+            'min_linhas_processos': 50000, # Abaixo disso (ou com um só núcleo) a montagem fica em série
+            'pool_tamanho': 5, # Conexões mantidas no pool (a extração paralela usa uma por partição)
+            'pool_max_excedente': 10,
+            'pool_reciclagem_segundos': 1800, # Renova conexões antigas antes que firewall/servidor as derrube
+            'timeout_consulta_ms': 0, # statement_timeout de cada sessão (0 = sem limite)
+            'nome_aplicacao': 'cer4exporter', # application_name visto em pg_stat_activity
+            'mapeamento_cbo': None, # {tp_funcao: cbo} de [MAPEAMENTO_CBO], somado a MAPEAMENTO_CBO
+            'mapeamento_raca': None, # {cor no banco: código BPA} de [MAPEAMENTO_RACA], somado a MAPEAMENTO_RACA_BD_PARA_BPA
+            'mapeamento_tipo_logradouro': None, # {NOME: código} de [MAPEAMENTO_TIPO_LOGRADOURO], somado a MAPEAMENTO_TIPO_LOGRADOURO
+            'deduplicacoes_personalizadas': None, # {nome: 'campo1, campo2; politica'} de [DEDUPLICACAO]
+            'limite_deduplicacao_memoria': 1000000, # Chaves únicas em memória (~2-3 KB cada); acima disso a deduplicação segue em SQLite temporário (0 = nunca)
+            'limite_ordenacao_memoria': 500000, # Registros ordenados em memória antes da numeração; acima disso a ordenação é externa (0 = nunca)
+            'diretorio_incremental': None, # Estado da exportação incremental (None = ~/.cache/cer4exporter/incremental)
+            'diretorio_temporario': None, # Onde criar os arquivos da deduplicação/ordenação em disco (None = pasta temporária do sistema)
         }
+        self._tabelas_mapeamento = None # De-paras efetivos (classe + config), montados no primeiro uso
+        self._memo_mapeamentos = collections.defaultdict(dict) # Resultados de @_memorizado_por_valor, por método
+        self._cache_codigos_procedimento = None
+        self._estatisticas_datas_lancamentos = None # Colunas de data de sigh.lancamentos + pg_stats (por conexão)
         
+    # Tabelas que a consulta principal usa com nomes fixos; [MAPEAMENTO_TABELAS] do config.ini é conferido contra elas.
+    TABELAS_CONSULTA = {'schema': 'sigh', 'tabela_ficha': 'ficha_amb_int', 'tabela_lancamentos': 'lancamentos',
+                        'tabela_pacientes': 'pacientes', 'tabela_prestadores': 'prestadores', 'tabela_municipios': 'municipios'}
+
+    def carregar_config_ini(self, caminho):
+        """Lê o config.ini e aplica [BPA] e [EXPORTACAO] em self.config. Retorna os parâmetros de conectar_bd ([DATABASE]).
+
+        Em [EXPORTACAO] vale qualquer chave de self.config; o valor é convertido para o tipo do padrão
+        (booleano, inteiro) e 'none' ou vazio vira None.
+        """
+        parser = configparser.ConfigParser()
+        if not parser.read(caminho, encoding='utf-8'):
+            raise FileNotFoundError(f"Arquivo de configuração não encontrado: {caminho}")
+
+        if parser.has_section('BPA'):
+            for chave, valor in parser.items('BPA'):
+                self.config[chave] = valor
+        if parser.has_section('EXPORTACAO'):
+            for chave, valor in parser.items('EXPORTACAO'):
+                padrao = self.config.get(chave)
+                if valor.strip().lower() in ('', 'none'):
+                    self.config[chave] = None
+                elif isinstance(padrao, bool):
+                    self.config[chave] = parser.getboolean('EXPORTACAO', chave)
+                elif isinstance(padrao, int):
+                    self.config[chave] = parser.getint('EXPORTACAO', chave)
+                else:
+                    self.config[chave] = valor
+        for secao, (chave_config, _) in self.SECOES_MAPEAMENTO.items():
+            if parser.has_section(secao):
+                self.config[chave_config] = dict(parser.items(secao))
+        self.limpar_mapeamentos()
+        if parser.has_section('DEDUPLICACAO'):
+            personalizadas = dict(parser.items('DEDUPLICACAO'))
+            for especificacao in personalizadas.values():
+                especificacao_de_texto(especificacao) # Erro no config.ini aparece já na leitura
+            self.config['deduplicacoes_personalizadas'] = personalizadas
+        if parser.has_section('MAPEAMENTO_TABELAS'):
+            for chave, esperado in self.TABELAS_CONSULTA.items():
+                valor = parser.get('MAPEAMENTO_TABELAS', chave, fallback=esperado)
+                if valor != esperado:
+                    print(f"Aviso: [MAPEAMENTO_TABELAS] {chave} = {valor}, mas a consulta usa '{esperado}'; o valor será ignorado.")
+
+        banco = parser['DATABASE'] if parser.has_section('DATABASE') else {}
+        return {
+            'db_name': banco.get('db_name', 'bd0553'), 'user': banco.get('db_user', 'postgres'),
+            'password': banco.get('db_password', 'postgres'), 'host': banco.get('db_host', 'localhost'),
+            'port': banco.get('db_port', '5432'),
+        }
+
+    def tabelas_mapeamento(self):
+        """De-paras efetivos {'cbo', 'raca', 'tipo_logradouro'}: tabelas da classe mais as entradas do config.ini.
+
+        Montados uma vez por exportador; limpar_mapeamentos() refaz depois de mudar self.config.
+        """
+        if self._tabelas_mapeamento is None:
+            extras = {chave_config: self.config.get(chave_config) or {} for chave_config, _ in self.SECOES_MAPEAMENTO.values()}
+            self._tabelas_mapeamento = {
+                'cbo': {**self.MAPEAMENTO_CBO,
+                        **{self._chave_cbo(tp): str(cbo).strip() for tp, cbo in extras['mapeamento_cbo'].items()}},
+                'raca': {**self.MAPEAMENTO_RACA_BD_PARA_BPA,
+                         **{str(cor).strip(): str(cod).strip() for cor, cod in extras['mapeamento_raca'].items()}},
+                'tipo_logradouro': {**self.MAPEAMENTO_TIPO_LOGRADOURO,
+                                    **{str(nome).strip().upper(): str(cod).strip() for nome, cod in extras['mapeamento_tipo_logradouro'].items()}},
+            }
+        return self._tabelas_mapeamento
+
+    def limpar_mapeamentos(self):
+        """Descarta os de-paras montados e os resultados memorizados (após mudar os mapeamentos em self.config)."""
+        self._tabelas_mapeamento = None
+        self._memo_mapeamentos.clear()
+
+    # tp_funcao inteiro em forma de texto: '39', '039', '39.0' (float) ou '39.00' (numeric/Decimal)
+    _RE_CHAVE_CBO_INTEIRA = re.compile(r'[0-9]+(\.0*)?')
+
+    @staticmethod
+    def _chave_cbo(tp_funcao):
+        """Chave de tp_funcao no de-para de CBO: inteiro quando o texto é um número inteiro, qualquer que
+        seja o tipo devolvido pelo driver (int, float, Decimal ou texto); senão o próprio texto.
+
+        A consulta formatada normaliza do mesmo jeito (_sql_chave_cbo).
+        """
+        texto = str(tp_funcao).strip()
+        if BPAExporter._RE_CHAVE_CBO_INTEIRA.fullmatch(texto):
+            return int(texto.split('.')[0])
+        return texto
+
+    @_memorizado_por_valor
     def obter_cbo_por_funcao(self, tp_funcao):
         """Obtém o código CBO baseado no tipo de função do profissional"""
-        
         if tp_funcao is None or str(tp_funcao).strip() == '':
             return "225142" 
-
-        mapeamento_cbo = {
-            1: "422105", 2: "351305", 3: "223208", 4: "225125", 5: "410105", 
-            6: "223208", 7: "413115", 8: "223405", 9: "223415", 10: "251605", 
-            11: "225270", 12: "411005", 13: "223710", 14: "521140", 15: "414105", 
-            16: "514320", 17: "514320", 18: "142105", 19: "225320", 20: "317210", 
-            21: "317210", 22: "225170", 23: "223810", 24: "223605", 25: "223905", 
-            26: "251510", 27: "225150", 28: "225160", 29: "223910", 30: "225145",
-            31: "223505", 32: "225135", 33: "225140", 34: "225130", 35: "224110",
-            36: "239215", 37: "225125", 38: "322205",
-        }
-        
-        try:
-            if isinstance(tp_funcao, str) and tp_funcao.isdigit():
-                tp_funcao_key = int(tp_funcao)
-            elif isinstance(tp_funcao, (int, float)):
-                 tp_funcao_key = int(tp_funcao)
-            else: 
-                tp_funcao_key = str(tp_funcao).strip()
-        except (ValueError, TypeError):
-            return "225142" 
-        
-        return mapeamento_cbo.get(tp_funcao_key, "225142") 
+        tp_funcao_key = self._chave_cbo(tp_funcao)
+        if tp_funcao_key is None:
+            return "225142"
+        return self.tabelas_mapeamento()['cbo'].get(tp_funcao_key, "225142")
             
     def conectar_bd(self, db_name="bd0553", user="postgres", password="postgres", host="localhost", port="5432"):
-        """Conecta ao banco de dados PostgreSQL"""
+        """Conecta ao banco de dados PostgreSQL.
+
+        Cria o engine com pool (pre-ping, reciclagem, statement_timeout e application_name); nenhuma
+        conexão fica aberta entre operações: cada uma pega a sua do pool em conexao().
+        """
         try:
+            from sqlalchemy import create_engine, MetaData, text # SQLAlchemy só é carregado ao conectar
+            self.desconectar()
             connection_string = f"postgresql://{user}:{password}@{host}:{port}/{db_name}"
-            self.engine = create_engine(connection_string)
+            self.engine = create_engine(
+                connection_string,
+                pool_size=self.config.get('pool_tamanho', 5),
+                max_overflow=self.config.get('pool_max_excedente', 10),
+                pool_pre_ping=True,
+                pool_recycle=self.config.get('pool_reciclagem_segundos', 1800),
+                connect_args={
+                    'application_name': self.config.get('nome_aplicacao', 'cer4exporter'),
+                    'options': f"-c statement_timeout={int(self.config.get('timeout_consulta_ms') or 0)}",
+                },
+            )
             self.metadata = MetaData()
-            self.conn = self.engine.connect() 
-            Session = sessionmaker(bind=self.engine)
-            self.session = Session()
+            with self.engine.connect() as conn:
+                conn.execute(text("SELECT 1"))
+            self._estatisticas_datas_lancamentos = None
             print("\nConexão com o banco de dados estabelecida com sucesso!")
             return True
         except Exception as e:
             print(f"Erro ao conectar ao banco de dados: {str(e)}")
+            self.desconectar()
             return False
-    
-    def calcular_controle(self, registros):
-        """Calcula o campo de controle"""
-        total = 0
-        for reg in registros:
-            proc_code_str = str(reg.get('prd_pa', '0')) 
-            proc_code = ''.join(filter(str.isdigit, proc_code_str))
+
+    def desconectar(self):
+        """Fecha todas as conexões do pool."""
+        if self.engine is not None:
+            self.engine.dispose()
+            self.engine = None
+
+    @property
+    def conn(self):
+        """Conexão da operação em andamento nesta thread (None fora de conexao() ou sem engine)."""
+        return getattr(self._local, 'conn', None)
+
+    @contextlib.contextmanager
+    def conexao(self):
+        """Pega uma conexão do pool para uma operação e a devolve ao final (com rollback).
+
+        Chamadas aninhadas na mesma thread reaproveitam a conexão já aberta.
+        """
+        atual = self.conn
+        if atual is not None or self.engine is None:
+            yield atual
+            return
+        with self.engine.connect() as conn:
+            self._local.conn = conn
             try:
-                proc_code_int = int(proc_code) if proc_code else 0
-            except ValueError:
-                proc_code_int = 0
+                yield conn
+            finally:
+                self._local.conn = None
+
+    def cancelar(self):
+        """Pede a interrupção da operação em andamento (pode ser chamado de outra thread).
+
+        Envia o cancelamento ao servidor para as consultas em execução e faz as etapas seguintes
+        levantarem OperacaoCancelada no próximo ponto de verificação.
+        """
+        self._cancelamento.set()
+        with self._lock_conexoes:
+            conexoes = list(self._conexoes_em_consulta)
+        for conexao_dbapi in conexoes:
             try:
-                quantidade_str = str(reg.get('prd_qt', '0')).replace('.', '')
-                quantidade = int(quantidade_str) if quantidade_str.strip() else 0
-            except (ValueError, TypeError):
-                quantidade = 0
-            total += proc_code_int + quantidade
+                conexao_dbapi.cancel()
+            except Exception as e:
+                print(f"Aviso: falha ao cancelar a consulta no servidor: {str(e)}")
+
+    def limpar_cancelamento(self):
+        self._cancelamento.clear()
+
+    def _informar_progresso(self, etapa, feitos, total=None):
+        """Repassa o progresso ao progresso_callback e interrompe a operação se houve cancelamento."""
+        if self._cancelamento.is_set():
+            raise OperacaoCancelada("Operação cancelada pelo usuário.")
+        if callable(self.progresso_callback):
+            self.progresso_callback(etapa, feitos, total)
+
+    @staticmethod
+    def _parcela_controle(reg):
+        """Parcela de um registro no campo de controle (código do procedimento + quantidade)."""
+        proc_code_str = str(reg.get('prd_pa', '0'))
+        proc_code = ''.join(filter(str.isdigit, proc_code_str))
+        try:
+            proc_code_int = int(proc_code) if proc_code else 0
+        except ValueError:
+            proc_code_int = 0
+        try:
+            quantidade_str = str(reg.get('prd_qt', '0')).replace('.', '')
+            quantidade = int(quantidade_str) if quantidade_str.strip() else 0
+        except (ValueError, TypeError):
+            quantidade = 0
+        return proc_code_int + quantidade
+
+    def calcular_controle(self, registros, total=None):
+        """Calcula o campo de controle (ou finaliza a partir de um total já acumulado)"""
+        if total is None:
+            total = sum(self._parcela_controle(reg) for reg in registros)
         resultado = (total % 1111) + 1111
         return resultado
     
     def gerar_header_bpa(self, competencia, registros):
         """Gera o cabeçalho do BPA conforme layout"""
-        num_linhas = len(registros)
+        return self._montar_header_bpa(competencia, len(registros), self.calcular_controle(registros))
+
+    def _montar_header_bpa(self, competencia, num_linhas, campo_controle):
+        """Monta o dict do cabeçalho a partir dos totais já calculados."""
         num_folhas = math.ceil(num_linhas / 99) if num_linhas > 0 else 1 # CORRIGIDO para 99
-        campo_controle = self.calcular_controle(registros)
         
         header = {
             'cbc_hdr_1': '01', 'cbc_hdr_2': '#BPA#', 'cbc_mvm': competencia, 
@@ -117,6 +394,12 @@ class BPAExporter:
         }
         return header
 
+    @staticmethod
+    def _linha_header_bpa(header_dict):
+        # Os valores já vêm com a largura do layout (_montar_header_bpa); aqui só seguem a ordem dos campos
+        return ''.join(header_dict[campo] for campo in CAMPOS_HEADER)
+
+    @_com_conexao
     def debug_datas_tabela(self, data_inicio, data_fim):
         # ... (código do debug_datas_tabela permanece o mesmo) ...
         if not self.conn:
@@ -180,6 +463,69 @@ class BPAExporter:
             import traceback; traceback.print_exc()
             return None
 
+    def _carregar_estatisticas_datas_lancamentos(self):
+        """Lê uma única vez (por conexão) as colunas de data de sigh.lancamentos e suas estatísticas do pg_stats.
+
+        Retorna [(coluna, null_frac, mcv, mcf, histograma)] na ordem das colunas, mais o reltuples da tabela.
+        """
+        if self._estatisticas_datas_lancamentos is not None:
+            return self._estatisticas_datas_lancamentos
+        from sqlalchemy import text
+        colunas = [row[0] for row in self.conn.execute(text(
+            "SELECT a.attname FROM pg_attribute a "
+            "WHERE a.attrelid = 'sigh.lancamentos'::regclass AND a.attnum > 0 AND NOT a.attisdropped "
+            "AND format_type(a.atttypid, a.atttypmod) IN ('date', 'timestamp without time zone', 'timestamp with time zone') "
+            "ORDER BY a.attnum"
+        ))]
+        reltuples = self.conn.execute(text("SELECT reltuples FROM pg_class WHERE oid = 'sigh.lancamentos'::regclass")).scalar() or 0
+        stats = {}
+        if colunas:
+            for row in self.conn.execute(text(
+                "SELECT attname, null_frac, most_common_vals::text::text[] AS mcv, most_common_freqs AS mcf, "
+                "histogram_bounds::text::text[] AS hist FROM pg_stats "
+                "WHERE schemaname = 'sigh' AND tablename = 'lancamentos' AND attname = ANY(:colunas)"
+            ), {'colunas': colunas}):
+                stats[row.attname] = (row.null_frac or 0.0, row.mcv or [], row.mcf or [], row.hist or [])
+        self._estatisticas_datas_lancamentos = (
+            [(coluna,) + stats.get(coluna, (0.0, [], [], [])) for coluna in colunas], max(reltuples, 0)
+        )
+        return self._estatisticas_datas_lancamentos
+
+    @staticmethod
+    def _estimar_linhas_periodo(null_frac, mcv, mcf, hist, reltuples, inicio, fim):
+        """Estimativa de linhas com a coluna entre inicio e fim (AAAA-MM-DD), como o planejador faria."""
+        freq_mcv = sum(f for v, f in zip(mcv, mcf) if inicio <= v[:10] <= fim)
+        freq_hist = 0.0
+        if len(hist) > 1:
+            limites = [v[:10] for v in hist]
+            baldes = bisect.bisect_right(limites, fim) - bisect.bisect_left(limites, inicio)
+            freq_hist = (1.0 - null_frac - sum(mcf)) * min(max(baldes, 0), len(hist) - 1) / (len(hist) - 1)
+        return reltuples * (freq_mcv + freq_hist)
+
+    @_com_conexao
+    def estimar_coluna_data_lancamento(self, data_inicio, data_fim):
+        """Escolhe a coluna de data de sigh.lancamentos com mais linhas estimadas no período, sem varrer a tabela.
+
+        Usa as estatísticas do ANALYZE (pg_stats/reltuples), lidas uma vez por conexão. Para o diagnóstico
+        completo (COUNT/MIN/MAX por coluna) use debug_datas_tabela ou a opção 'diagnostico_datas_completo'.
+        """
+        if not self.conn:
+            return None
+        try:
+            inicio = data_inicio.isoformat() if isinstance(data_inicio, datetime.date) else str(data_inicio)
+            fim = data_fim.isoformat() if isinstance(data_fim, datetime.date) else str(data_fim)
+            colunas, reltuples = self._carregar_estatisticas_datas_lancamentos()
+            melhor_coluna, maior_estimativa = None, 0
+            for coluna, null_frac, mcv, mcf, hist in colunas:
+                estimativa = self._estimar_linhas_periodo(null_frac, mcv, mcf, hist, reltuples, inicio, fim)
+                print(f"  Coluna {coluna}: ~{int(estimativa)} registros estimados no período (pg_stats)")
+                if estimativa > maior_estimativa:
+                    melhor_coluna, maior_estimativa = coluna, estimativa
+            return melhor_coluna
+        except Exception as e:
+            print(f"Erro ao estimar a coluna de data pelas estatísticas: {str(e)}")
+            return None
+
     def consultar_dados_com_debug(self, data_inicio, data_fim, competencia=None, criterio_data="atendimento"):
         # ... (código do consultar_dados_com_debug sem alterações significativas na lógica central) ...
         if criterio_data == "lancamento":
@@ -194,8 +540,11 @@ class BPAExporter:
         # Esta função não será alterada pois a GUI usa consultar_dados_completo
         return []
 
-    def _build_sql_completo(self, coluna_data_filtro, alias_tabela_filtro="l"):
-        """Constrói a string SQL COMPLETA comum para diferentes critérios de data."""
+    def _build_sql_completo(self, coluna_data_filtro, alias_tabela_filtro="l", filtro_enderecos=None):
+        """Constrói a string SQL COMPLETA comum para diferentes critérios de data.
+
+        filtro_enderecos é o WHERE da consulta, usado pela estratégia 'distinct_on' de _sql_join_endereco.
+        """
         # Esta função já estava correta nas últimas versões, sem p.cpf, p.situacao_rua, fi.situacao_rua
         return f"""
         SELECT
@@ -235,160 +584,804 @@ class BPAExporter:
             sigh.pacientes AS p ON fi.cod_paciente = p.id_paciente
         LEFT JOIN
             sigh.prestadores AS pr ON fi.cod_medico = pr.id_prestador
-        LEFT JOIN (
+        {self._sql_join_endereco(filtro_enderecos)}
+        LEFT JOIN
+            endereco_sigh.municipios AS mun_pac ON p.cod_municipio = mun_pac.id_municipio
+        """
+
+    ESTRATEGIAS_ENDERECO = ('row_number', 'lateral', 'distinct_on')
+
+    def _sql_join_endereco(self, filtro_enderecos=None):
+        """JOIN do endereço ativo mais recente (maior id_endereco) do paciente, conforme 'estrategia_endereco'.
+
+        - row_number: numera todos os endereços ativos da tabela e junta o rn = 1 (forma original);
+        - lateral: busca, para cada paciente do resultado, o último endereço ativo (LIMIT 1);
+        - distinct_on: DISTINCT ON por paciente, restrito aos pacientes que passam em filtro_enderecos.
+        """
+        estrategia = self.config.get('estrategia_endereco', 'distinct_on')
+        if estrategia == 'lateral':
+            return """LEFT JOIN LATERAL (
+            SELECT en.* FROM sigh.enderecos AS en
+            WHERE en.cod_paciente = p.id_paciente AND en.ativo = 't'
+            ORDER BY en.id_endereco DESC
+            LIMIT 1
+        ) AS e ON TRUE"""
+        if estrategia == 'distinct_on':
+            pacientes_do_periodo = ""
+            if filtro_enderecos:
+                # Mesmos aliases (l, c, fi) da consulta principal, para reaproveitar o WHERE e os parâmetros.
+                pacientes_do_periodo = f"""
+              AND en.cod_paciente IN (
+                SELECT fi.cod_paciente
+                FROM sigh.lancamentos AS l
+                JOIN sigh.contas AS c ON l.cod_conta = c.id_conta
+                JOIN sigh.ficha_amb_int AS fi ON c.cod_fia = fi.id_fia
+                {filtro_enderecos}
+              )"""
+            return f"""LEFT JOIN (
+            SELECT DISTINCT ON (en.cod_paciente) en.*
+            FROM sigh.enderecos AS en
+            WHERE en.ativo = 't'{pacientes_do_periodo}
+            ORDER BY en.cod_paciente, en.id_endereco DESC
+        ) AS e ON p.id_paciente = e.cod_paciente"""
+        if estrategia != 'row_number':
+            raise ValueError(f"estrategia_endereco inválida: {estrategia} (use {', '.join(self.ESTRATEGIAS_ENDERECO)})")
+        return """LEFT JOIN (
             SELECT *, ROW_NUMBER() OVER(PARTITION BY cod_paciente ORDER BY id_endereco DESC) as rn
             FROM sigh.enderecos
             WHERE ativo = 't'
-        ) AS e ON p.id_paciente = e.cod_paciente AND e.rn = 1
+        ) AS e ON p.id_paciente = e.cod_paciente AND e.rn = 1"""
+
+    @staticmethod
+    def _sql_literal(valor):
+        """Literal SQL de texto para as tabelas de-para embutidas (VALUES)."""
+        if valor is None:
+            return "NULL"
+        return "'" + str(valor).replace("'", "''") + "'"
+
+    @staticmethod
+    def _sql_ljust(expressao, largura):
+        """rpad com a semântica de str.ljust: completa com espaços, mas não corta o que passar da largura."""
+        return f"rpad({expressao}, GREATEST({largura}, length({expressao})))"
+
+    @staticmethod
+    def _sql_zfill(expressao, largura):
+        """lpad com zeros com a semântica de str.zfill: não corta o que passar da largura."""
+        return f"lpad({expressao}, GREATEST({largura}, length({expressao})), '0')"
+
+    @staticmethod
+    def _sql_chave_cbo(expressao):
+        """Normalização de _chave_cbo no SQL: texto de número inteiro ('039', '39.00') vira '39'."""
+        texto = f"btrim({expressao}::text)"
+        return (f"CASE WHEN {texto} ~ '^[0-9]+(\\.0*)?$' "
+                f"THEN split_part({texto}, '.', 1)::numeric::text ELSE {texto} END")
+
+    def _build_sql_bpa_i_formatado(self, competencia, filtro_enderecos=None, ordem=None):
+        """Constrói o SQL que devolve os campos prd_* já formatados (largura fixa) pelo PostgreSQL.
+
+        Reproduz _construir_registro_bpa_i: de-para de procedimento/CID, CBO, raça, logradouro,
+        idade, datas, CEP e telefone. Só a folha/sequência fica para o Python.
+        filtro_enderecos: como em _build_sql_completo. ordem: cláusula ORDER BY que numera as linhas
+        na coluna fmt_ordem (usada pela deduplicação no SQL). Retorna (sql_sem_where_order_by, params).
+        """
+        tabela_proc_cid = self.carregar_tabela_procedimentos_cid()
+        valores_proc = ",\n                ".join(
+            f"({self._sql_literal(codigo)}, {self._sql_literal(info.get('codigo_sigtap'))}, "
+            f"{self._sql_literal(info.get('servico'))}, {self._sql_literal(info.get('classificacao'))}, "
+            f"{self._sql_literal(info.get('cid_sugestao'))}, {'TRUE' if info.get('cid_obrigatorio') else 'FALSE'})"
+            for codigo, info in tabela_proc_cid.items()
+        )
+        tabelas = self.tabelas_mapeamento()
+        valores_cbo = ", ".join(
+            f"({self._sql_literal(tp_funcao)}, {self._sql_literal(cbo)})" for tp_funcao, cbo in tabelas['cbo'].items()
+        )
+        casos_raca = " ".join(
+            f"WHEN {self._sql_literal(cod_bd)} THEN {self._sql_literal(cod_bpa)}"
+            for cod_bd, cod_bpa in tabelas['raca'].items()
+        )
+        casos_logradouro = " ".join(
+            f"WHEN {self._sql_literal(nome)} THEN {self._sql_literal(cod)}"
+            for nome, cod in tabelas['tipo_logradouro'].items()
+        )
+
+        params = {
+            "fmt_competencia": competencia,
+            "fmt_cnes": self.config.get('cnes', '0000000'),
+            "fmt_default_ibge": self.config.get('default_ibge_paciente', '000000'),
+            "fmt_default_cep": self.config.get('default_cep_paciente', '00000000'),
+            "fmt_default_ine": self.config.get('default_ine', '0000000000'),
+            "fmt_cnpj_estab": self.config.get('cgc_cpf', '') if self.config.get('indicador_destino') == 'E' else '',
+        }
+
+        coluna_ordem = f",\n            ROW_NUMBER() OVER ({ordem}) AS fmt_ordem" if ordem else ""
+
+        sql = f"""
+        WITH tab_proc_bpa (codigo_curto, codigo_sigtap, servico, classificacao, cid_sugestao, cid_obrigatorio) AS (
+            VALUES
+                {valores_proc}
+        ),
+        tab_cbo_bpa (tp_funcao, cbo) AS (
+            VALUES {valores_cbo}
+        )
+        SELECT
+            '03' AS prd_ident,
+            {self._sql_ljust('CAST(:fmt_cnes AS text)', 7)} AS prd_cnes,
+            CAST(:fmt_competencia AS text) AS prd_cmp,
+            {self._sql_ljust("btrim(COALESCE(pr.cns::text, ''))", 15)} AS prd_cnsmed,
+            {self._sql_ljust("COALESCE(cbo.cbo, '225142')", 6)} AS prd_cbo,
+            COALESCE(to_char(COALESCE(fi.data_atendimento, c.dt_inicio), 'YYYYMMDD'), CAST(:fmt_competencia AS text) || '01') AS prd_dtaten,
+            {self._sql_ljust("COALESCE(tp.codigo_sigtap, '0301010013')", 10)} AS prd_pa,
+            {self._sql_ljust("btrim(COALESCE(fi.matricula::text, ''))", 15)} AS prd_cnspac,
+            CASE WHEN btrim(COALESCE(p.cod_sexo::text, '')) = '3' THEN 'F' ELSE 'M' END AS prd_sexo,
+            rpad(btrim(COALESCE(NULLIF(mun_pac.num_ibge::text, ''), CAST(:fmt_default_ibge AS text))), 6) AS prd_ibge,
+            CASE WHEN cid_fmt.cid = '    ' THEN cid_src.fallback ELSE cid_fmt.cid END AS prd_cid,
+            lpad(LEAST(GREATEST(COALESCE(date_part('year', age(COALESCE(fi.data_atendimento, c.dt_inicio)::date, p.data_nasc::date))::int, 0), 0), 130)::text, 3, '0') AS prd_ldade,
+            1 AS prd_qt,
+            '01' AS prd_caten,
+            rpad(btrim(COALESCE(NULLIF(c.numero_guia::text, ''), '')), 13) AS prd_naut,
+            'BPA' AS prd_org,
+            rpad(btrim(COALESCE(NULLIF(p.nm_paciente, ''), 'PACIENTE NAO IDENTIFICADO')), 30) AS prd_nmpac,
+            COALESCE(to_char(p.data_nasc, 'YYYYMMDD'), '19000101') AS prd_dtnasc,
+            raca.raca AS prd_raca,
+            CASE WHEN raca.raca = '05' AND btrim(COALESCE(p.cod_etnia_indigena::text, '')) <> ''
+                 THEN {self._sql_zfill('btrim(p.cod_etnia_indigena::text)', 4)} ELSE '    ' END AS prd_etnia,
+            '010' AS prd_nac,
+            {self._sql_zfill("COALESCE(tp.servico, '135')", 3)} AS prd_srv,
+            {self._sql_zfill("COALESCE(tp.classificacao, '001')", 3)} AS prd_clf,
+            '        ' AS "prd_equipe_Seq",
+            '    ' AS "prd_equipe_Area",
+            {self._sql_ljust('CAST(:fmt_cnpj_estab AS text)', 14)} AS prd_cnpj,
+            CASE WHEN end_fmt.cep <> '' THEN {self._sql_zfill('end_fmt.cep', 8)}
+                 ELSE {self._sql_ljust('CAST(:fmt_default_cep AS text)', 8)} END AS prd_cep_pcnte,
+            CASE WHEN end_fmt.tp_logradouro = '' THEN '000'
+                 WHEN end_fmt.tp_logradouro ~ '^[0-9]{{1,3}}$' THEN lpad(end_fmt.tp_logradouro, 3, '0')
+                 ELSE {self._sql_zfill(f"CASE upper(end_fmt.tp_logradouro) {casos_logradouro} ELSE '000' END", 3)}
+            END AS prd_lograd_pcnte,
+            rpad(btrim(COALESCE(e.pac_logradouro, '')), 30) AS prd_end_pcnte,
+            rpad(btrim(COALESCE(e.complemento, '')), 10) AS prd_compl_pcnte,
+            rpad(btrim(COALESCE(e.numero::text, '')), 5) AS prd_num_pcnte,
+            rpad(btrim(COALESCE(e.pac_bairro, '')), 30) AS prd_bairro_pcnte,
+            rpad(regexp_replace(btrim(COALESCE(NULLIF(p.fone_cel_1::text, ''), p.fone_res_1::text, '')), '[^0-9]', '', 'g'), 11) AS prd_ddtel_pcnte,
+            rpad(btrim(COALESCE(p.email, '')), 40) AS prd_email_pcnte,
+            {self._sql_ljust('CAST(:fmt_default_ine AS text)', 10)} AS prd_ine,
+            '           ' AS prd_cpf_pcnte,
+            ' ' AS prd_situacao_rua,
+            l.id_lancamento AS _id_lancamento_original,
+            l.cod_proc AS fmt_cod_proc,
+            proc.codigo_procedimento AS fmt_codigo_curto,
+            (tp.codigo_curto IS NOT NULL) AS fmt_proc_mapeado{coluna_ordem}
+        FROM
+            sigh.lancamentos AS l
+        JOIN
+            sigh.contas AS c ON l.cod_conta = c.id_conta
+        JOIN
+            sigh.ficha_amb_int AS fi ON c.cod_fia = fi.id_fia
+        LEFT JOIN
+            sigh.pacientes AS p ON fi.cod_paciente = p.id_paciente
+        LEFT JOIN
+            sigh.prestadores AS pr ON fi.cod_medico = pr.id_prestador
+        {self._sql_join_endereco(filtro_enderecos)}
         LEFT JOIN
             endereco_sigh.municipios AS mun_pac ON p.cod_municipio = mun_pac.id_municipio
+        LEFT JOIN
+            sigh.procedimentos AS proc ON proc.id_procedimento = l.cod_proc
+        LEFT JOIN
+            tab_proc_bpa AS tp ON tp.codigo_curto = proc.codigo_procedimento::text
+        LEFT JOIN
+            tab_cbo_bpa AS cbo ON cbo.tp_funcao = {self._sql_chave_cbo('pr.cod_tp_funcao')}
+        CROSS JOIN LATERAL (
+            SELECT {self._sql_ljust(f"COALESCE(CASE btrim(COALESCE(p.cod_raca_etnia::text, '')) {casos_raca} END, '99')", 2)} AS raca
+        ) AS raca
+        CROSS JOIN LATERAL (
+            SELECT replace(replace(btrim(COALESCE(e.pac_cep::text, '')), '.', ''), '-', '') AS cep,
+                   btrim(COALESCE(e.pac_tp_logradouro::text, '')) AS tp_logradouro
+        ) AS end_fmt
+        CROSS JOIN LATERAL (
+            SELECT btrim(COALESCE(l.cod_cid::text, '')) AS lanc,
+                   btrim(COALESCE(fi.diagnostico::text, '')) AS diag,
+                   CASE WHEN COALESCE(l.cod_cid::text, '') = '' AND COALESCE(fi.diagnostico::text, '') = ''
+                        THEN tp.cid_sugestao END AS sug,
+                   CASE WHEN COALESCE(tp.cid_obrigatorio, FALSE) THEN 'Z000' ELSE '    ' END AS fallback
+        ) AS cid_src
+        CROSS JOIN LATERAL (
+            SELECT CASE WHEN cid_src.lanc = '' AND cid_src.diag = '' AND btrim(COALESCE(cid_src.sug, '')) = ''
+                        THEN cid_src.fallback
+                        ELSE left(rpad(replace(upper(COALESCE(NULLIF(cid_src.lanc, ''), NULLIF(cid_src.diag, ''),
+                                                              NULLIF(cid_src.sug, ''), cid_src.fallback)), '.', ''), 4), 4)
+                   END AS cid
+        ) AS cid_fmt
+        """
+        return sql, params
+
+    # Ordenação equivalente, no banco, à chave usada em processar_registros_bpa_i_completo.
+    # No modo streaming as linhas já chegam nessa ordem e não são reordenadas em Python.
+    ORDER_BY_STREAMING = (
+        "ORDER BY btrim(COALESCE(pr.cns::text, '')) COLLATE \"C\", "
+        "fi.data_atendimento NULLS FIRST, l.data NULLS FIRST, "
+        "btrim(COALESCE(p.nm_paciente, '')) COLLATE \"C\", l.id_lancamento"
+    )
+
+    @staticmethod
+    def _sql_deduplicacao(sql_formatado, especificacao):
+        """Envolve a consulta formatada (com a coluna fmt_ordem) na deduplicação da especificação,
+        para o PostgreSQL devolver só as linhas finais.
+
+        Cada chave (GROUP BY dos campos prd_*) fica com a sua primeira linha na ordem do streaming
+        (menor fmt_ordem), como em bpa_deduplicacao.deduplicar; na política SOMAR o grupo traz a soma
+        de prd_qt em fmt_qt_grupo. Os procedimentos sem mapeamento de todas as linhas do grupo vêm em
+        fmt_faltantes, para o log de mapeamentos faltantes continuar completo.
+        """
+        chave = ", ".join(f'"{campo}"' for campo in especificacao.campos)
+        soma = "SUM(prd_qt)" if especificacao.politica == SOMAR else "NULL::bigint"
+        filtro_chave_nula = ""
+        if especificacao.descartar_chave_nula:
+            filtro_chave_nula = "WHERE " + " AND ".join(f'"{campo}" IS NOT NULL' for campo in especificacao.campos)
+        return f"""
+        WITH base AS ({sql_formatado}
+        ),
+        grupos AS (
+            SELECT MIN(fmt_ordem) AS fmt_ordem, {soma} AS fmt_qt_grupo,
+                   array_agg(DISTINCT ARRAY[fmt_codigo_curto::text, fmt_cod_proc::text])
+                       FILTER (WHERE NOT fmt_proc_mapeado AND fmt_codigo_curto IS NOT NULL) AS fmt_faltantes
+            FROM base
+            {filtro_chave_nula}
+            GROUP BY {chave}
+        )
+        SELECT base.*, grupos.fmt_qt_grupo, grupos.fmt_faltantes
+        FROM base JOIN grupos USING (fmt_ordem)
+        ORDER BY fmt_ordem"""
+
+    # Mesma condição de data validada no SIGH, em forma que usa índices: sem cast na coluna, com faixa
+    # semiaberta em data_hora_criacao e o OR separado em UNION ALL (o IN elimina ids repetidos).
+    SQL_IDS_PERIODO_SARGAVEL = """l.id_lancamento IN (
+            SELECT id_lancamento FROM sigh.lancamentos
+            WHERE data_hora_criacao >= :data_inicio AND data_hora_criacao < :data_fim_exclusivo
+              AND cod_cc = 2 AND cod_tp_ato = 56 AND cod_proc IS NOT NULL
+            UNION ALL
+            SELECT id_lancamento FROM sigh.lancamentos
+            WHERE data >= :data_inicio AND data <= :data_fim
+              AND cod_cc = 2 AND cod_tp_ato = 56 AND cod_proc IS NOT NULL
+        )"""
+
+    # Índices que atendem aos filtros e junções de _montar_consulta_completa: (tabela, colunas, predicado parcial).
+    INDICES_RECOMENDADOS = [
+        ('sigh.lancamentos', ['data_hora_criacao'], 'cod_cc = 2 AND cod_tp_ato = 56 AND cod_proc IS NOT NULL'),
+        ('sigh.lancamentos', ['data'], 'cod_cc = 2 AND cod_tp_ato = 56 AND cod_proc IS NOT NULL'),
+        ('sigh.lancamentos', ['cod_conta'], None),
+        ('sigh.contas', ['competencia'], None),
+        ('sigh.contas', ['cod_fia'], None),
+        ('sigh.enderecos', ['cod_paciente', 'id_endereco'], "ativo = 't'"),
+    ]
+
+    @_com_conexao
+    def sugerir_indices(self):
+        """Compara INDICES_RECOMENDADOS com pg_indexes e devolve o DDL dos que faltam.
+
+        Um índice existente cobre a recomendação se as colunas recomendadas forem o seu prefixo e ele
+        não tiver predicado, ou tiver o mesmo predicado parcial.
+        """
+        from sqlalchemy import text
+        def normalizar(expr):
+            return re.sub(r'[\s()"]', '', (expr or '').lower()).replace("='t'", '=true')
+
+        tabelas = sorted({tabela for tabela, _, _ in self.INDICES_RECOMENDADOS})
+        existentes = {}
+        for row in self.conn.execute(text(
+            "SELECT schemaname || '.' || tablename AS tabela, indexname, indexdef FROM pg_indexes "
+            "WHERE schemaname || '.' || tablename = ANY(:tabelas)"
+        ), {'tabelas': tabelas}):
+            m = re.search(r'USING \w+ \((.*?)\)(?: INCLUDE \(.*?\))?(?: WHERE (.*))?$', row.indexdef)
+            if not m:
+                continue
+            colunas = [normalizar(c.split()[0]) for c in m.group(1).split(',')]
+            existentes.setdefault(row.tabela, []).append((row.indexname, colunas, normalizar(m.group(2))))
+
+        sugestoes = []
+        for tabela, colunas, predicado in self.INDICES_RECOMENDADOS:
+            cobertura = [nome for nome, cols, pred in existentes.get(tabela, [])
+                         if cols[:len(colunas)] == colunas and (not pred or pred == normalizar(predicado))]
+            if cobertura:
+                print(f"OK  {tabela} ({', '.join(colunas)}): coberto por {', '.join(cobertura)}")
+                continue
+            nome = f"ix_{tabela.split('.')[-1]}_{'_'.join(colunas)}" + ('_bpa' if predicado else '')
+            ddl = f"CREATE INDEX CONCURRENTLY IF NOT EXISTS {nome} ON {tabela} ({', '.join(colunas)})"
+            if predicado:
+                ddl += f" WHERE {predicado}"
+            print(f"FALTA {tabela} ({', '.join(colunas)}):\n    {ddl};")
+            sugestoes.append(ddl)
+        return sugestoes
+
+    def _montar_consulta_completa(self, data_inicio, data_fim, competencia=None, criterio_data="lancamento", streaming=False, formatar_no_sql=False, particao=None, deduplicacao=None,
+                                  filtro_extra=None, assinaturas=False):
+        """Monta o SQL completo (SELECT + filtros SIGH + ORDER BY). Retorna (sql, params, competencia_gui).
+
+        Com formatar_no_sql=True o SELECT é o de _build_sql_bpa_i_formatado (campos prd_* prontos),
+        sempre ordenado como no modo streaming.
+        particao=(i, n) restringe aos lançamentos com id_lancamento % n = i (extração paralela).
+        deduplicacao: EspecificacaoDeduplicacao aplicada no próprio SQL (_sql_deduplicacao); só com
+        formatar_no_sql, pois a chave usa os campos prd_* formatados.
+        filtro_extra=(condição, params) é somado ao WHERE (p.ex. os lançamentos alterados, na exportação incremental).
+        assinaturas=True devolve só (id_lancamento, assinatura) de cada linha da consulta completa, sem
+        ordenação: md5 do texto da linha, com o código do procedimento (ver consultar_dados_incremental).
         """
+        if deduplicacao is not None and not formatar_no_sql:
+            raise ValueError("A deduplicação no SQL requer formatar_no_sql=True.")
+        # Validação e formatação de competência (GUI continua AAAAMM)
+        if competencia is None or len(competencia) != 6 or not competencia.isdigit():
+            competencia_gui = datetime.datetime.now().strftime("%Y%m") # Usado para processar_registros_bpa_i_completo
+        else:
+            competencia_gui = competencia
+
+        # Formato da competência para o banco de dados (AAAA/MM) se o critério for competência
+        competencia_bd_formatada = competencia_gui[:4] + "/" + competencia_gui[4:]
+
+        data_inicio_str = data_inicio.isoformat() if isinstance(data_inicio, datetime.date) else str(data_inicio)
+        data_fim_str = data_fim.isoformat() if isinstance(data_fim, datetime.date) else str(data_fim)
+
+        # Coluna de data para o ALIAS 'data_filtro_usada' no SELECT e para o ORDER BY
+        coluna_data_para_select_no_alias = "data"
+        alias_tabela_para_select = "l" # Default para 'lancamento'
+
+        # Determina a coluna de data para o SELECT e ORDER BY baseado na seleção da GUI.
+        # A cláusula WHERE principal usará a lógica de data confirmada do SIGH.
+        if criterio_data == "lancamento":
+            if self.conn and not formatar_no_sql:
+                # Escolhe a melhor coluna 'data_lancamento' para SELECT/ORDER BY pelas estatísticas do banco;
+                # a varredura completa de debug_datas_tabela só roda se pedida explicitamente.
+                if self.config.get('diagnostico_datas_completo'):
+                    coluna_data_para_select_no_alias = self.debug_datas_tabela(data_inicio, data_fim) or "data"
+                else:
+                    coluna_data_para_select_no_alias = self.estimar_coluna_data_lancamento(data_inicio, data_fim) or "data"
+            else:
+                coluna_data_para_select_no_alias = "data"
+            alias_tabela_para_select = "l"
+            print(f"Coluna de data para SELECT/ORDER BY (GUI='{criterio_data}'): {alias_tabela_para_select}.{coluna_data_para_select_no_alias}")
+        elif criterio_data == "conta":
+            coluna_data_para_select_no_alias = "dt_inicio"; alias_tabela_para_select = "c"
+            print(f"Coluna de data para SELECT/ORDER BY (GUI='{criterio_data}'): {alias_tabela_para_select}.{coluna_data_para_select_no_alias}")
+        elif criterio_data == "atendimento":
+            coluna_data_para_select_no_alias = "data_atendimento"; alias_tabela_para_select = "fi"
+            print(f"Coluna de data para SELECT/ORDER BY (GUI='{criterio_data}'): {alias_tabela_para_select}.{coluna_data_para_select_no_alias}")
+        elif criterio_data == "competencia":
+            coluna_data_para_select_no_alias = "competencia"; alias_tabela_para_select = "c"
+            print(f"Campo para SELECT 'data_filtro_usada' (GUI='{criterio_data}'): {alias_tabela_para_select}.{coluna_data_para_select_no_alias}")
+
+        # --- Montando a Cláusula WHERE e Parâmetros ---
+        condicoes_where_comuns_sigh = [
+            "c.ativo = 't'",
+            "c.status_conta = 'A'",
+            "c.codigo_conta IN (1, 2)",
+            "l.cod_cc = 2",
+            "l.cod_tp_ato = 56",
+            "l.cod_proc IS NOT NULL"
+            # Adicione aqui filtros de fi.tipo_atend ou fi.cod_situacao_atendimento
+            # SE eles faziam parte da sua query que deu 6766/4516 DISTINCT id_lancamento.
+            # Ex:
+            # "fi.tipo_atend = 'AMB'",
+            # "fi.cod_situacao_atendimento = 4"
+        ]
 
-    def consultar_dados_completo(self, data_inicio, data_fim, competencia=None, criterio_data="lancamento"):
-            """Consulta completa aplicando os filtros SIGH validados."""
-            if not self.conn:
-                log_msg = "Erro: Sem conexão com o banco de dados para consulta completa."
-                print(log_msg)
-                if hasattr(self, 'gui_log_callback') and callable(self.gui_log_callback):
-                    self.gui_log_callback(log_msg)
-                return []
+        params = {}
+        if criterio_data == "competencia":
+            condicoes_especificas = ["c.competencia = :competencia_param"] + condicoes_where_comuns_sigh
+            where_clause_final = "WHERE " + " AND ".join(condicoes_especificas)
+            params = {"competencia_param": competencia_bd_formatada,
+                    "data_inicio": data_inicio_str,
+                    "data_fim": data_fim_str}
+            print(f"Usando critério GUI: COMPETÊNCIA DA CONTA ({competencia_bd_formatada}) com filtros SIGH.")
+        else:
+            # Para critérios de data da GUI (lancamento, conta, atendimento)
+            # Usamos a condição de data que você validou.
+            params = {"data_inicio": data_inicio_str, "data_fim": data_fim_str}
+            if self.config.get('predicado_data') == 'legado':
+                condicao_data_validada_sigh = f"((l.data_hora_criacao::date BETWEEN :data_inicio AND :data_fim) OR (l.data BETWEEN :data_inicio AND :data_fim))"
+            else:
+                condicao_data_validada_sigh = self.SQL_IDS_PERIODO_SARGAVEL
+                params["data_fim_exclusivo"] = (datetime.date.fromisoformat(data_fim_str[:10]) + datetime.timedelta(days=1)).isoformat()
+
+            condicoes_com_data_validada = [condicao_data_validada_sigh] + condicoes_where_comuns_sigh
+            where_clause_final = "WHERE " + " AND ".join(condicoes_com_data_validada)
+            print(f"Usando critério GUI: {criterio_data} com filtros SIGH validados (incluindo data SIGH).")
+
+        if particao is not None:
+            where_clause_final += "\n  AND l.id_lancamento % :n_particoes = :particao"
+            params.update({"particao": particao[0], "n_particoes": particao[1]})
+
+        if filtro_extra is not None:
+            where_clause_final += f"\n  AND {filtro_extra[0]}"
+            params.update(filtro_extra[1])
+
+        if assinaturas:
+            # Mesmas junções e WHERE da consulta completa; só duas colunas saem do servidor. Um lançamento
+            # com várias linhas (endereços, p.ex.) tem uma assinatura só, das linhas em ordem fixa.
+            sql_linhas = self._build_sql_completo(coluna_data_para_select_no_alias, alias_tabela_para_select, where_clause_final)
+            sql_assinaturas = f"""
+        SELECT texto.id_lancamento, md5(string_agg(texto.linha, ',' ORDER BY texto.linha)) AS assinatura
+        FROM (
+            SELECT linha.id_lancamento, linha::text || '|' || COALESCE(proc.codigo_procedimento::text, '') AS linha
+            FROM ({sql_linhas}
+        {where_clause_final}) AS linha
+            LEFT JOIN
+                sigh.procedimentos AS proc ON proc.id_procedimento = linha.cod_proc
+        ) AS texto
+        GROUP BY texto.id_lancamento
+        """
+            return sql_assinaturas, params, competencia_gui
+
+        # _build_sql_completo monta o SELECT e os JOINs.
+        params_select = {}
+        if formatar_no_sql:
+            ordem = self.ORDER_BY_STREAMING if deduplicacao is not None else None
+            sql_base, params_select = self._build_sql_bpa_i_formatado(competencia_gui, where_clause_final, ordem)
+        else:
+            sql_base = self._build_sql_completo(coluna_data_para_select_no_alias, alias_tabela_para_select, where_clause_final)
+        params.update(params_select)
+
+        # Ordenação
+        if streaming or formatar_no_sql:
+            order_by_clause = self.ORDER_BY_STREAMING
+        else:
+            order_by_data_field_para_ordenacao = "c.dt_inicio" # Default para competência
+            if criterio_data != "competencia":
+                order_by_data_field_para_ordenacao = f"{alias_tabela_para_select}.{coluna_data_para_select_no_alias}"
+            order_by_clause = f"ORDER BY pr.cns, {order_by_data_field_para_ordenacao}, l.cod_proc, l.id_lancamento, p.id_paciente"
+
+        if deduplicacao is not None:
+            # A ordem vem de fmt_ordem (ROW_NUMBER com o mesmo ORDER BY), no SELECT externo
+            full_sql_query_str = self._sql_deduplicacao(sql_base + "\n" + where_clause_final, deduplicacao)
+        else:
+            full_sql_query_str = sql_base + "\n" + where_clause_final + "\n" + order_by_clause
+        return full_sql_query_str, params, competencia_gui
+
+    @_com_conexao
+    def comparar_estrategias_endereco(self, data_inicio, data_fim, competencia=None, criterio_data="lancamento", repeticoes=3):
+        """Roda EXPLAIN (ANALYZE) da consulta completa com cada estratégia de _sql_join_endereco.
+
+        Retorna {estrategia: (menor tempo de planejamento, menor tempo de execução)} em ms.
+        """
+        from sqlalchemy import text
+        estrategia_atual = self.config.get('estrategia_endereco')
+        resultados = {}
+        try:
+            for estrategia in self.ESTRATEGIAS_ENDERECO:
+                self.config['estrategia_endereco'] = estrategia
+                sql, params, _ = self._montar_consulta_completa(data_inicio, data_fim, competencia, criterio_data, streaming=True)
+                tempos = []
+                for _ in range(repeticoes):
+                    plano = self.conn.execute(text("EXPLAIN (ANALYZE, FORMAT JSON) " + sql), params).scalar()
+                    if isinstance(plano, str):
+                        plano = json.loads(plano)
+                    tempos.append((plano[0]['Planning Time'], plano[0]['Execution Time']))
+                resultados[estrategia] = (min(t[0] for t in tempos), min(t[1] for t in tempos))
+        finally:
+            self.config['estrategia_endereco'] = estrategia_atual
+        for estrategia, (planejamento, execucao) in resultados.items():
+            print(f"  {estrategia:<12} planejamento {planejamento:9.2f} ms   execução {execucao:10.2f} ms")
+        return resultados
 
-            self.mapeamentos_faltantes_log.clear()
+    def _iterar_lotes_bd(self, sql, params, tamanho_lote=None, conn=None):
+        """Executa o SQL com cursor nomeado no servidor (stream_results) e gera lotes de dicts.
 
-            try:
-                print(f"\nIniciando consulta COMPLETA (filtros SIGH) para o período de {data_inicio} a {data_fim}")
-                
-                # Validação e formatação de competência (GUI continua AAAAMM)
-                if competencia is None or len(competencia) != 6 or not competencia.isdigit():
-                    competencia_gui = datetime.datetime.now().strftime("%Y%m") # Usado para processar_registros_bpa_i_completo
-                    # print(f"Competência da GUI inválida ou ausente, usando default: {competencia_gui}")
-                else:
-                    competencia_gui = competencia
-                
-                # Formato da competência para o banco de dados (AAAA/MM) se o critério for competência
-                competencia_bd_formatada = competencia_gui[:4] + "/" + competencia_gui[4:]
+        conn: conexão a usar (padrão self.conn); a extração paralela passa uma por partição.
+        """
+        from sqlalchemy import text
+        tamanho_lote = tamanho_lote or self.config.get('tamanho_lote_consulta', 5000)
+        consulta = text(sql).execution_options(stream_results=True, yield_per=tamanho_lote)
+        conn = conn or self.conn
+        conexao_dbapi = conn.connection.dbapi_connection
+        with self._lock_conexoes:
+            self._conexoes_em_consulta.add(conexao_dbapi)
+        result = None
+        try:
+            result = conn.execute(consulta, params)
+            for particao in result.partitions():
+                yield [dict(row._mapping) for row in particao]
+        except Exception as e:
+            if self._cancelamento.is_set():
+                raise OperacaoCancelada("Consulta cancelada pelo usuário.") from e
+            raise
+        finally:
+            with self._lock_conexoes:
+                self._conexoes_em_consulta.discard(conexao_dbapi)
+            if result is not None:
+                result.close()
+
+    def _iterar_lotes_consulta(self, sql, params, tamanho_lote=None, conn=None):
+        """Como _iterar_lotes_bd, mas passando pelo cache em disco (bpa_cache_consulta) quando habilitado.
+
+        A entrada é indexada pelo SQL + parâmetros e só vale enquanto max(id_lancamento) e
+        max(data_hora_criacao) de sigh.lancamentos não mudarem: só inserts a invalidam; UPDATE/DELETE
+        (em lançamentos, pacientes, contas...) não são vistos até a validade expirar. Por isso fica
+        desligado por padrão.
+        """
+        if not self.config.get('usar_cache_consultas'):
+            yield from self._iterar_lotes_bd(sql, params, tamanho_lote, conn)
+            return
+        from bpa_cache_consulta import CacheConsultas, chave_consulta, sondar_atualizacao
+        cache = CacheConsultas(self.config.get('diretorio_cache_consultas'), self.config.get('validade_cache_consultas_horas'))
+        chave = chave_consulta(sql, params)
+        sonda = sondar_atualizacao(conn or self.conn)
+        lotes = cache.ler(chave, sonda)
+        if lotes is not None:
+            print(f"Resultado da consulta lido do cache ({chave[:12]}).")
+            yield from lotes
+            return
+        yield from cache.gravar(chave, sonda, self._iterar_lotes_bd(sql, params, tamanho_lote, conn))
 
-                from sqlalchemy import text
-                
-                data_inicio_str = data_inicio.isoformat() if isinstance(data_inicio, datetime.date) else str(data_inicio)
-                data_fim_str = data_fim.isoformat() if isinstance(data_fim, datetime.date) else str(data_fim)
-                
-                # Coluna de data para o ALIAS 'data_filtro_usada' no SELECT e para o ORDER BY
-                coluna_data_para_select_no_alias = "data" 
-                alias_tabela_para_select = "l" # Default para 'lancamento'
-                
-                # Determina a coluna de data para o SELECT e ORDER BY baseado na seleção da GUI.
-                # A cláusula WHERE principal usará a lógica de data confirmada do SIGH.
-                if criterio_data == "lancamento": 
-                    if self.conn: 
-                        # debug_datas_tabela ajuda a escolher a melhor coluna 'data_lancamento' para SELECT/ORDER BY
-                        coluna_data_para_select_no_alias = self.debug_datas_tabela(data_inicio, data_fim) or "data"
-                    else:
-                        coluna_data_para_select_no_alias = "data" 
-                    alias_tabela_para_select = "l"
-                    print(f"Coluna de data para SELECT/ORDER BY (GUI='{criterio_data}'): {alias_tabela_para_select}.{coluna_data_para_select_no_alias}")
-                elif criterio_data == "conta":
-                    coluna_data_para_select_no_alias = "dt_inicio"; alias_tabela_para_select = "c"
-                    print(f"Coluna de data para SELECT/ORDER BY (GUI='{criterio_data}'): {alias_tabela_para_select}.{coluna_data_para_select_no_alias}")
-                elif criterio_data == "atendimento": 
-                    coluna_data_para_select_no_alias = "data_atendimento"; alias_tabela_para_select = "fi"
-                    print(f"Coluna de data para SELECT/ORDER BY (GUI='{criterio_data}'): {alias_tabela_para_select}.{coluna_data_para_select_no_alias}")
-                elif criterio_data == "competencia":
-                    coluna_data_para_select_no_alias = "competencia"; alias_tabela_para_select = "c" 
-                    print(f"Campo para SELECT 'data_filtro_usada' (GUI='{criterio_data}'): {alias_tabela_para_select}.{coluna_data_para_select_no_alias}")
-
-                # _build_sql_completo monta o SELECT e os JOINs.
-                # O JOIN com sigh.categorias é incluído por _build_sql_completo,
-                # mas não será usado no WHERE principal se não for necessário para os filtros SIGH.
-                sql_base = self._build_sql_completo(coluna_data_para_select_no_alias, alias_tabela_para_select)
-
-                # --- Montando a Cláusula WHERE e Parâmetros ---
-                condicoes_where_comuns_sigh = [
-                    "c.ativo = 't'",
-                    "c.status_conta = 'A'",
-                    "c.codigo_conta IN (1, 2)", 
-                    "l.cod_cc = 2",             
-                    "l.cod_tp_ato = 56",        
-                    "l.cod_proc IS NOT NULL"
-                    # Adicione aqui filtros de fi.tipo_atend ou fi.cod_situacao_atendimento
-                    # SE eles faziam parte da sua query que deu 6766/4516 DISTINCT id_lancamento.
-                    # Ex:
-                    # "fi.tipo_atend = 'AMB'", 
-                    # "fi.cod_situacao_atendimento = 4" 
-                ]
-                
-                params = {}
-                if criterio_data == "competencia":
-                    condicoes_especificas = ["c.competencia = :competencia_param"] + condicoes_where_comuns_sigh
-                    where_clause_final = "WHERE " + " AND ".join(condicoes_especificas)
-                    params = {"competencia_param": competencia_bd_formatada, 
-                            "data_inicio": data_inicio_str, 
-                            "data_fim": data_fim_str}
-                    print(f"Usando critério GUI: COMPETÊNCIA DA CONTA ({competencia_bd_formatada}) com filtros SIGH.")
-                else: 
-                    # Para critérios de data da GUI (lancamento, conta, atendimento)
-                    # Usamos a condição de data que você validou.
-                    condicao_data_validada_sigh = f"((l.data_hora_criacao::date BETWEEN :data_inicio AND :data_fim) OR (l.data BETWEEN :data_inicio AND :data_fim))"
-                    
-                    condicoes_com_data_validada = [condicao_data_validada_sigh] + condicoes_where_comuns_sigh
-                    where_clause_final = "WHERE " + " AND ".join(condicoes_com_data_validada)
-                    params = {"data_inicio": data_inicio_str, "data_fim": data_fim_str}
-                    print(f"Usando critério GUI: {criterio_data} com filtros SIGH validados (incluindo data SIGH).")
-                
-                # Ordenação
-                order_by_data_field_para_ordenacao = "c.dt_inicio" # Default para competência
-                if criterio_data != "competencia":
-                    order_by_data_field_para_ordenacao = f"{alias_tabela_para_select}.{coluna_data_para_select_no_alias}"
+    def _iterar_lotes_particionados(self, data_inicio, data_fim, competencia, criterio_data, particoes, tamanho_lote=None):
+        """Extrai as partições id_lancamento % n em paralelo (uma conexão do pool por thread) e gera lotes
+        já intercalados pela chave de _chave_ordenacao_bd (k-way merge), na mesma ordem da consulta única.
 
-                order_by_clause = f"ORDER BY pr.cns, {order_by_data_field_para_ordenacao}, l.cod_proc, l.id_lancamento, p.id_paciente"
-                
-                full_sql_query_str = sql_base + "\n" + where_clause_final + "\n" + order_by_clause
-                
-                print(f"SQL Final para buscar dados base:\n{full_sql_query_str}")
-                print(f"Parâmetros: {params}")
+        Cada partição chega ordenada pelo ORDER_BY_STREAMING; as threads entregam lotes por filas limitadas,
+        então a memória fica em poucos lotes por partição.
+        """
+        import concurrent.futures
+        tamanho_lote = tamanho_lote or self.config.get('tamanho_lote_consulta', 5000)
+        consultas = [self._montar_consulta_completa(data_inicio, data_fim, competencia, criterio_data,
+                                                    streaming=True, particao=(i, particoes))[:2]
+                     for i in range(particoes)]
+        fim_particao = object()
+        parar = threading.Event()
+        filas = [queue.Queue(maxsize=2) for _ in consultas]
+
+        def colocar(fila, item):
+            while not parar.is_set():
+                try:
+                    fila.put(item, timeout=0.5)
+                    return True
+                except queue.Full:
+                    continue
+            return False
 
-                result = self.conn.execute(text(full_sql_query_str), params)
-                registros_do_banco = [dict(row._mapping) for row in result.fetchall()]
-                
-                num_brutos = len(registros_do_banco)
-                print(f"Encontrados {num_brutos} registros brutos na consulta SQL principal.")
-                if hasattr(self, 'gui_log_callback') and callable(self.gui_log_callback):
-                    self.gui_log_callback(f"Consulta SQL retornou {num_brutos} linhas brutas.")
-
-                if registros_do_banco:
-                    registros_processados = self.processar_registros_bpa_i_completo(registros_do_banco, competencia_gui)
-                    
-                    if self.mapeamentos_faltantes_log:
-                        self._escrever_log_mapeamentos_faltantes()
-                    
-                    return registros_processados
-                else: 
-                    msg_nenhum_registro = "Nenhum registro encontrado no banco de dados para os critérios SIGH aplicados."
-                    print(msg_nenhum_registro)
-                    if hasattr(self, 'gui_log_callback') and callable(self.gui_log_callback):
-                        self.gui_log_callback(msg_nenhum_registro)
-                    return []
-                        
+        def extrair(sql, params, fila):
+            try:
+                with self.engine.connect() as conn:
+                    for lote in self._iterar_lotes_consulta(sql, params, tamanho_lote, conn):
+                        if not colocar(fila, lote):
+                            return
+                colocar(fila, fim_particao)
+            except Exception as e:
+                colocar(fila, e)
+
+        def registros_da_particao(fila):
+            while True:
+                item = fila.get()
+                if item is fim_particao:
+                    return
+                if isinstance(item, Exception):
+                    raise item
+                yield from item
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=particoes) as pool:
+            try:
+                for (sql, params), fila in zip(consultas, filas):
+                    pool.submit(extrair, sql, params, fila)
+                lote = []
+                for registro in heapq.merge(*[registros_da_particao(f) for f in filas], key=self._chave_ordenacao_bd):
+                    lote.append(registro)
+                    if len(lote) >= tamanho_lote:
+                        yield lote
+                        lote = []
+                if lote:
+                    yield lote
+            finally:
+                parar.set()
+
+    def limpar_cache_consultas(self):
+        """Apaga o cache em disco dos resultados de consulta. Retorna quantas entradas foram removidas."""
+        from bpa_cache_consulta import CacheConsultas
+        return CacheConsultas(self.config.get('diretorio_cache_consultas')).limpar()
+
+    @_com_conexao
+    def consultar_dados_completo(self, data_inicio, data_fim, competencia=None, criterio_data="lancamento", streaming=False, formatar_no_sql=False,
+                                 metodo_dedup=None):
+        """Consulta completa aplicando os filtros SIGH validados.
+
+        Com streaming=True as linhas são lidas em lotes por cursor no servidor e processadas
+        lote a lote, sem manter a lista bruta do banco em memória; a lista de registros processados
+        devolvida continua inteira em memória. Do banco ao arquivo sem materializar os registros,
+        use iterar_dados_completo ou exportar_txt_streaming.
+        Com formatar_no_sql=True o PostgreSQL devolve os campos BPA-I já formatados.
+        metodo_dedup: devolve os registros já deduplicados por esse método; com formatar_no_sql a
+        deduplicação vai na própria consulta (GROUP BY da chave), senão é a de aplicar_deduplicacao.
+        """
+        if not self.conn:
+            log_msg = "Erro: Sem conexão com o banco de dados para consulta completa."
+            print(log_msg)
+            if hasattr(self, 'gui_log_callback') and callable(self.gui_log_callback):
+                self.gui_log_callback(log_msg)
+            return []
+
+        if streaming or formatar_no_sql:
+            try:
+                if formatar_no_sql:
+                    return list(self.iterar_dados_formatados_sql(data_inicio, data_fim, competencia, criterio_data,
+                                                                 metodo_dedup=metodo_dedup))
+                registros = list(self.iterar_dados_completo(data_inicio, data_fim, competencia, criterio_data))
+                return self.aplicar_deduplicacao(registros, metodo_dedup) if metodo_dedup else registros
+            except OperacaoCancelada:
+                raise
             except Exception as e:
-                error_message = f"Erro na consulta SQL COMPLETA ou processamento: {str(e)}"
+                error_message = f"Erro na consulta SQL COMPLETA (streaming) ou processamento: {str(e)}"
                 print(error_message)
                 if hasattr(self, 'gui_log_callback') and callable(self.gui_log_callback):
                     self.gui_log_callback(error_message)
                 import traceback
                 traceback.print_exc()
                 return []
-                
+
+        self.mapeamentos_faltantes_log.clear()
+
+        try:
+            print(f"\nIniciando consulta COMPLETA (filtros SIGH) para o período de {data_inicio} a {data_fim}")
+
+            full_sql_query_str, params, competencia_gui = self._montar_consulta_completa(
+                data_inicio, data_fim, competencia, criterio_data
+            )
+
+            print(f"SQL Final para buscar dados base:\n{full_sql_query_str}")
+            print(f"Parâmetros: {params}")
+
+            registros_do_banco = []
+            for lote in self._iterar_lotes_consulta(full_sql_query_str, params):
+                registros_do_banco.extend(lote)
+                self._informar_progresso('buscados', len(registros_do_banco))
+
+            num_brutos = len(registros_do_banco)
+            print(f"Encontrados {num_brutos} registros brutos na consulta SQL principal.")
+            if hasattr(self, 'gui_log_callback') and callable(self.gui_log_callback):
+                self.gui_log_callback(f"Consulta SQL retornou {num_brutos} linhas brutas.")
+
+            if registros_do_banco:
+                registros_processados = self.processar_registros_bpa_i_completo(registros_do_banco, competencia_gui)
+
+                if self.mapeamentos_faltantes_log:
+                    self._escrever_log_mapeamentos_faltantes()
+
+                if metodo_dedup:
+                    return self.aplicar_deduplicacao(registros_processados, metodo_dedup)
+                return registros_processados
+            else:
+                msg_nenhum_registro = "Nenhum registro encontrado no banco de dados para os critérios SIGH aplicados."
+                print(msg_nenhum_registro)
+                if hasattr(self, 'gui_log_callback') and callable(self.gui_log_callback):
+                    self.gui_log_callback(msg_nenhum_registro)
+                return []
+
+        except OperacaoCancelada:
+            raise
+        except Exception as e:
+            error_message = f"Erro na consulta SQL COMPLETA ou processamento: {str(e)}"
+            print(error_message)
+            if hasattr(self, 'gui_log_callback') and callable(self.gui_log_callback):
+                self.gui_log_callback(error_message)
+            import traceback
+            traceback.print_exc()
+            return []
+
+    @_com_conexao
+    def iterar_dados_completo(self, data_inicio, data_fim, competencia=None, criterio_data="lancamento", tamanho_lote=None):
+        """Gera registros BPA-I (sem folha/seq) a partir de um cursor no servidor, lote a lote.
+
+        A ordem vem do ORDER BY do banco (ORDER_BY_STREAMING), equivalente à ordenação feita
+        em processar_registros_bpa_i_completo, então a numeração posterior não muda.
+        """
+        if not self.conn:
+            raise RuntimeError("Sem conexão com o banco de dados para consulta completa.")
+
+        self.mapeamentos_faltantes_log.clear()
+        print(f"\nIniciando consulta COMPLETA em streaming (filtros SIGH) para o período de {data_inicio} a {data_fim}")
+
+        full_sql_query_str, params, competencia_gui = self._montar_consulta_completa(
+            data_inicio, data_fim, competencia, criterio_data, streaming=True
+        )
+        print(f"SQL Final para buscar dados base (streaming):\n{full_sql_query_str}")
+        print(f"Parâmetros: {params}")
+
+        particoes = int(self.config.get('particoes_extracao') or 1)
+        if particoes > 1:
+            print(f"Extração paralela em {particoes} partições de id_lancamento.")
+            lotes_bd = self._iterar_lotes_particionados(data_inicio, data_fim, competencia, criterio_data, particoes, tamanho_lote)
+        else:
+            lotes_bd = self._iterar_lotes_consulta(full_sql_query_str, params, tamanho_lote)
+
+        contador = {'brutos': 0}
+        def lotes_contados():
+            for lote in lotes_bd:
+                contador['brutos'] += len(lote)
+                self._informar_progresso('buscados', contador['brutos'])
+                yield lote
+
+        yield from self.iterar_registros_bpa_i(lotes_contados(), competencia_gui)
+
+        num_brutos = contador['brutos']
+        print(f"Encontrados {num_brutos} registros brutos na consulta SQL principal (streaming).")
+        if hasattr(self, 'gui_log_callback') and callable(self.gui_log_callback):
+            self.gui_log_callback(f"Consulta SQL retornou {num_brutos} linhas brutas.")
+        if self.mapeamentos_faltantes_log:
+            self._escrever_log_mapeamentos_faltantes()
+
+    @_com_conexao
+    def iterar_dados_formatados_sql(self, data_inicio, data_fim, competencia=None, criterio_data="lancamento", tamanho_lote=None,
+                                    metodo_dedup=None):
+        """Gera registros BPA-I (sem folha/seq) com os campos formatados pelo próprio PostgreSQL
+        (_build_sql_bpa_i_formatado). O Python só registra os procedimentos sem mapeamento.
+
+        metodo_dedup: deduplicação feita na própria consulta (_sql_deduplicacao); os registros já chegam
+        únicos, na mesma ordem e com a mesma quantidade que iterar_deduplicacao daria.
+        """
+        if not self.conn:
+            raise RuntimeError("Sem conexão com o banco de dados para consulta completa.")
+
+        self.mapeamentos_faltantes_log.clear()
+        print(f"\nIniciando consulta COMPLETA formatada no SQL para o período de {data_inicio} a {data_fim}")
+
+        especificacao = self.especificacao_deduplicacao(metodo_dedup) if metodo_dedup else None
+        full_sql_query_str, params, competencia_gui = self._montar_consulta_completa(
+            data_inicio, data_fim, competencia, criterio_data, formatar_no_sql=True, deduplicacao=especificacao
+        )
+        if especificacao is not None:
+            print(f"Deduplicação ({metodo_dedup}) feita na consulta SQL.")
+        print(f"SQL Final (campos BPA-I formatados no banco):\n{full_sql_query_str}")
+
+        num_brutos = 0
+        for lote in self._iterar_lotes_consulta(full_sql_query_str, params, tamanho_lote):
+            num_brutos += len(lote)
+            self._informar_progresso('buscados', num_brutos)
+            for registro in lote:
+                cod_proc_bd = registro.pop('fmt_cod_proc')
+                codigo_curto = registro.pop('fmt_codigo_curto')
+                proc_mapeado = registro.pop('fmt_proc_mapeado')
+                if especificacao is None:
+                    faltantes = () if proc_mapeado else ((codigo_curto, cod_proc_bd),)
+                else:
+                    # Sem mapeamento em qualquer linha do grupo, e a quantidade somada (política SOMAR)
+                    faltantes = registro.pop('fmt_faltantes') or ()
+                    quantidade_grupo = registro.pop('fmt_qt_grupo')
+                    if quantidade_grupo is not None:
+                        registro['prd_qt'] = quantidade_grupo
+                for codigo_curto, cod_proc_bd in faltantes:
+                    if codigo_curto and str(codigo_curto) != '72':
+                        self.mapeamentos_faltantes_log.add((str(codigo_curto), str(cod_proc_bd)))
+                yield RegistroBPAI.de_dict(registro)
+
+        print(f"Encontrados {num_brutos} registros já formatados na consulta SQL principal.")
+        if hasattr(self, 'gui_log_callback') and callable(self.gui_log_callback):
+            self.gui_log_callback(f"Consulta SQL (formatada no banco) retornou {num_brutos} linhas.")
+        if self.mapeamentos_faltantes_log:
+            self._escrever_log_mapeamentos_faltantes()
+
     def debug_estrutura_tabelas(self):
         # ... (código do debug_estrutura_tabelas permanece o mesmo) ...
         return True # Adicionado para consistência
 
+    @_memorizado_por_valor
     def _obter_codigo_tipo_logradouro(self, valor_do_banco):
-        # ... (código do _obter_codigo_tipo_logradouro permanece o mesmo) ...
         if not valor_do_banco: return "000"
         val_str = str(valor_do_banco).strip()
         if val_str.isdigit() and len(val_str) <= 3: return val_str.zfill(3)
-        mapeamento = {"RUA": "001", "AVENIDA": "002", "TRAVESSA": "003", "PRACA": "004", "RODOVIA": "005"}
-        return mapeamento.get(val_str.upper(), "000").zfill(3)
+        return self.tabelas_mapeamento()['tipo_logradouro'].get(val_str.upper(), "000").zfill(3)
+
+    @_memorizado_por_valor
+    def _obter_codigo_raca(self, valor_do_banco):
+        """Código BPA-I de raça/cor ('99' = sem informação) a partir do valor do banco."""
+        return self.tabelas_mapeamento()['raca'].get(str(valor_do_banco or '').strip(), '99')
+
+    @staticmethod
+    def _chave_ordenacao_bd(r):
+        """Chave de ordenação das linhas brutas (profissional, atendimento, lançamento, paciente, id).
+
+        Os textos perdem só os espaços das pontas, como o btrim() de ORDER_BY_STREAMING (str.strip()
+        também tiraria tabulações e NBSP), para o modo streaming e a extração particionada seguirem a
+        mesma ordem, e portanto a mesma folha/sequência, da lista em memória.
+        """
+        return (
+            str(r.get('cns_med') or '').strip(' '),
+            r.get('data_atendimento') or datetime.date.min,
+            r.get('data_lancamento_original') or datetime.date.min,
+            str(r.get('nm_paciente') or '').strip(' '),
+            r.get('id_lancamento') or 0
+        )
 
     def processar_registros_bpa_i_completo(self, registros_bd, competencia=None):
         """Processa os registros COMPLETOS para o formato BPA-I, SEM atribuir folha/sequência aqui."""
@@ -405,241 +1398,304 @@ class BPAExporter:
         tabela_proc_cid = self.carregar_tabela_procedimentos_cid()
 
         # A ORDENAÇÃO aqui é crucial para o método _atribuir_folha_sequencia_final
-        registros_bd.sort(key=lambda r: (
-            str(r.get('cns_med') or '').strip(),
-            r.get('data_atendimento') or datetime.date.min, 
-            r.get('data_lancamento_original') or datetime.date.min,
-            str(r.get('nm_paciente') or '').strip(),
-            r.get('id_lancamento') or 0
-        ))
-
-        registros_bpa_i_sem_numeracao = []
+        registros_bd.sort(key=self._chave_ordenacao_bd)
+
+        processos = self._processos_construcao(len(registros_bd))
+        if processos > 1:
+            registros_bpa_i_sem_numeracao = self._construir_registros_em_processos(
+                registros_bd, competencia, mapeamento_proc, tabela_proc_cid, processos)
+        else:
+            registros_bpa_i_sem_numeracao = self._construir_registros_em_serie(
+                registros_bd, competencia, mapeamento_proc, tabela_proc_cid)
+        
+        print(f"Processados {len(registros_bpa_i_sem_numeracao)} registros BPA-I (sem folha/sequência ainda).")
+        return registros_bpa_i_sem_numeracao
 
-        for reg_data in registros_bd:
-            # --- Início do processamento de cada campo do registro ---
-            cns_med_val = str(reg_data.get('cns_med') or '').strip()
-            cns_med = cns_med_val.ljust(15) if cns_med_val else ' '.ljust(15)
+    def _construir_registros_em_serie(self, registros_bd, competencia, mapeamento_proc, tabela_proc_cid):
+        """Monta os registros BPA-I (sem folha/sequência) no processo atual, pelo motor configurado."""
+        total_bd = len(registros_bd)
+        construir_vetorizado = self._motor_vetorizado()
+        if construir_vetorizado:
+            registros = construir_vetorizado(self, registros_bd, competencia, mapeamento_proc, tabela_proc_cid)
+            self._informar_progresso('processados', total_bd, total_bd)
+            return registros
+
+        registros = []
+        for indice, reg_data in enumerate(registros_bd, 1):
+            registros.append(self._construir_registro_bpa_i(reg_data, competencia, mapeamento_proc, tabela_proc_cid))
+            if indice % 1000 == 0 or indice == total_bd:
+                self._informar_progresso('processados', indice, total_bd)
+        return registros
+
+    @staticmethod
+    def _nucleos_disponiveis():
+        """Núcleos que este processo pode usar (afinidade/cgroup quando o sistema informa; senão os da máquina)."""
+        if hasattr(os, 'sched_getaffinity'):
+            return len(os.sched_getaffinity(0))
+        return os.cpu_count() or 1
+
+    def _processos_construcao(self, total_bd):
+        """Quantos processos usar na montagem dos registros.
+
+        O pool só entra com 'processos_construcao' diferente de 1, mais de um núcleo disponível e pelo
+        menos 'min_linhas_processos' linhas; nunca usa mais processos que núcleos. Fora disso, 1 (em série).
+        """
+        processos = self.config.get('processos_construcao')
+        nucleos = self._nucleos_disponiveis()
+        if processos is None or int(processos) == 0:
+            processos = nucleos
+        processos = min(int(processos), nucleos, total_bd)
+        if processos <= 1 or total_bd < int(self.config.get('min_linhas_processos') or 0):
+            return 1
+        return processos
+
+    def _construir_registros_em_processos(self, registros_bd, competencia, mapeamento_proc, tabela_proc_cid, processos):
+        """Monta os registros em um pool de processos, em blocos contíguos das linhas já ordenadas.
+
+        As tabelas de mapeamento vão uma vez para cada processo (initializer); os blocos voltam na ordem
+        de envio e os mapeamentos faltantes de cada um são somados a self.mapeamentos_faltantes_log.
+        """
+        import concurrent.futures
+        total_bd = len(registros_bd)
+        # Alguns blocos por processo, para equilibrar a carga sem multiplicar o custo de cada envio
+        tamanho_bloco = max(1000, math.ceil(total_bd / (processos * 4)))
+        blocos = [registros_bd[i:i + tamanho_bloco] for i in range(0, total_bd, tamanho_bloco)]
+        print(f"Montando registros em {processos} processos ({len(blocos)} blocos de até {tamanho_bloco} linhas).")
+
+        registros = []
+        pool = concurrent.futures.ProcessPoolExecutor(
+            max_workers=processos, initializer=_iniciar_processo_construcao,
+            initargs=(type(self), dict(self.config), competencia, mapeamento_proc, tabela_proc_cid))
+        try:
+            futuros = [pool.submit(_construir_bloco_em_processo, bloco) for bloco in blocos]
+            for futuro in futuros:
+                campos, valores, faltantes = futuro.result()
+                registros.extend(RegistroBPAI.de_linhas(campos, valores))
+                self.mapeamentos_faltantes_log.update(faltantes)
+                self._informar_progresso('processados', len(registros), total_bd)
+        finally:
+            pool.shutdown(wait=True, cancel_futures=True)
+        return registros
 
-            tp_funcao = reg_data.get('tp_funcao')
-            cbo_val = self.obter_cbo_por_funcao(tp_funcao)
-            cbo = cbo_val.ljust(6) 
+    def iterar_registros_bpa_i(self, lotes_bd, competencia=None):
+        """Versão em streaming de processar_registros_bpa_i_completo: consome lotes já ordenados
+        pelo banco e gera um registro BPA-I (sem folha/seq) por linha."""
+        if competencia is None:
+            competencia = datetime.datetime.now().strftime("%Y%m")
 
-            nome_paciente_val = str(reg_data.get('nm_paciente') or 'PACIENTE NAO IDENTIFICADO').strip()
-            nome_paciente = nome_paciente_val.ljust(30)[:30]
-            
-            data_nasc_obj = reg_data.get('data_nasc')
-            data_nasc_str = data_nasc_obj.strftime('%Y%m%d') if data_nasc_obj else '19000101'
+        tabela_proc_cid = self.carregar_tabela_procedimentos_cid()
+        construir_vetorizado = self._motor_vetorizado()
+        mapeamento_proc = {}
+        cod_procs_consultados = set()
+        total_processados = 0
+
+        for lote in lotes_bd:
+            # Busca apenas os cod_proc ainda não vistos em lotes anteriores
+            cod_procs_novos = {reg.get('cod_proc') for reg in lote if reg.get('cod_proc')} - cod_procs_consultados
+            if cod_procs_novos:
+                cod_procs_consultados.update(cod_procs_novos)
+                mapeamento_proc.update(self.carregar_mapeamento_procedimentos(list(cod_procs_novos)))
+            if construir_vetorizado:
+                yield from construir_vetorizado(self, lote, competencia, mapeamento_proc, tabela_proc_cid)
+            else:
+                for reg_data in lote:
+                    yield self._construir_registro_bpa_i(reg_data, competencia, mapeamento_proc, tabela_proc_cid)
+            total_processados += len(lote)
+            self._informar_progresso('processados', total_processados)
+
+        print(f"Processados {total_processados} registros BPA-I em streaming (sem folha/sequência ainda).")
+
+    MOTORES_PROCESSAMENTO = ('linhas', 'vetorizado')
+
+    def _motor_vetorizado(self):
+        """bpa_vetorizado.construir_registros_vetorizado se 'motor_processamento' = 'vetorizado'; None para o motor por linha.
+        Sem NumPy instalado, avisa e segue pelo motor por linha."""
+        motor = self.config.get('motor_processamento') or 'linhas'
+        if motor not in self.MOTORES_PROCESSAMENTO:
+            raise ValueError(f"motor_processamento inválido: {motor} (use {', '.join(self.MOTORES_PROCESSAMENTO)})")
+        if motor == 'linhas':
+            return None
+        try:
+            from bpa_vetorizado import construir_registros_vetorizado
+        except ImportError as e:
+            print(f"Aviso: motor vetorizado indisponível ({str(e)}); usando o processamento por linha.")
+            return None
+        return construir_registros_vetorizado
 
-            data_atendimento_obj = reg_data.get('data_atendimento') or reg_data.get('conta_dt_inicio')
-            data_atend_str = data_atendimento_obj.strftime('%Y%m%d') if data_atendimento_obj else competencia + "01"
+    def _construir_registro_bpa_i(self, reg_data, competencia, mapeamento_proc, tabela_proc_cid):
+        """Monta o dict BPA-I (sem folha/sequência) de uma linha bruta do banco."""
+        # --- Início do processamento de cada campo do registro ---
+        cns_med_val = str(reg_data.get('cns_med') or '').strip()
+        cns_med = cns_med_val.ljust(15) if cns_med_val else ' '.ljust(15)
 
-            cnspac_val = str(reg_data.get('cnspac_paciente') or reg_data.get('cnspac_ficha') or '').strip()
-            cnspac = cnspac_val.ljust(15) if cnspac_val else ' '.ljust(15)
+        tp_funcao = reg_data.get('tp_funcao')
+        cbo_val = self.obter_cbo_por_funcao(tp_funcao)
+        cbo = cbo_val.ljust(6) 
 
-            sexo_bd = str(reg_data.get('sexo') or '').strip() 
-            sexo = 'F' if sexo_bd == '3' else 'M' 
+        nome_paciente_val = str(reg_data.get('nm_paciente') or 'PACIENTE NAO IDENTIFICADO').strip()
+        nome_paciente = nome_paciente_val.ljust(30)[:30]
+        
+        data_nasc_obj = reg_data.get('data_nasc')
+        data_nasc_str = data_nasc_obj.strftime('%Y%m%d') if data_nasc_obj else '19000101'
+
+        data_atendimento_obj = reg_data.get('data_atendimento') or reg_data.get('conta_dt_inicio')
+        data_atend_str = data_atendimento_obj.strftime('%Y%m%d') if data_atendimento_obj else competencia + "01"
+
+        cnspac_val = str(reg_data.get('cnspac_paciente') or reg_data.get('cnspac_ficha') or '').strip()
+        cnspac = cnspac_val.ljust(15) if cnspac_val else ' '.ljust(15)
+
+        sexo_bd = str(reg_data.get('sexo') or '').strip() 
+        sexo = 'F' if sexo_bd == '3' else 'M' 
+
+        cod_ibge_paciente_val = str(reg_data.get('mun_num_ibge') or self.config.get('default_ibge_paciente', '000000')).strip()
+        cod_ibge_paciente = cod_ibge_paciente_val.ljust(6)[:6]
+
+        idade = 0
+        if data_nasc_obj and data_atendimento_obj:
+            idade = data_atendimento_obj.year - data_nasc_obj.year - \
+                    ((data_atendimento_obj.month, data_atendimento_obj.day) < (data_nasc_obj.month, data_nasc_obj.day))
+        idade_str = str(min(max(idade, 0), 130)).zfill(3)
+
+        # Mapeamento de Raça/Cor CORRIGIDO e ATUALIZADO conforme sua tabela
+        raca = self._obter_codigo_raca(reg_data.get('cod_raca')) # Default '99' se não mapeado
+        raca = raca.ljust(2)
+
+
+        etnia_val = str(reg_data.get('cod_etnia_paciente') or '').strip() if raca == '05' else ''
+        etnia = etnia_val.zfill(4) if etnia_val else '    '
+
+        # Nacionalidade do paciente - FIXO em '010' (Brasileiro)
+        nacionalidade = '010'
+
+        cpf_paciente_val = str(reg_data.get('cpf_paciente') or '').replace('.', '').replace('-', '').strip()
+        cpf_paciente = cpf_paciente_val.ljust(11) if cpf_paciente_val else ' '.ljust(11)
+
+        # Campo prd_situacao_rua fixo como espaço
+        prd_situacao_rua_final = ' '
+
+        cep_val = str(reg_data.get('e_pac_cep') or '').strip().replace('.', '').replace('-', '')
+        cep = cep_val.zfill(8) if cep_val else self.config.get('default_cep_paciente', '00000000').ljust(8)
+        logradouro_tipo_origem = reg_data.get('e_pac_tp_logradouro') 
+        logradouro_tipo_cod = self._obter_codigo_tipo_logradouro(logradouro_tipo_origem)
+        endereco_nome_val = str(reg_data.get('e_pac_logradouro_nome') or '').strip()
+        endereco_nome = endereco_nome_val.ljust(30)[:30]
+        complemento_val = str(reg_data.get('e_complemento') or '').strip()
+        complemento = complemento_val.ljust(10)[:10]
+        numero_val = str(reg_data.get('e_numero') or '').strip()
+        numero = numero_val.ljust(5)[:5]
+        bairro_val = str(reg_data.get('e_pac_bairro_nome') or '').strip()
+        bairro = bairro_val.ljust(30)[:30]
+
+        telefone_val_db = str(reg_data.get('fone_cel_1') or reg_data.get('fone_res_1') or '').strip()
+        telefone_numeros = ''.join(filter(str.isdigit, telefone_val_db))
+        telefone = telefone_numeros.ljust(11)[:11] if telefone_numeros else ' '.ljust(11)
+        email_val = str(reg_data.get('email_paciente') or '').strip()
+        email = email_val.ljust(40)[:40]
+
+        # --- BLOCO DE MAPEAMENTO PARA PROCEDIMENTO E CID COM DEBUG ---
+        cod_proc_bd = reg_data.get('cod_proc')
+        id_lancamento_debug = reg_data.get('id_lancamento') 
+
+        cod_proc_sigtap = '0301010013' 
+        servico_val = '135' 
+        classificacao_val = '001' 
+        cid_sugestao_local = None
+        cid_obrigatorio_para_este_procedimento = False
+
+        # print(f"--- DEBUG Lanc. ID: {id_lancamento_debug}, cod_proc_bd: {cod_proc_bd} ---") 
+
+        if cod_proc_bd and str(cod_proc_bd).strip():
+            codigo_procedimento_mapeado = mapeamento_proc.get(str(cod_proc_bd))
+            # print(f"  > codigo_procedimento_mapeado (de mapeamento_proc): {codigo_procedimento_mapeado}") 
+
+            if not codigo_procedimento_mapeado:
+                # print(f"  ALERTA: cod_proc_bd '{cod_proc_bd}' NÃO ENCONTRADO em mapeamento_proc.")
+                pass
+
+            if codigo_procedimento_mapeado:
+                proc_info = tabela_proc_cid.get(codigo_procedimento_mapeado)
+                # print(f"  > proc_info (de tabela_proc_cid usando '{codigo_procedimento_mapeado}'): {proc_info is not None}")
+
+                if not proc_info:
+                     # print(f"  ALERTA: codigo_procedimento_mapeado '{codigo_procedimento_mapeado}' (de cod_proc_bd '{cod_proc_bd}') NÃO ENCONTRADO em tabela_proc_cid.")
+                    if codigo_procedimento_mapeado != '72': # Exemplo de exclusão do log, ajuste se necessário
+                        self.mapeamentos_faltantes_log.add(
+                            (codigo_procedimento_mapeado, str(cod_proc_bd))
+                        )
+
+                cid_obrigatorio_para_este_procedimento = False # Default
+                if proc_info:
+                    cod_proc_sigtap = proc_info['codigo_sigtap']
+                    servico_val = proc_info.get('servico', servico_val) 
+                    classificacao_val = proc_info.get('classificacao', classificacao_val)
+                    # Verifica a nova chave 'cid_obrigatorio'
+                    cid_obrigatorio_para_este_procedimento = proc_info.get('cid_obrigatorio', False) # Default para False se não definido
+                    if not (reg_data.get('lanc_cod_cid') or reg_data.get('diagnostico')):
+                        cid_sugestao_local = proc_info.get('cid_sugestao')
+        # else:
+             # print(f"  INFO: cod_proc_bd VAZIO ou NULO para Lanc. ID {id_lancamento_debug}. Usando defaults para PA.")
+        
+        cod_proc_sigtap = cod_proc_sigtap.ljust(10)
+        # print(f"  > Final para Lanc. ID {id_lancamento_debug}: prd_pa={cod_proc_sigtap}, prd_srv={servico_val.zfill(3)}, prd_clf={classificacao_val.zfill(3)}")
 
-            cod_ibge_paciente_val = str(reg_data.get('mun_num_ibge') or self.config.get('default_ibge_paciente', '000000')).strip()
-            cod_ibge_paciente = cod_ibge_paciente_val.ljust(6)[:6]
+        lanc_cod_cid_val = str(reg_data.get('lanc_cod_cid') or '').strip()
+        diagnostico_val = str(reg_data.get('diagnostico') or '').strip()
+        # print(f"  > Fontes CID para Lanc. ID {id_lancamento_debug}: lanc_cod_cid='{lanc_cod_cid_val}', diagnostico='{diagnostico_val}', cid_sugestao_local='{cid_sugestao_local}'")
+        
+        cid_final_fallback = 'Z000' # Default padrão se CID for obrigatório e não encontrado
+        if not cid_obrigatorio_para_este_procedimento:
+            cid_final_fallback = '    ' # Novo default para CID não obrigatório
 
-            idade = 0
-            if data_nasc_obj and data_atendimento_obj:
-                idade = data_atendimento_obj.year - data_nasc_obj.year - \
-                        ((data_atendimento_obj.month, data_atendimento_obj.day) < (data_nasc_obj.month, data_nasc_obj.day))
-            idade_str = str(min(max(idade, 0), 130)).zfill(3)
 
-            # Mapeamento de Raça/Cor CORRIGIDO e ATUALIZADO conforme sua tabela
-            cod_cor_bd_val = str(reg_data.get('cod_raca') or '').strip() 
-            
-            mapeamento_raca_bd_para_bpa = {
-                # Chave: "Valor Origem BD" (da sua tabela de-para)
-                # Valor: "Valor Final" (código de 2 dígitos para o BPA-I)
-                # Certifique-se que os VALORES ('01', '02', etc.) são os códigos OFICIAIS do BPA-I
-                # (01-Branca, 02-Preta, 03-Parda, 04-Amarela, 05-Indígena, 99-Sem informação)
-                '4': '01',  # BRANCA (Ex: BD valor '4' -> BPA '01')
-                '33': '02', # PRETA  (Ex: BD valor '33' -> BPA '02')
-                '22': '03', # PARDA  (Ex: BD valor '22' -> BPA '03')
-                '16': '03', # MULATO -> Parda (Ex: BD valor '16' -> BPA '03')
-                '27': '03', # PARDA (variação) -> Parda (Ex: BD valor '27' -> BPA '03')
-                '20': '03', # MISTO -> Parda (Ex: BD valor '20' -> BPA '03', ou '99' se preferir)
-                '29': '04', # AMARELA (Ex: BD valor '29' -> BPA '04')
-                '26': '04', # AMAREL -> Amarela (Ex: BD valor '26' -> BPA '04')
-                '19': '05', # INDIGENA (Ex: BD valor '19' -> BPA '05')
-                '18': '05', # INDIA -> Indígena (Ex: BD valor '18' -> BPA '05')
-                '7':  '02', # NEGRO -> Preta (Ex: BD valor '7' -> BPA '02')
-                '31': '99', # NÃO INFORMADA (Ex: BD valor '31' -> BPA '99')
-            }
-            raca = mapeamento_raca_bd_para_bpa.get(cod_cor_bd_val, '99') # Default '99' se não mapeado
-            raca = raca.ljust(2)
-
-
-            etnia_val = str(reg_data.get('cod_etnia_paciente') or '').strip() if raca == '05' else ''
-            etnia = etnia_val.zfill(4) if etnia_val else '    '
-
-            # Nacionalidade do paciente - FIXO em '010' (Brasileiro)
-            nacionalidade = '010'
-
-            cpf_paciente_val = str(reg_data.get('cpf_paciente') or '').replace('.', '').replace('-', '').strip()
-            cpf_paciente = cpf_paciente_val.ljust(11) if cpf_paciente_val else ' '.ljust(11)
-
-            # Campo prd_situacao_rua fixo como espaço
-            prd_situacao_rua_final = ' '
-
-            cep_val = str(reg_data.get('e_pac_cep') or '').strip().replace('.', '').replace('-', '')
-            cep = cep_val.zfill(8) if cep_val else self.config.get('default_cep_paciente', '00000000').ljust(8)
-            logradouro_tipo_origem = reg_data.get('e_pac_tp_logradouro') 
-            logradouro_tipo_cod = self._obter_codigo_tipo_logradouro(logradouro_tipo_origem)
-            endereco_nome_val = str(reg_data.get('e_pac_logradouro_nome') or '').strip()
-            endereco_nome = endereco_nome_val.ljust(30)[:30]
-            complemento_val = str(reg_data.get('e_complemento') or '').strip()
-            complemento = complemento_val.ljust(10)[:10]
-            numero_val = str(reg_data.get('e_numero') or '').strip()
-            numero = numero_val.ljust(5)[:5]
-            bairro_val = str(reg_data.get('e_pac_bairro_nome') or '').strip()
-            bairro = bairro_val.ljust(30)[:30]
-
-            telefone_val_db = str(reg_data.get('fone_cel_1') or reg_data.get('fone_res_1') or '').strip()
-            telefone_numeros = ''.join(filter(str.isdigit, telefone_val_db))
-            telefone = telefone_numeros.ljust(11)[:11] if telefone_numeros else ' '.ljust(11)
-            email_val = str(reg_data.get('email_paciente') or '').strip()
-            email = email_val.ljust(40)[:40]
-
-            # --- BLOCO DE MAPEAMENTO PARA PROCEDIMENTO E CID COM DEBUG ---
-            cod_proc_bd = reg_data.get('cod_proc')
-            id_lancamento_debug = reg_data.get('id_lancamento') 
-
-            cod_proc_sigtap = '0301010013' 
-            servico_val = '135' 
-            classificacao_val = '001' 
-            cid_sugestao_local = None
-
-            # print(f"--- DEBUG Lanc. ID: {id_lancamento_debug}, cod_proc_bd: {cod_proc_bd} ---") 
-
-            if cod_proc_bd and str(cod_proc_bd).strip():
-                codigo_procedimento_mapeado = mapeamento_proc.get(str(cod_proc_bd))
-                # print(f"  > codigo_procedimento_mapeado (de mapeamento_proc): {codigo_procedimento_mapeado}") 
-
-                if not codigo_procedimento_mapeado:
-                    # print(f"  ALERTA: cod_proc_bd '{cod_proc_bd}' NÃO ENCONTRADO em mapeamento_proc.")
-                    pass
-
-                if codigo_procedimento_mapeado:
-                    proc_info = tabela_proc_cid.get(codigo_procedimento_mapeado)
-                    # print(f"  > proc_info (de tabela_proc_cid usando '{codigo_procedimento_mapeado}'): {proc_info is not None}")
-
-                    if not proc_info:
-                         # print(f"  ALERTA: codigo_procedimento_mapeado '{codigo_procedimento_mapeado}' (de cod_proc_bd '{cod_proc_bd}') NÃO ENCONTRADO em tabela_proc_cid.")
-                        if codigo_procedimento_mapeado != '72': # Exemplo de exclusão do log, ajuste se necessário
-                            self.mapeamentos_faltantes_log.add(
-                                (codigo_procedimento_mapeado, str(cod_proc_bd))
-                            )
-
-                    cid_obrigatorio_para_este_procedimento = False # Default
-                    if proc_info:
-                        cod_proc_sigtap = proc_info['codigo_sigtap']
-                        servico_val = proc_info.get('servico', servico_val) 
-                        classificacao_val = proc_info.get('classificacao', classificacao_val)
-                        # Verifica a nova chave 'cid_obrigatorio'
-                        cid_obrigatorio_para_este_procedimento = proc_info.get('cid_obrigatorio', False) # Default para False se não definido
-                        if not (reg_data.get('lanc_cod_cid') or reg_data.get('diagnostico')):
-                            cid_sugestao_local = proc_info.get('cid_sugestao')
-            # else:
-                 # print(f"  INFO: cod_proc_bd VAZIO ou NULO para Lanc. ID {id_lancamento_debug}. Usando defaults para PA.")
-            
-            cod_proc_sigtap = cod_proc_sigtap.ljust(10)
-            # print(f"  > Final para Lanc. ID {id_lancamento_debug}: prd_pa={cod_proc_sigtap}, prd_srv={servico_val.zfill(3)}, prd_clf={classificacao_val.zfill(3)}")
+        cid_val_db = (lanc_cod_cid_val or diagnostico_val or cid_sugestao_local or cid_final_fallback).upper()
 
-            lanc_cod_cid_val = str(reg_data.get('lanc_cod_cid') or '').strip()
-            diagnostico_val = str(reg_data.get('diagnostico') or '').strip()
-            # print(f"  > Fontes CID para Lanc. ID {id_lancamento_debug}: lanc_cod_cid='{lanc_cod_cid_val}', diagnostico='{diagnostico_val}', cid_sugestao_local='{cid_sugestao_local}'")
-            
-            cid_final_fallback = 'Z000' # Default padrão se CID for obrigatório e não encontrado
+        # Se mesmo com fallback '0000', alguma fonte primária (BD ou sugestão) preencheu, mantenha.
+        # Apenas se todas as fontes + sugestão forem vazias E CID não é obrigatório, use '0000'.
+        if not lanc_cod_cid_val and not diagnostico_val and not (cid_sugestao_local and cid_sugestao_local.strip()):
             if not cid_obrigatorio_para_este_procedimento:
-                cid_final_fallback = '    ' # Novo default para CID não obrigatório
-
-
-            cid_val_db = (lanc_cod_cid_val or diagnostico_val or cid_sugestao_local or cid_final_fallback).upper()
-
-            # Se mesmo com fallback '0000', alguma fonte primária (BD ou sugestão) preencheu, mantenha.
-            # Apenas se todas as fontes + sugestão forem vazias E CID não é obrigatório, use '0000'.
-            if not lanc_cod_cid_val and not diagnostico_val and not (cid_sugestao_local and cid_sugestao_local.strip()):
-                if not cid_obrigatorio_para_este_procedimento:
-                    cid_val_db = '    '
-                else:
-                    cid_val_db = 'Z000' # Se obrigatório e tudo vazio, mantém Z000
-
-            cid = cid_val_db.replace('.', '').ljust(4)[:4]
-            if cid == '    ': # Se ficou apenas espaços (ex: cid_sugestao era ' ' e outras vazias)
-                cid = cid_final_fallback.ljust(4)
-
-
-            quantidade_val = 1 
-            quantidade_formatada = str(quantidade_val).zfill(6)
-
-            caracter_atendimento = '01' 
-            numero_guia_val = str(reg_data.get('conta_numero_guia') or reg_data.get('numero_guia') or '').strip()
-            prd_naut = numero_guia_val.ljust(13)[:13]
-            prd_org = 'BPA'.ljust(3)
-            prd_equipe_seq = ' '.ljust(8); prd_equipe_area = ' '.ljust(4)
-            prd_ine = (str(reg_data.get('ine_da_equipe_no_banco') or self.config.get('default_ine', '0000000000'))).ljust(10)
-            prd_cnpj_estab_val = self.config.get('cgc_cpf', '') if self.config.get('indicador_destino') == 'E' else ''
-            prd_cnpj_estab = prd_cnpj_estab_val.ljust(14) if prd_cnpj_estab_val else ' '.ljust(14)
-            
-            registro_bpa_i = {
-                'prd_ident': '03', 'prd_cnes': self.config.get('cnes', '0000000').ljust(7),
-                'prd_cmp': competencia, 'prd_cnsmed': cns_med, 'prd_cbo': cbo,
-                'prd_dtaten': data_atend_str,
-                # prd_flh e prd_seq são atribuídos em _atribuir_folha_sequencia_final
-                'prd_pa': cod_proc_sigtap, 'prd_cnspac': cnspac, 'prd_sexo': sexo,
-                'prd_ibge': cod_ibge_paciente, 'prd_cid': cid, 'prd_ldade': idade_str,
-                'prd_qt': quantidade_formatada,
-                'prd_caten': caracter_atendimento, 'prd_naut': prd_naut,
-                'prd_org': prd_org, 'prd_nmpac': nome_paciente, 'prd_dtnasc': data_nasc_str,
-                'prd_raca': raca, 'prd_etnia': etnia, 'prd_nac': nacionalidade,
-                'prd_srv': servico_val.zfill(3), 'prd_clf': classificacao_val.zfill(3),
-                'prd_equipe_Seq': prd_equipe_seq, 'prd_equipe_Area': prd_equipe_area,
-                'prd_cnpj': prd_cnpj_estab, 'prd_cep_pcnte': cep,
-                'prd_lograd_pcnte': logradouro_tipo_cod, 'prd_end_pcnte': endereco_nome,
-                'prd_compl_pcnte': complemento, 'prd_num_pcnte': numero,
-                'prd_bairro_pcnte': bairro, 'prd_ddtel_pcnte': telefone,
-                'prd_email_pcnte': email, 'prd_ine': prd_ine,
-                'prd_cpf_pcnte': cpf_paciente,
-                'prd_cid': cid,
-                'prd_situacao_rua': prd_situacao_rua_final, # Linha corrigida
-                '_id_lancamento_original': reg_data.get('id_lancamento') # Novo campo para deduplicação por ID original
-
-            }
-            registros_bpa_i_sem_numeracao.append(registro_bpa_i)
-        
-        print(f"Processados {len(registros_bpa_i_sem_numeracao)} registros BPA-I (sem folha/sequência ainda).")
-        return registros_bpa_i_sem_numeracao
+                cid_val_db = '    '
+            else:
+                cid_val_db = 'Z000' # Se obrigatório e tudo vazio, mantém Z000
 
+        cid = cid_val_db.replace('.', '').ljust(4)[:4]
+        if cid == '    ': # Se ficou apenas espaços (ex: cid_sugestao era ' ' e outras vazias)
+            cid = cid_final_fallback.ljust(4)
 
-    def deduplicate_por_id_lancamento_original(self, registros_bpa_processados):
-        """
-        Deduplica mantendo apenas o primeiro registro encontrado para cada '_id_lancamento_original' único.
-        Assume que prd_qt já é '000001'.
-        """
-        print(f"\nIniciando deduplicação por ID de Lançamento Original de {len(registros_bpa_processados)} registros...")
-        if not registros_bpa_processados:
-            return []
 
-        ids_lancamento_vistos = set()
-        registros_finais = []
+        quantidade_val = 1 # Inteiro até a gravação (formatar_quantidade)
 
-        for registro in registros_bpa_processados:
-            id_original = registro.get('_id_lancamento_original')
-            if id_original is not None and id_original not in ids_lancamento_vistos:
-                ids_lancamento_vistos.add(id_original)
-                registros_finais.append(registro.copy()) # Adiciona uma cópia
-            # else: Se id_original é None ou já foi visto, descarta.
-        
-        print(f"Deduplicação por ID de Lançamento Original concluída:")
-        print(f"  - Registros originais processados: {len(registros_bpa_processados)}")
-        print(f"  - Registros únicos finais (por id_lancamento): {len(registros_finais)}")
+        caracter_atendimento = '01' 
+        numero_guia_val = str(reg_data.get('conta_numero_guia') or reg_data.get('numero_guia') or '').strip()
+        prd_naut = numero_guia_val.ljust(13)[:13]
+        prd_org = 'BPA'.ljust(3)
+        prd_equipe_seq = ' '.ljust(8); prd_equipe_area = ' '.ljust(4)
+        prd_ine = (str(reg_data.get('ine_da_equipe_no_banco') or self.config.get('default_ine', '0000000000'))).ljust(10)
+        prd_cnpj_estab_val = self.config.get('cgc_cpf', '') if self.config.get('indicador_destino') == 'E' else ''
+        prd_cnpj_estab = prd_cnpj_estab_val.ljust(14) if prd_cnpj_estab_val else ' '.ljust(14)
         
-        return registros_finais
-
+        registro_bpa_i = RegistroBPAI(
+            prd_ident='03', prd_cnes=self.config.get('cnes', '0000000').ljust(7),
+            prd_cmp=competencia, prd_cnsmed=cns_med, prd_cbo=cbo,
+            prd_dtaten=data_atend_str,
+            # prd_flh e prd_seq são atribuídos em _atribuir_folha_sequencia_final
+            prd_pa=cod_proc_sigtap, prd_cnspac=cnspac, prd_sexo=sexo,
+            prd_ibge=cod_ibge_paciente, prd_cid=cid, prd_ldade=idade_str,
+            prd_qt=quantidade_val,
+            prd_caten=caracter_atendimento, prd_naut=prd_naut,
+            prd_org=prd_org, prd_nmpac=nome_paciente, prd_dtnasc=data_nasc_str,
+            prd_raca=raca, prd_etnia=etnia, prd_nac=nacionalidade,
+            prd_srv=servico_val.zfill(3), prd_clf=classificacao_val.zfill(3),
+            prd_equipe_Seq=prd_equipe_seq, prd_equipe_Area=prd_equipe_area,
+            prd_cnpj=prd_cnpj_estab, prd_cep_pcnte=cep,
+            prd_lograd_pcnte=logradouro_tipo_cod, prd_end_pcnte=endereco_nome,
+            prd_compl_pcnte=complemento, prd_num_pcnte=numero,
+            prd_bairro_pcnte=bairro, prd_ddtel_pcnte=telefone,
+            prd_email_pcnte=email, prd_ine=prd_ine,
+            prd_cpf_pcnte=cpf_paciente,
+            prd_situacao_rua=prd_situacao_rua_final, # Linha corrigida
+            _id_lancamento_original=reg_data.get('id_lancamento') # Novo campo para deduplicação por ID original
+        )
+        return registro_bpa_i
 
     def _escrever_log_mapeamentos_faltantes(self):
         """Escreve os códigos curtos de procedimentos não encontrados em tabela_proc_cid para um arquivo de log."""
@@ -653,7 +1709,7 @@ class BPAExporter:
                 f.write(f"Relatório de Mapeamentos de Procedimentos Faltantes em tabela_proc_cid (gerado em: {datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')})\n")
                 f.write("==================================================================================================================\n")
                 f.write("Os seguintes 'Códigos Curtos' (vindos de sigh.procedimentos.codigo_procedimento) precisam ser adicionados\n")
-                f.write("à função 'carregar_tabela_procedimentos_cid' no arquivo bpa_exporter.py com seus respectivos códigos SIGTAP.\n")
+                f.write("à tabela de procedimentos (procedimentos_bpa.csv ou a configurada em 'arquivo_procedimentos') com seus respectivos códigos SIGTAP.\n")
                 f.write("O 'ID Original do BD' refere-se ao 'cod_proc' da tabela sigh.lancamentos (que é o 'id_procedimento' em sigh.procedimentos).\n\n")
                 
                 # Ordenar para facilitar a visualização
@@ -665,7 +1721,7 @@ class BPAExporter:
             print(f"Log de mapeamentos de procedimentos faltantes foi salvo em: {nome_arquivo_log}")
             # Informar o usuário via GUI também
             if hasattr(self, 'gui_log_callback') and callable(self.gui_log_callback): # Se houver um callback para logar na GUI
-                 self.gui_log_callback(f"AVISO: Log de mapeamentos de procedimentos faltantes foi salvo em '{nome_arquivo_log}'. Verifique este arquivo para completar os mapeamentos em 'carregar_tabela_procedimentos_cid'.")
+                 self.gui_log_callback(f"AVISO: Log de mapeamentos de procedimentos faltantes foi salvo em '{nome_arquivo_log}'. Verifique este arquivo para completar os mapeamentos na tabela de procedimentos (procedimentos_bpa.csv).")
 
         except Exception as e:
             print(f"Erro ao escrever log de mapeamentos faltantes: {str(e)}")
@@ -681,194 +1737,304 @@ class BPAExporter:
         if not lista_registros_processados:
             return []
 
-        # A ordenação já deve ter sido feita em processar_registros_bpa_i_completo.
-        # Se a deduplicação puder alterar a ordem, re-ordenar aqui:
-        # lista_registros_processados.sort(key=lambda r: (
-        #     str(r.get('prd_cnsmed') or '').strip(), 
-        #     r.get('prd_dtaten') or '',              
-        #     str(r.get('prd_nmpac') or '').strip()   
-        # ))
-
-        cns_profissional_grupo_atual = None
-        folha_para_profissional_atual = 0 
-        sequencia_na_folha_atual = 0
-        
-        registros_numerados = []
+        # A ordenação já vem de processar_registros_bpa_i_completo (ou do ORDER BY do banco); se a
+        # deduplicação ou quem chamou deixou algum profissional espalhado, re-ordena de forma estável.
+        if not agrupado_por_profissional(lista_registros_processados):
+            print("Registros fora de ordem por profissional: re-ordenando antes da numeração.")
+            lista_registros_processados = sorted(lista_registros_processados, key=profissional)
 
-        for registro in lista_registros_processados:
-            cns_profissional_registro_corrente = registro.get('prd_cnsmed', ' ').strip()
-
-            if cns_profissional_registro_corrente != cns_profissional_grupo_atual:
-                cns_profissional_grupo_atual = cns_profissional_registro_corrente
-                folha_para_profissional_atual = 1
-                sequencia_na_folha_atual = 1
-            else:
-                sequencia_na_folha_atual += 1
-                if sequencia_na_folha_atual > 99: # Limite de 99 por folha
-                    folha_para_profissional_atual += 1
-                    sequencia_na_folha_atual = 1
-            
-            registro_copia = registro.copy() 
-            registro_copia['prd_flh'] = str(folha_para_profissional_atual).zfill(3)
-            registro_copia['prd_seq'] = str(sequencia_na_folha_atual).zfill(2)
-            registros_numerados.append(registro_copia)
-            
+        # Só prd_flh/prd_seq mudam: são gravados no próprio registro, sem cópia
+        registros_numerados = list(numerar(lista_registros_processados))
         print(f"Atribuição final de folha/sequência para {len(registros_numerados)} registros concluída.")
         return registros_numerados
+
+    def iterar_folha_sequencia(self, registros, ordenados=True):
+        """Versão em streaming de _atribuir_folha_sequencia_final: grava prd_flh/prd_seq no próprio
+        registro (sem cópia) e o repassa adiante.
+
+        ordenados=True: os registros já chegam agrupados por profissional (ORDER BY do banco; a
+        deduplicação só descarta registros, sem reordenar). Com False passam antes pela ordenação
+        por profissional (externa acima de 'limite_ordenacao_memoria' registros).
+        """
+        if not ordenados:
+            registros = ordenar_por_profissional(registros, int(self.config.get('limite_ordenacao_memoria') or 0),
+                                                 self.config.get('diretorio_temporario'))
+        return numerar(registros)
+
+    # Opções de self.config que entram no conteúdo dos registros (fazem parte da assinatura do estado incremental)
+    CONFIG_REGISTRO = ('cnes', 'cgc_cpf', 'indicador_destino', 'default_ibge_paciente', 'default_cep_paciente', 'default_ine')
+
+    @_com_conexao
+    def consultar_dados_incremental(self, data_inicio, data_fim, competencia=None, criterio_data="lancamento",
+                                    metodo_dedup="completo", reiniciar=False):
+        """Registros finais (deduplicados e numerados) do período, montando só os lançamentos novos ou
+        alterados desde a execução anterior do mesmo escopo (estado em bpa_incremental).
+
+        O marcador de alteração é a assinatura de cada linha da consulta completa (md5 do texto da linha
+        mais o código do procedimento): muda com qualquer edição do lançamento (cod_proc, quantidade,
+        data, CID), da conta (status, competência), da ficha, do paciente (CNS, endereço, raça...), do
+        profissional ou do município. Custo: a consulta de assinaturas percorre no servidor as mesmas
+        linhas e junções do período que a extração completa (com o mesmo filtro de ids sargável), mas só
+        (id_lancamento, md5) são transferidos; as linhas completas são buscadas apenas para os ids novos
+        ou com assinatura diferente, e os ids que sumiram (conta inativada, etc.) saem do estado.
+        Sem estado válido (primeira execução, reiniciar=True ou de-paras/procedimentos/opções do registro
+        diferentes) a extração é completa. Só os profissionais cuja lista final mudou são renumerados.
+        """
+        import bpa_incremental
+        if not self.conn:
+            raise RuntimeError("Sem conexão com o banco de dados para consulta incremental.")
+        if competencia is None or len(competencia) != 6 or not competencia.isdigit():
+            competencia = datetime.datetime.now().strftime("%Y%m")
+
+        escopo = json.dumps([competencia, criterio_data, str(data_inicio), str(data_fim), self.config.get('cnes')])
+        assinatura = bpa_incremental.assinatura({chave: self.config.get(chave) for chave in self.CONFIG_REGISTRO},
+                                                self.tabelas_mapeamento(), self.carregar_tabela_procedimentos_cid())
+        estado = bpa_incremental.EstadoIncremental(escopo, assinatura, self.config.get('diretorio_incremental'))
+        try:
+            if reiniciar:
+                estado.descartar()
+            self.mapeamentos_faltantes_log.clear()
+            anteriores = estado.assinaturas_linhas()
+
+            sql_assinaturas, params_assinaturas, competencia = self._montar_consulta_completa(
+                data_inicio, data_fim, competencia, criterio_data, assinaturas=True)
+            atuais = {}
+            for lote in self._iterar_lotes_bd(sql_assinaturas, params_assinaturas):
+                atuais.update((linha['id_lancamento'], linha['assinatura']) for linha in lote)
+            alterados = {id_lancamento for id_lancamento, valor in atuais.items() if anteriores.get(id_lancamento) != valor}
+            removidos = anteriores.keys() - atuais.keys()
+
+            if not estado.valido:
+                print(f"\nExportação incremental: extração completa do período {data_inicio} a {data_fim}.")
+                filtro = None
+            else:
+                print(f"\nExportação incremental: {len(alterados)} de {len(atuais)} lançamentos novos ou alterados.")
+                filtro = bpa_incremental.filtro_alterados(alterados)
+
+            linhas_bd = []
+            if alterados:
+                sql, params, competencia = self._montar_consulta_completa(
+                    data_inicio, data_fim, competencia, criterio_data, filtro_extra=filtro)
+                for lote in self._iterar_lotes_bd(sql, params):
+                    linhas_bd.extend(lote)
+                    self._informar_progresso('buscados', len(linhas_bd))
+            # Mesma ordem de processar_registros_bpa_i_completo; a chave fica guardada com cada linha
+            linhas_bd.sort(key=self._chave_ordenacao_bd)
+            chaves = [self._chave_ordenacao_bd(linha) for linha in linhas_bd]
+            novos = self.processar_registros_bpa_i_completo(linhas_bd, competencia)
+
+            estado.remover(removidos | alterados)
+            estado.adicionar(chaves, novos)
+            print(f"Exportação incremental: {len(novos)} linhas novas ou atualizadas, {len(removidos)} lançamentos removidos.")
+            if self.mapeamentos_faltantes_log:
+                self._escrever_log_mapeamentos_faltantes()
+
+            # Alterado entre as duas consultas e fora dos filtros na segunda: sem assinatura, volta na próxima
+            buscados = {linha.get('id_lancamento') for linha in linhas_bd}
+            for id_lancamento in alterados - buscados:
+                del atuais[id_lancamento]
+
+            todas = estado.linhas()
+            todas.sort(key=operator.itemgetter(0))
+            registros = self.aplicar_deduplicacao([registro for _, registro in todas], metodo_dedup)
+            registros = self._numerar_incremental(registros, estado.numeracao_anterior())
+            estado.gravar(atuais, registros)
+            return registros
+        finally:
+            estado.fechar()
+
+    def _numerar_incremental(self, registros, numeracao_anterior):
+        """Numera folha/sequência por profissional, reaproveitando prd_flh/prd_seq da exportação anterior
+        quando a lista final do profissional (lançamentos e quantidades, em ordem) não mudou."""
+        if not agrupado_por_profissional(registros):
+            registros = sorted(registros, key=profissional)
+        total, renumerados = 0, 0
+        for cns, grupo in itertools.groupby(registros, key=profissional):
+            grupo = list(grupo)
+            anterior = numeracao_anterior.get(cns)
+            total += 1
+            if anterior is not None and [(r['_id_lancamento_original'], r['prd_qt']) for r in grupo] == [(i, qt) for i, qt, _, _ in anterior]:
+                for registro, (_, _, folha, sequencia) in zip(grupo, anterior):
+                    registro['prd_flh'] = folha
+                    registro['prd_seq'] = sequencia
+            else:
+                collections.deque(numerar(grupo), maxlen=0)
+                renumerados += 1
+        print(f"Numeração incremental: {renumerados} de {total} profissionais renumerados.")
+        return registros
+
+    @_com_conexao
+    def exportar_txt_streaming(self, data_inicio, data_fim, competencia, caminho_arquivo_base,
+                               criterio_data="lancamento", metodo_dedup="completo", tamanho_lote=None,
+                               formatar_no_sql=False, deduplicar_no_sql=False):
+        """Pipeline completo em streaming: cursor no servidor -> registros BPA-I -> deduplicação ->
+        folha/sequência -> arquivo TXT. Nenhuma etapa materializa a lista inteira de linhas
+        (a deduplicação com soma de quantidade guarda apenas os registros únicos).
+        Com formatar_no_sql e deduplicar_no_sql a deduplicação é feita pelo PostgreSQL e só as linhas
+        finais são transferidas. Retorna o número de linhas gravadas, ou None em caso de erro.
+        """
+        if not self.conn:
+            print("Erro: Sem conexão com o banco de dados para exportação em streaming.")
+            return None
+        if competencia is None or len(competencia) != 6 or not competencia.isdigit():
+            competencia = datetime.datetime.now().strftime("%Y%m")
+
+        if formatar_no_sql and deduplicar_no_sql:
+            registros = self.iterar_dados_formatados_sql(data_inicio, data_fim, competencia, criterio_data, tamanho_lote,
+                                                         metodo_dedup=metodo_dedup)
+        else:
+            if formatar_no_sql:
+                registros = self.iterar_dados_formatados_sql(data_inicio, data_fim, competencia, criterio_data, tamanho_lote)
+            else:
+                registros = self.iterar_dados_completo(data_inicio, data_fim, competencia, criterio_data, tamanho_lote)
+            registros = self.iterar_deduplicacao(registros, metodo_dedup)
+        # Ordem do ORDER BY do banco; a deduplicação (no SQL ou em Python) só descarta registros
+        registros = self.iterar_folha_sequencia(registros, ordenados=True)
+        return self.gerar_arquivo_txt_streaming(competencia, registros, caminho_arquivo_base)
         
     def consultar_dados_alternativo(self, data_inicio, data_fim, competencia=None):
         # ... (código do consultar_dados_alternativo permanece o mesmo) ...
         return None, [] # Adicionado para consistência
 
+    @_com_conexao
     def carregar_mapeamento_procedimentos(self, cod_procs_bd_unicos):
-        # ... (código do carregar_mapeamento_procedimentos permanece o mesmo) ...
-        # Sua versão mais recente desta função está correta.
+        """Mapeia id_procedimento (sigh.procedimentos) -> codigo_procedimento.
+
+        Os códigos ficam num cache LRU/TTL no exportador (reaproveitado entre execuções da GUI);
+        só os ids ainda não vistos, ou expirados, são buscados no banco, em blocos de ANY(array).
+        """
         mapeamento_proc = {}
         if not self.conn or not cod_procs_bd_unicos: return mapeamento_proc
         try:
-            from sqlalchemy import table, column, select
-            procedimentos_table = table("procedimentos", column("id_procedimento"), column("codigo_procedimento"), schema="sigh")
-            cod_procs_list = [str(c) for c in cod_procs_bd_unicos]
-            query = select(procedimentos_table.c.id_procedimento, procedimentos_table.c.codigo_procedimento).where(procedimentos_table.c.id_procedimento.in_(cod_procs_list))
-            result = self.conn.execute(query)
-            for row in result: mapeamento_proc[str(row.id_procedimento)] = str(row.codigo_procedimento) 
-            print(f"Mapeamento de {len(mapeamento_proc)} procedimentos carregado (de {len(cod_procs_bd_unicos)} únicos).")
+            from bpa_procedimentos import buscar_codigos_procedimentos
+            cache = self._obter_cache_codigos_procedimento()
+            cod_procs_list = list(dict.fromkeys(str(c) for c in cod_procs_bd_unicos))
+            mapeamento_proc, faltantes = cache.consultar(cod_procs_list)
+            if faltantes:
+                buscados = buscar_codigos_procedimentos(self.conn, faltantes, self.config.get('tamanho_bloco_ids_procedimento', 1000))
+                cache.guardar(faltantes, buscados)
+                mapeamento_proc.update(buscados)
+            print(f"Mapeamento de {len(mapeamento_proc)} procedimentos carregado (de {len(cod_procs_list)} únicos; {len(faltantes)} buscados no banco).")
         except Exception as e: print(f"Erro ao carregar mapeamento de procedimentos: {str(e)}")
         return mapeamento_proc
-        
+
+    def _obter_cache_codigos_procedimento(self):
+        if self._cache_codigos_procedimento is None:
+            from bpa_procedimentos import CacheCodigosProcedimento
+            self._cache_codigos_procedimento = CacheCodigosProcedimento(
+                self.config.get('cache_procedimentos_max_itens', 50000), self.config.get('cache_procedimentos_ttl_segundos', 3600))
+        return self._cache_codigos_procedimento
+
+    def invalidar_cache_procedimentos(self, ids=None):
+        """Descarta o cache id -> código (todo, ou só os ids informados), p.ex. após alterar sigh.procedimentos."""
+        if self._cache_codigos_procedimento is not None:
+            self._cache_codigos_procedimento.invalidar(ids)
+
+    @_com_conexao
     def carregar_tabela_procedimentos_cid(self):
-        """Carrega a tabela de procedimentos (código curto) e seus respectivos SIGTAP, Serviço, Classificação e CID sugerido."""
-        tabela = {} 
-        tabela['105'] = {'codigo_sigtap': '0301070105', 'servico': '135', 'classificacao': '003', 'cid_sugestao': 'M638', 'cid_obrigatorio': True}
-        tabela['121'] = {'codigo_sigtap': '0301070121', 'servico': '135', 'classificacao': '003', 'cid_sugestao': 'M638', 'cid_obrigatorio': True}
-        tabela['237'] = {'codigo_sigtap': '0301070237', 'servico': '135', 'classificacao': '003', 'cid_sugestao': '', 'cid_obrigatorio': False}
-        tabela['63'] = {'codigo_sigtap': '0301100063', 'servico': '135', 'classificacao': '003', 'cid_sugestao': '', 'cid_obrigatorio': False}
-        tabela['210'] = {'codigo_sigtap': '0301070210', 'servico': '135', 'classificacao': '003', 'cid_sugestao': '', 'cid_obrigatorio': False}
-        tabela['229'] = {'codigo_sigtap': '0301070229', 'servico': '135', 'classificacao': '003', 'cid_sugestao': '', 'cid_obrigatorio': False}
-        tabela['19'] = {'codigo_sigtap': '0302050019', 'servico': '135', 'classificacao': '003', 'cid_sugestao': 'M968', 'cid_obrigatorio': True}
-        tabela['27'] = {'codigo_sigtap': '0302050027', 'servico': '135', 'classificacao': '003', 'cid_sugestao': 'M998', 'cid_obrigatorio': True}
-        tabela['14'] = {'codigo_sigtap': '0302060014', 'servico': '135', 'classificacao': '003', 'cid_sugestao': 'G968', 'cid_obrigatorio': True}
-        tabela['30'] = {'codigo_sigtap': '0302060030', 'servico': '135', 'classificacao': '003', 'cid_sugestao': 'G839', 'cid_obrigatorio': True}
-        tabela['57'] = {'codigo_sigtap': '0302060057', 'servico': '135', 'classificacao': '003', 'cid_sugestao': 'Q878', 'cid_obrigatorio': True}
-        tabela['49'] = {'codigo_sigtap': '0302060049', 'servico': '135', 'classificacao': '003', 'cid_sugestao': 'F83', 'cid_obrigatorio': True}
-        tabela['530'] = {'codigo_sigtap': '0309050530', 'servico': '135', 'classificacao': '003', 'cid_sugestao': '', 'cid_obrigatorio': False}
-        tabela['23'] = {'codigo_sigtap': '0211030023', 'servico': '135', 'classificacao': '003', 'cid_sugestao': '', 'cid_obrigatorio': False}
-        tabela['31'] = {'codigo_sigtap': '0211030031', 'servico': '135', 'classificacao': '003', 'cid_sugestao': '', 'cid_obrigatorio': False}
-        tabela['24'] = {'codigo_sigtap': '0301070024', 'servico': '135', 'classificacao': '002', 'cid_sugestao': 'F83', 'cid_obrigatorio': True}
-        tabela['40'] = {'codigo_sigtap': '0301070040', 'servico': '135', 'classificacao': '002', 'cid_sugestao': 'F84', 'cid_obrigatorio': True}
-        tabela['59'] = {'codigo_sigtap': '0301070059', 'servico': '135', 'classificacao': '002', 'cid_sugestao': 'F84', 'cid_obrigatorio': True}
-        tabela['75'] = {'codigo_sigtap': '0301070075', 'servico': '135', 'classificacao': '002', 'cid_sugestao': 'F84', 'cid_obrigatorio': True}
-        tabela['261'] = {'codigo_sigtap': '0301070261', 'servico': '135', 'classificacao': '002', 'cid_sugestao': 'F84', 'cid_obrigatorio': True}
-        tabela['13'] = {'codigo_sigtap': '0211100013', 'servico': '135', 'classificacao': '002', 'cid_sugestao': '', 'cid_obrigatorio': False}
-        tabela['38'] = {'codigo_sigtap': '0211060038', 'servico': '135', 'classificacao': '001', 'cid_sugestao': '', 'cid_obrigatorio': False}
-        tabela['20'] = {'codigo_sigtap': '0211060020', 'servico': '135', 'classificacao': '001', 'cid_sugestao': '', 'cid_obrigatorio': False}
-        tabela['54'] = {'codigo_sigtap': '0211060054', 'servico': '135', 'classificacao': '001', 'cid_sugestao': '', 'cid_obrigatorio': False}
-        tabela['100'] = {'codigo_sigtap': '0211060100', 'servico': '135', 'classificacao': '001', 'cid_sugestao': '', 'cid_obrigatorio': False}
-        tabela['1127'] = {'codigo_sigtap': '0211061127', 'servico': '135', 'classificacao': '001', 'cid_sugestao': '', 'cid_obrigatorio': False}
-        tabela['224'] = {'codigo_sigtap': '0211060224', 'servico': '135', 'classificacao': '001', 'cid_sugestao': '', 'cid_obrigatorio': False}
-        tabela['259'] = {'codigo_sigtap': '0211060259', 'servico': '135', 'classificacao': '001', 'cid_sugestao': '', 'cid_obrigatorio': False}
-        tabela['232'] = {'codigo_sigtap': '0211060232', 'servico': '135', 'classificacao': '001', 'cid_sugestao': '', 'cid_obrigatorio': False}
-        tabela['151'] = {'codigo_sigtap': '0211060151', 'servico': '135', 'classificacao': '001', 'cid_sugestao': '', 'cid_obrigatorio': False}
-        tabela['148'] = {'codigo_sigtap': '0301070148', 'servico': '135', 'classificacao': '001', 'cid_sugestao': '', 'cid_obrigatorio': False}
-        tabela['156'] = {'codigo_sigtap': '0301070156', 'servico': '135', 'classificacao': '001', 'cid_sugestao': 'H542', 'cid_obrigatorio': True}
-        tabela['164'] = {'codigo_sigtap': '0301070164', 'servico': '135', 'classificacao': '001', 'cid_sugestao': 'H542', 'cid_obrigatorio': True}
-        tabela['245'] = {'codigo_sigtap': '0301070245', 'servico': '135', 'classificacao': '001', 'cid_sugestao': '', 'cid_obrigatorio': False}
-        tabela['18'] = {'codigo_sigtap': '0302030018', 'servico': '135', 'classificacao': '001', 'cid_sugestao': 'H542', 'cid_obrigatorio': True}
-        tabela['26'] = {'codigo_sigtap': '0302030026', 'servico': '135', 'classificacao': '001', 'cid_sugestao': 'H519', 'cid_obrigatorio': True}
-        tabela['1113'] = {'codigo_sigtap': '0211051113', 'servico': '135', 'classificacao': '005', 'cid_sugestao': '', 'cid_obrigatorio': False}
-        tabela['25'] = {'codigo_sigtap': '0211070025', 'servico': '135', 'classificacao': '005', 'cid_sugestao': '', 'cid_obrigatorio': False}
-        tabela['33'] = {'codigo_sigtap': '0211070033', 'servico': '135', 'classificacao': '005', 'cid_sugestao': '', 'cid_obrigatorio': False}
-        tabela['41'] = {'codigo_sigtap': '0211070041', 'servico': '135', 'classificacao': '005', 'cid_sugestao': '', 'cid_obrigatorio': False}
-        tabela['50'] = {'codigo_sigtap': '0211070050', 'servico': '135', 'classificacao': '005', 'cid_sugestao': '', 'cid_obrigatorio': False}
-        tabela['106'] = {'codigo_sigtap': '0211070106', 'servico': '135', 'classificacao': '005', 'cid_sugestao': 'H919', 'cid_obrigatorio': True}
-        tabela['149'] = {'codigo_sigtap': '0211070149', 'servico': '135', 'classificacao': '005', 'cid_sugestao': '', 'cid_obrigatorio': False}
-        tabela['157'] = {'codigo_sigtap': '0211070157', 'servico': '135', 'classificacao': '005', 'cid_sugestao': '', 'cid_obrigatorio': False}
-        tabela['203'] = {'codigo_sigtap': '0211070203', 'servico': '135', 'classificacao': '005', 'cid_sugestao': '', 'cid_obrigatorio': False}
-        tabela['211'] = {'codigo_sigtap': '0211070211', 'servico': '135', 'classificacao': '005', 'cid_sugestao': '', 'cid_obrigatorio': False}
-        tabela['246'] = {'codigo_sigtap': '0211070246', 'servico': '135', 'classificacao': '005', 'cid_sugestao': '', 'cid_obrigatorio': False}
-        tabela['262'] = {'codigo_sigtap': '0211070262', 'servico': '135', 'classificacao': '005', 'cid_sugestao': '', 'cid_obrigatorio': False}
-        tabela['270'] = {'codigo_sigtap': '0211070270', 'servico': '135', 'classificacao': '005', 'cid_sugestao': '', 'cid_obrigatorio': False}
-        tabela['300'] = {'codigo_sigtap': '0211070300', 'servico': '135', 'classificacao': '005', 'cid_sugestao': 'H919', 'cid_obrigatorio': True}
-        tabela['319'] = {'codigo_sigtap': '0211070319', 'servico': '135', 'classificacao': '005', 'cid_sugestao': 'H919', 'cid_obrigatorio': True}
-        tabela['327'] = {'codigo_sigtap': '0211070327', 'servico': '135', 'classificacao': '005', 'cid_sugestao': '', 'cid_obrigatorio': False}
-        tabela['335'] = {'codigo_sigtap': '0211070335', 'servico': '135', 'classificacao': '005', 'cid_sugestao': '', 'cid_obrigatorio': False}
-        tabela['343'] = {'codigo_sigtap': '0211070343', 'servico': '135', 'classificacao': '005', 'cid_sugestao': '', 'cid_obrigatorio': False}
-        tabela['351'] = {'codigo_sigtap': '0211070351', 'servico': '135', 'classificacao': '005', 'cid_sugestao': '', 'cid_obrigatorio': False}        
-        tabela['424'] = {'codigo_sigtap': '0211070424', 'servico': '135', 'classificacao': '005', 'cid_sugestao': '', 'cid_obrigatorio': False}
-        tabela['432'] = {'codigo_sigtap': '0211070432', 'servico': '135', 'classificacao': '005', 'cid_sugestao': '', 'cid_obrigatorio': False}
-        tabela['32'] = {'codigo_sigtap': '0301070032', 'servico': '135', 'classificacao': '005', 'cid_sugestao': 'H919', 'cid_obrigatorio': True}
-        tabela['253'] = {'codigo_sigtap': '0301070253', 'servico': '135', 'classificacao': '005', 'cid_sugestao': '', 'cid_obrigatorio': False}
-        tabela['520'] = {'codigo_sigtap': '0701050020', 'servico': '135', 'classificacao': '012', 'cid_sugestao': 'Z933', 'cid_obrigatorio': True}
-        tabela['512'] = {'codigo_sigtap': '0701050012', 'servico': '135', 'classificacao': '012', 'cid_sugestao': 'Z933', 'cid_obrigatorio': True}
-        tabela['72'] = {'codigo_sigtap': '0301010072', 'servico': '135', 'classificacao': '003', 'cid_sugestao': '', 'cid_obrigatorio': False}
-        tabela['113'] = {'codigo_sigtap': '0301070113', 'servico': '135', 'classificacao': '002', 'cid_sugestao': 'H919', 'cid_obrigatorio': True}
-        tabela['114'] = {'codigo_sigtap': '0211070114', 'servico': '135', 'classificacao': '005', 'cid_sugestao': '', 'cid_obrigatorio': False}
-        tabela['124'] = {'codigo_sigtap': '0301070024', 'servico': '135', 'classificacao': '002', 'cid_sugestao': 'F840', 'cid_obrigatorio': True}
-        tabela['143'] = {'codigo_sigtap': '0701030143', 'servico': '135', 'classificacao': '005', 'cid_sugestao': 'H919', 'cid_obrigatorio': True}
-        tabela['160'] = {'codigo_sigtap': '0301080160', 'servico': '135', 'classificacao': '002', 'cid_sugestao': '', 'cid_obrigatorio': False}
-        tabela['288'] = {'codigo_sigtap': '0301070288', 'servico': '135', 'classificacao': '002', 'cid_sugestao': '', 'cid_obrigatorio': False}
-        tabela['296'] = {'codigo_sigtap': '0301070296', 'servico': '135', 'classificacao': '002', 'cid_sugestao': '', 'cid_obrigatorio': False}
-        tabela['44'] = {'codigo_sigtap': '0301040044', 'servico': '135', 'classificacao': '002', 'cid_sugestao': '', 'cid_obrigatorio': False}
-        tabela['48'] = {'codigo_sigtap': '0301010048', 'servico': '', 'classificacao': '', 'cid_sugestao': '', 'cid_obrigatorio': False}
-        tabela['67'] = {'codigo_sigtap': '0301070067', 'servico': '135', 'classificacao': '002', 'cid_sugestao': '', 'cid_obrigatorio': False}
-        tabela['76'] = {'codigo_sigtap': '0211070076', 'servico': '', 'classificacao': '', 'cid_sugestao': '', 'cid_obrigatorio': False}
-        tabela['79'] = {'codigo_sigtap': '0301040079', 'servico': '', 'classificacao': '', 'cid_sugestao': '', 'cid_obrigatorio': False}
-        tabela['84'] = {'codigo_sigtap': '0211070084', 'servico': '', 'classificacao': '', 'cid_sugestao': '', 'cid_obrigatorio': False}
-        tabela['92'] = {'codigo_sigtap': '0211070092', 'servico': '135', 'classificacao': '005', 'cid_sugestao': 'H919', 'cid_obrigatorio': True}
-        return tabela
+        """Carrega a tabela de procedimentos (código curto) e seus respectivos SIGTAP, Serviço, Classificação e CID sugerido.
+
+        A tabela vem de bpa_procedimentos (CSV/SQLite em 'arquivo_procedimentos' ou a tabela do banco em
+        'tabela_procedimentos_bd') e fica em cache no processo enquanto a origem não mudar.
+        """
+        from bpa_procedimentos import carregar_tabela_procedimentos, carregar_tabela_procedimentos_bd
+        if self.config.get('tabela_procedimentos_bd') and self.conn:
+            tabela = carregar_tabela_procedimentos_bd(self.conn, self.config['tabela_procedimentos_bd'])
+        else:
+            tabela = carregar_tabela_procedimentos(self.config.get('arquivo_procedimentos'))
+        return tabela.como_dict()
     
+    def _caminho_arquivo_bpa(self, competencia, caminho_arquivo_base):
+        """Troca a extensão do caminho escolhido pela extensão do mês (JAN, FEV, ...)."""
+        mes_num = int(competencia[-2:])
+        extensoes_bpa = ['JAN', 'FEV', 'MAR', 'ABR', 'MAI', 'JUN', 'JUL', 'AGO', 'SET', 'OUT', 'NOV', 'DEZ']
+        extensao_final = extensoes_bpa[mes_num - 1] if 0 < mes_num <= 12 else competencia[-2:]
+        nome_base_sem_ext = os.path.splitext(os.path.basename(caminho_arquivo_base))[0]
+        diretorio = os.path.dirname(caminho_arquivo_base)
+        return os.path.join(diretorio, f"{nome_base_sem_ext}.{extensao_final}")
+
+    # Codificador da linha BPA-I, compilado uma vez a partir de bpa_layout.REGISTRO_BPA_I_LAYOUT
+    _formatar_linha_bpa_i = staticmethod(compilar_codificador(REGISTRO_BPA_I_LAYOUT, TAMANHO_LINHA_BPA, PADROES_REGISTRO_BPA_I))
+
+    # Escrita do TXT: linhas codificadas e gravadas em blocos, sobre um buffer de 1 MiB
+    LINHAS_POR_BLOCO_ESCRITA = 1000
+    TAMANHO_BUFFER_ESCRITA = 1 << 20
+
     def gerar_arquivo_txt(self, competencia, registros_bpa, caminho_arquivo_base):
-        # ... (código do gerar_arquivo_txt permanece o mesmo) ...
         # Certifique-se que newline='' está sendo usado
         if not registros_bpa: print("Não há registros processados para gerar o arquivo TXT."); return False
+        print(f"\nGerando arquivo TXT para {len(registros_bpa)} registros com competência {competencia}")
+        return self.gerar_arquivo_txt_streaming(competencia, registros_bpa, caminho_arquivo_base, len(registros_bpa)) is not None
+
+    def gerar_arquivo_txt_streaming(self, competencia, registros_iter, caminho_arquivo_base, total_previsto=None):
+        """Grava o arquivo BPA consumindo os registros um a um.
+
+        O cabeçalho é escrito com totais zerados e, ao final, reescrito no mesmo lugar com
+        cbc_lin, cbc_flh e cbc_smt_vrf calculados durante a escrita (campos de largura fixa).
+        Retorna o número de linhas gravadas, ou None em caso de erro.
+        """
+        caminho_arquivo_final_com_ext = None
         try:
-            print(f"\nGerando arquivo TXT para {len(registros_bpa)} registros com competência {competencia}")
-            mes_num = int(competencia[-2:])
-            extensoes_bpa = ['JAN', 'FEV', 'MAR', 'ABR', 'MAI', 'JUN', 'JUL', 'AGO', 'SET', 'OUT', 'NOV', 'DEZ']
-            extensao_final = extensoes_bpa[mes_num - 1] if 0 < mes_num <= 12 else competencia[-2:]
-            nome_base_sem_ext = os.path.splitext(os.path.basename(caminho_arquivo_base))[0]
-            diretorio = os.path.dirname(caminho_arquivo_base)
-            caminho_arquivo_final_com_ext = os.path.join(diretorio, f"{nome_base_sem_ext}.{extensao_final}")
-            header_dict = self.gerar_header_bpa(competencia, registros_bpa)
-            with open(caminho_arquivo_final_com_ext, 'w', newline='', encoding='latin-1') as f: # newline=''
-                linha_header_str = ( header_dict['cbc_hdr_1'] + header_dict['cbc_hdr_2'] + header_dict['cbc_mvm'] + header_dict['cbc_lin'] + header_dict['cbc_flh'] + header_dict['cbc_smt_vrf'] + header_dict['cbc_rsp'] + header_dict['cbc_sgl'] + header_dict['cbc_cgccpf'] + header_dict['cbc_dst'] + header_dict['cbc_dst_in'] + header_dict['cbc_versao'] )
-                f.write(linha_header_str + '\r\n')
-                for reg_dict in registros_bpa:
-                    linha_reg_str = (
-                        str(reg_dict.get('prd_ident', '03')).ljust(2) + str(reg_dict.get('prd_cnes', ' ' * 7)).ljust(7) +
-                        str(reg_dict.get('prd_cmp', ' ' * 6)).ljust(6) + str(reg_dict.get('prd_cnsmed', ' ' * 15)).ljust(15) +
-                        str(reg_dict.get('prd_cbo', ' ' * 6)).ljust(6) + str(reg_dict.get('prd_dtaten', ' ' * 8)).ljust(8) +
-                        str(reg_dict.get('prd_flh', '000')).zfill(3) + str(reg_dict.get('prd_seq', '00')).zfill(2) +
-                        str(reg_dict.get('prd_pa', ' ' * 10)).ljust(10) + str(reg_dict.get('prd_cnspac', ' ' * 15)).ljust(15) +
-                        str(reg_dict.get('prd_sexo', ' ')).ljust(1) + str(reg_dict.get('prd_ibge', ' ' * 6)).ljust(6) +
-                        str(reg_dict.get('prd_cid', ' ' * 4)).ljust(4) + str(reg_dict.get('prd_ldade', '000')).zfill(3) +
-                        str(reg_dict.get('prd_qt', '000000')).zfill(6) + str(reg_dict.get('prd_caten', '  ')).ljust(2) +
-                        str(reg_dict.get('prd_naut', ' ' * 13)).ljust(13) + str(reg_dict.get('prd_org', '   ')).ljust(3) +
-                        str(reg_dict.get('prd_nmpac', ' ' * 30)).ljust(30) + str(reg_dict.get('prd_dtnasc', ' ' * 8)).ljust(8) +
-                        str(reg_dict.get('prd_raca', '  ')).ljust(2) + str(reg_dict.get('prd_etnia', '    ')).ljust(4) +
-                        str(reg_dict.get('prd_nac', '   ')).ljust(3) + str(reg_dict.get('prd_srv', '   ')).ljust(3) +
-                        str(reg_dict.get('prd_clf', '   ')).ljust(3) + str(reg_dict.get('prd_equipe_Seq', ' ' * 8)).ljust(8) +
-                        str(reg_dict.get('prd_equipe_Area', ' ' * 4)).ljust(4) + str(reg_dict.get('prd_cnpj', ' ' * 14)).ljust(14) +
-                        str(reg_dict.get('prd_cep_pcnte', ' ' * 8)).ljust(8) + str(reg_dict.get('prd_lograd_pcnte', '   ')).ljust(3) +
-                        str(reg_dict.get('prd_end_pcnte', ' ' * 30)).ljust(30) + str(reg_dict.get('prd_compl_pcnte', ' ' * 10)).ljust(10) +
-                        str(reg_dict.get('prd_num_pcnte', ' ' * 5)).ljust(5) + str(reg_dict.get('prd_bairro_pcnte', ' ' * 30)).ljust(30) +
-                        str(reg_dict.get('prd_ddtel_pcnte', ' ' * 11)).ljust(11) + str(reg_dict.get('prd_email_pcnte', ' ' * 40)).ljust(40) +
-                        str(reg_dict.get('prd_ine', ' ' * 10)).ljust(10) + str(reg_dict.get('prd_cpf_pcnte', ' ' * 11)).ljust(11) +
-                        str(reg_dict.get('prd_situacao_rua', ' ')).ljust(1)
-                    )
-                    linha_reg_final = linha_reg_str.ljust(350)[:350]
-                    f.write(linha_reg_final + '\r\n')
-            print(f"Arquivo BPA gerado com sucesso: {caminho_arquivo_final_com_ext}")
-            return True
+            caminho_arquivo_final_com_ext = self._caminho_arquivo_bpa(competencia, caminho_arquivo_base)
+            linha_header_provisoria = self._linha_header_bpa(self._montar_header_bpa(competencia, 0, self.calcular_controle([], total=0)))
+            num_linhas = 0
+            total_controle = 0
+            codificar = self._formatar_linha_bpa_i
+            parcela_controle = self._parcela_controle
+            linhas_bloco = []
+            # Binário com buffer grande: cada bloco de linhas vira uma única string, codificada em latin-1 de uma vez
+            with open(caminho_arquivo_final_com_ext, 'wb', buffering=self.TAMANHO_BUFFER_ESCRITA) as f:
+                f.write((linha_header_provisoria + '\r\n').encode('latin-1'))
+                for reg_dict in registros_iter:
+                    linhas_bloco.append(codificar(reg_dict))
+                    total_controle += parcela_controle(reg_dict)
+                    if len(linhas_bloco) == self.LINHAS_POR_BLOCO_ESCRITA:
+                        f.write(('\r\n'.join(linhas_bloco) + '\r\n').encode('latin-1'))
+                        num_linhas += len(linhas_bloco)
+                        linhas_bloco.clear()
+                        self._informar_progresso('gravados', num_linhas, total_previsto)
+                if linhas_bloco:
+                    f.write(('\r\n'.join(linhas_bloco) + '\r\n').encode('latin-1'))
+                    num_linhas += len(linhas_bloco)
+
+                linha_header_final = self._linha_header_bpa(self._montar_header_bpa(
+                    competencia, num_linhas, self.calcular_controle([], total=total_controle)
+                ))
+                if len(linha_header_final) != len(linha_header_provisoria):
+                    raise ValueError(f"Totais do cabeçalho excedem a largura dos campos ({num_linhas} linhas).")
+                f.seek(0)
+                f.write(linha_header_final.encode('latin-1'))
+            self._informar_progresso('gravados', num_linhas, num_linhas)
+            print(f"Arquivo BPA gerado com sucesso: {caminho_arquivo_final_com_ext} ({num_linhas} linhas)")
+            return num_linhas
         except Exception as e:
-            print(f"Erro ao gerar arquivo BPA: {str(e)}"); import traceback; traceback.print_exc(); return False
+            cancelado = isinstance(e, OperacaoCancelada)
+            if not cancelado:
+                print(f"Erro ao gerar arquivo BPA: {str(e)}"); import traceback; traceback.print_exc()
+            # Não deixa para trás um arquivo com cabeçalho provisório
+            if caminho_arquivo_final_com_ext and os.path.exists(caminho_arquivo_final_com_ext):
+                os.remove(caminho_arquivo_final_com_ext)
+            if cancelado:
+                raise
+            return None
             
+    @staticmethod
+    def _itens_para_arquivo(reg):
+        """reg.items() com prd_qt no formato do arquivo ('000003'), como sai no TXT."""
+        return [(campo, formatar_quantidade(valor) if campo == 'prd_qt' else valor) for campo, valor in reg.items()]
+
     def gerar_arquivo_csv(self, registros_bpa, caminho_arquivo):
         # ... (código do gerar_arquivo_csv permanece o mesmo) ...
         if not registros_bpa: print("Não há dados para gerar CSV."); return False
         try:
-            df = pd.DataFrame(registros_bpa)
-            df.to_csv(caminho_arquivo, index=False, quoting=csv.QUOTE_ALL, encoding='utf-8-sig')
+            # Mesmo formato do DataFrame.to_csv usado antes (colunas na ordem em que aparecem,
+            # tudo entre aspas, UTF-8 com BOM), sem carregar o pandas.
+            colunas = list(dict.fromkeys(campo for reg in registros_bpa for campo in reg.keys()))
+            with open(caminho_arquivo, 'w', newline='', encoding='utf-8-sig') as f:
+                writer = csv.DictWriter(f, fieldnames=colunas, quoting=csv.QUOTE_ALL, restval='', lineterminator=os.linesep)
+                writer.writeheader()
+                for reg in registros_bpa:
+                    writer.writerow({campo: ('' if valor is None else valor) for campo, valor in self._itens_para_arquivo(reg)})
             print(f"Arquivo CSV gerado com sucesso: {caminho_arquivo}"); return True
         except Exception as e: print(f"Erro ao gerar arquivo CSV: {str(e)}"); return False
     
@@ -876,7 +2042,8 @@ class BPAExporter:
         # ... (código do gerar_arquivo_xlsx permanece o mesmo) ...
         if not registros_bpa: print("Não há dados para gerar XLSX."); return False
         try:
-            df = pd.DataFrame(registros_bpa)
+            import pandas as pd # Só a exportação XLSX usa pandas
+            df = pd.DataFrame([dict(self._itens_para_arquivo(reg)) for reg in registros_bpa])
             df.to_excel(caminho_arquivo, index=False)
             print(f"Arquivo Excel gerado com sucesso: {caminho_arquivo}"); return True
         except Exception as e: print(f"Erro ao gerar arquivo Excel: {str(e)}"); return False
@@ -888,402 +2055,225 @@ class BPAExporter:
         if not registros_bpa_i: print("Atenção: 'processar_registros_bpa_i' (simples) não foi totalmente implementada para todos os campos BPA-I.")
         return registros_bpa_i # Retorna lista vazia ou o que ela já fazia
     
+    def especificacao_deduplicacao(self, metodo):
+        """EspecificacaoDeduplicacao do método: um dos padrões (bpa_deduplicacao.ESPECIFICACOES) ou de
+        [DEDUPLICACAO] no config.ini. None para 'nenhum'; método desconhecido usa o completo."""
+        if metodo == SEM_DEDUPLICACAO:
+            return None
+        personalizadas = self.config.get('deduplicacoes_personalizadas') or {}
+        if metodo in personalizadas:
+            return especificacao_de_texto(personalizadas[metodo])
+        if metodo not in ESPECIFICACOES_DEDUPLICACAO:
+            print(f"Aviso: método de deduplicação desconhecido '{metodo}'; usando 'completo'.")
+            metodo = 'completo'
+        return ESPECIFICACOES_DEDUPLICACAO[metodo]
+
+    def metodos_deduplicacao(self):
+        """Nomes aceitos por aplicar_deduplicacao: os padrões e os de [DEDUPLICACAO] no config.ini."""
+        return list(dict.fromkeys(METODOS_DEDUPLICACAO + list(self.config.get('deduplicacoes_personalizadas') or {})))
+
     def aplicar_deduplicacao(self, registros_bpa_brutos, metodo="completo"):
         """Aplica deduplicação baseada no método escolhido. Não renumera folha/sequência aqui."""
         if not registros_bpa_brutos:
             return []
-            
-        if metodo == "nenhum":
+        if metodo == SEM_DEDUPLICACAO:
             print("Deduplicação desabilitada - mantendo todos os registros brutos processados.")
             return registros_bpa_brutos
-        elif metodo == "simples": 
-            return self.deduplicate_por_criterio_alternativo(registros_bpa_brutos)
-        elif metodo == "novo_manter_primeiro": 
-            return self.deduplicate_novo_criterio_manter_primeiro(registros_bpa_brutos)
-        elif metodo == "por_id_lancamento": # NOVA OPÇÃO
-            return self.deduplicate_por_id_lancamento_original(registros_bpa_brutos)
-        else: # "completo" ou default
-            return self.deduplicate_registros_bpa(registros_bpa_brutos)
+        print(f"\nIniciando deduplicação ({metodo}) de {len(registros_bpa_brutos)} registros...")
+        registros_finais = list(self.iterar_deduplicacao(registros_bpa_brutos, metodo))
+        print(f"Deduplicação ({metodo}) concluída: {len(registros_finais)} registros únicos finais.")
+        return registros_finais
             
-    def deduplicate_registros_bpa(self, registros_bpa_processados):
-        """Remove registros duplicados da lista de registros BPA-I (Método Completo). Não renumera."""
-        print(f"\nIniciando deduplicação (Método Completo) de {len(registros_bpa_processados)} registros...")
-        if not registros_bpa_processados: return []
-        campos_chave = [
-            'prd_cnes', 'prd_cmp', 'prd_cnsmed', 'prd_cbo', 'prd_dtaten',
-            'prd_pa', 'prd_cnspac', 'prd_cid', 
-        ]
-        registros_unicos_dict = {}; registros_duplicados_info = []
-        for registro in registros_bpa_processados:
-            chave_str_list = [str(registro.get(campo, '')).strip() for campo in campos_chave]
-            chave_unica_tupla = tuple(chave_str_list)
-            if chave_unica_tupla in registros_unicos_dict:
-                registro_existente = registros_unicos_dict[chave_unica_tupla]
-                try:
-                    qtd_atual_str = str(registro.get('prd_qt', '0')).replace('.', '')
-                    qtd_existente_str = str(registro_existente.get('prd_qt', '0')).replace('.', '')
-                    qtd_atual = int(qtd_atual_str) if qtd_atual_str.isdigit() else 0
-                    qtd_existente = int(qtd_existente_str) if qtd_existente_str.isdigit() else 0
-                    qtd_total_somada = qtd_existente + qtd_atual
-                    registro_existente['prd_qt'] = str(qtd_total_somada).zfill(6)
-                    registros_duplicados_info.append({'chave': chave_unica_tupla, 'qtd_adic': qtd_atual, 'nova_qtd': qtd_total_somada})
-                except (ValueError, TypeError) as e_qtd:
-                    print(f"  Aviso: Erro ao somar quantidades para chave {chave_unica_tupla}: {e_qtd}. Mantendo o primeiro.")
-                    registros_duplicados_info.append({'chave': chave_unica_tupla, 'motivo': 'Erro qtd'})
-            else:
-                registros_unicos_dict[chave_unica_tupla] = registro.copy() 
-        registros_finais_deduplicados = list(registros_unicos_dict.values())
-        print(f"Deduplicação (Método Completo) concluída: {len(registros_finais_deduplicados)} registros únicos finais.")
-        return registros_finais_deduplicados
+    def iterar_deduplicacao(self, registros, metodo="completo"):
+        """Versão em streaming de aplicar_deduplicacao (uma passada de bpa_deduplicacao.deduplicar).
+        As políticas que mantêm o primeiro registro repassam cada registro assim que ele aparece; as que
+        somam quantidade guardam uma cópia de cada registro único (os de entrada não mudam) e as entregam
+        ao final, na ordem em que apareceram. Acima de 'limite_deduplicacao_memoria' chaves únicas o estado vai para o disco."""
+        especificacao = self.especificacao_deduplicacao(metodo)
+        if especificacao is None:
+            yield from registros
+        else:
+            yield from deduplicar(registros, especificacao, int(self.config.get('limite_deduplicacao_memoria') or 0),
+                                  self.config.get('diretorio_temporario'))
 
-    def deduplicate_novo_criterio_manter_primeiro(self, registros_bpa_processados):
-        """
-        Deduplica mantendo apenas o primeiro registro para a chave:
-        (CNES, Competência, CBO Profissional, Data Atendimento, CNS Paciente).
-        A quantidade prd_qt não é somada, é mantida a do primeiro registro (que será '000001').
-        """
-        print(f"\nIniciando deduplicação (Novo Critério - Manter Primeiro por Pac/Prof/Dia) de {len(registros_bpa_processados)} registros...")
-        if not registros_bpa_processados:
-            return []
+# --- Interface Gráfica (BPAExporterGUI) ---
+ARQUIVO_CONFIG_PADRAO = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'config.ini')
+METODOS_DEDUPLICACAO = list(ESPECIFICACOES_DEDUPLICACAO) + [SEM_DEDUPLICACAO]
 
-        registros_unicos_dict = {} 
-        registros_finais = []
 
-        campos_chave_novo = [
-            'prd_cnes', 
-            'prd_cmp', 
-            'prd_cbo', 
-            'prd_dtaten', 
-            'prd_cnspac' 
-        ]
+def _data_iso(valor):
+    return datetime.date.fromisoformat(valor)
 
-        for registro in registros_bpa_processados:
-            chave_str_list = [str(registro.get(campo, '')).strip() for campo in campos_chave_novo]
-            chave_unica_tupla = tuple(chave_str_list)
-
-            if chave_unica_tupla not in registros_unicos_dict:
-                # Se a chave não foi vista antes, este é o primeiro registro para esta combinação.
-                registros_unicos_dict[chave_unica_tupla] = True # Apenas marcar a chave como vista
-                registros_finais.append(registro.copy()) # Adiciona o registro (com prd_qt='000001')
-            # else:
-                # Chave já existe, este é um registro subsequente para a mesma combinação. Ignora.
-                # self._log_message(f"  DEBUG: Duplicata (Novo Critério) descartada para chave {chave_unica_tupla}, Pac: {registro.get('prd_nmpac')}, Proc Orig: {registro.get('prd_pa')}")
-        
-        print(f"Deduplicação (Novo Critério - Manter Primeiro) concluída:")
-        print(f"  - Registros originais processados: {len(registros_bpa_processados)}")
-        print(f"  - Registros únicos finais: {len(registros_finais)}")
-        
-        return registros_finais
 
+def exportar_linha_de_comando(args):
+    """Executa o pipeline sem interface (consulta -> deduplicação -> numeração -> arquivos).
 
-    def deduplicate_por_criterio_alternativo(self, registros_bpa_processados):
-        """Método alternativo de deduplicação (Simples). Não renumera."""
-        print(f"\nIniciando deduplicação (Método Simples) de {len(registros_bpa_processados)} registros...")
-        if not registros_bpa_processados: return []
-        registros_unicos_agregados = {}
-        for registro in registros_bpa_processados:
-            chave_simples = ( str(registro.get('prd_cnspac', '')).strip(), str(registro.get('prd_pa', '')).strip(), str(registro.get('prd_dtaten', '')).strip() )
-            if chave_simples in registros_unicos_agregados:
-                registro_existente = registros_unicos_agregados[chave_simples]
-                try:
-                    qtd_atual_str = str(registro.get('prd_qt', '0')).replace('.', '')
-                    qtd_existente_str = str(registro_existente.get('prd_qt', '0')).replace('.', '')
-                    qtd_atual = int(qtd_atual_str) if qtd_atual_str.isdigit() else 0
-                    qtd_existente = int(qtd_existente_str) if qtd_existente_str.isdigit() else 0
-                    nova_qtd_total = qtd_existente + qtd_atual
-                    registro_existente['prd_qt'] = str(nova_qtd_total).zfill(6)
-                except (ValueError, TypeError) as e_qtd_simples:
-                    print(f"  Aviso: Erro ao somar quantidades (Simples) para chave {chave_simples}: {e_qtd_simples}.")
-            else:
-                registros_unicos_agregados[chave_simples] = registro.copy()
-        registros_finais_agrupados = list(registros_unicos_agregados.values())
-        print(f"Deduplicação (Método Simples) concluída: {len(registros_finais_agrupados)} registros finais.")
-        return registros_finais_agrupados
+    Retorna o resumo com os tempos de cada etapa em segundos; as mensagens do exportador vão para stderr.
+    """
+    tempos = {}
+    resumo = {'status': 'erro', 'competencia': args.competencia, 'criterio': args.criterio,
+              'deduplicacao': args.dedup, 'arquivos': {}, 'tempos_s': tempos}
+    inicio_total = time.perf_counter()
 
-# --- Interface Gráfica (BPAExporterGUI) ---
-class BPAExporterGUI:
-    def __init__(self, root_window):
-        self.root = root_window
-        self.root.title("Exportador BPA-I (SIGH Profissional)")
-        self.root.geometry("950x720") # Aumentei um pouco a altura para o novo label
-        self.exporter = BPAExporter()
-        self.exporter.gui_log_callback = self._log_message # Passa a função de log da GUI para o exporter
+    def cronometrar(etapa, funcao, *a, **k):
+        t0 = time.perf_counter()
+        resultado = funcao(*a, **k)
+        tempos[etapa] = round(time.perf_counter() - t0, 3)
+        return resultado
 
-        
-        style = ttk.Style()
-        style.theme_use('clam') 
-        style.configure("TLabel", padding=3, font=('Helvetica', 10))
-        style.configure("TButton", padding=3, font=('Helvetica', 10))
-        style.configure("TEntry", padding=3, font=('Helvetica', 10))
-        style.configure("TCombobox", padding=3, font=('Helvetica', 10))
-        style.configure("TLabelframe.Label", font=('Helvetica', 10, 'bold'))
-        
-        self.frame_conexao = ttk.LabelFrame(root_window, text="1. Conexão ao Banco de Dados")
-        self.frame_conexao.pack(fill="x", padx=10, pady=5, ipady=5)
-        
-        
-        self.frame_filtros = ttk.LabelFrame(root_window, text="2. Filtros e Deduplicação")
-        self.frame_filtros.pack(fill="x", padx=10, pady=5, ipady=5)
-        
-        self.frame_config = ttk.LabelFrame(root_window, text="3. Configurações do Arquivo BPA-I")
-        self.frame_config.pack(fill="x", padx=10, pady=5, ipady=5)
-        
-        self.frame_acoes = ttk.LabelFrame(root_window, text="4. Ações e Totais") # Nome do frame ajustado
-        self.frame_acoes.pack(fill="x", padx=10, pady=5, ipady=5)
-        
-        self.frame_log = ttk.LabelFrame(root_window, text="Log de Eventos")
-        self.frame_log.pack(fill="both", expand=True, padx=10, pady=5)
-
-        conn_fields = [ ("Banco:", "db_name", "bd0553"), ("Usuário:", "db_user", "postgres"), ("Senha:", "db_password", "postgres", True), ("Host:", "db_host", "localhost"), ("Porta:", "db_port", "5432") ]
-        for i, (label_text, attr_name, default_val, *is_password) in enumerate(conn_fields):
-            row, col_offset = divmod(i, 3)
-            ttk.Label(self.frame_conexao, text=label_text).grid(row=row, column=col_offset*2, padx=5, pady=3, sticky="w")
-            entry = ttk.Entry(self.frame_conexao, width=18)
-            if is_password and is_password[0]: entry.config(show="*")
-            entry.insert(0, default_val); entry.grid(row=row, column=col_offset*2 + 1, padx=5, pady=3, sticky="ew"); setattr(self, attr_name, entry)
-        self.btn_conectar = ttk.Button(self.frame_conexao, text="Conectar ao BD", command=self.conectar_bd)
-        self.btn_conectar.grid(row=len(conn_fields)//3, column=6, padx=10, pady=5, rowspan=max(1, (len(conn_fields)-1)//3 + 1 - (len(conn_fields)//3) ), sticky="ew")
-        ttk.Label(self.frame_filtros, text="Data Início:").grid(row=0, column=0, padx=5, pady=3, sticky="w")
-        self.data_inicio_entry = DateEntry(self.frame_filtros, width=12, date_pattern='dd/mm/yyyy', font=('Helvetica', 10)); self.data_inicio_entry.grid(row=0, column=1, padx=5, pady=3, sticky="ew")
-        ttk.Label(self.frame_filtros, text="Data Fim:").grid(row=0, column=2, padx=5, pady=3, sticky="w")
-        self.data_fim_entry = DateEntry(self.frame_filtros, width=12, date_pattern='dd/mm/yyyy', font=('Helvetica', 10)); self.data_fim_entry.grid(row=0, column=3, padx=5, pady=3, sticky="ew")
-        ttk.Label(self.frame_filtros, text="Competência (AAAAMM):").grid(row=0, column=4, padx=5, pady=3, sticky="w")
-        self.competencia_entry = ttk.Entry(self.frame_filtros, width=10); self.competencia_entry.insert(0, datetime.datetime.now().strftime("%Y%m")); self.competencia_entry.grid(row=0, column=5, padx=5, pady=3, sticky="ew")
-        ttk.Label(self.frame_filtros, text="Critério de Data para Filtro:").grid(row=1, column=0, padx=5, pady=3, sticky="w")
-        self.criterio_data_combo = ttk.Combobox(self.frame_filtros, values=["Data do Lançamento (Recomendado)", "Data da Conta (Início)", "Competência da Conta", "Data do Atendimento (Ficha)"], width=30, state="readonly"); self.criterio_data_combo.current(0); self.criterio_data_combo.grid(row=1, column=1, columnspan=3, padx=5, pady=3, sticky="ew")
-        ttk.Label(self.frame_filtros, text="Deduplicação de Registros:").grid(row=2, column=0, padx=5, pady=3, sticky="w")
-        self.metodo_deduplicacao_combo = ttk.Combobox(self.frame_filtros, values=[
-            "Método Completo (Agrega Qtde por Proc/Pac/etc)", # Descrição ajustada
-            "Método Simples (Agrega Qtde por Proc/Pac/Data)", # Descrição ajustada
-            "Novo: 1 Proc por Pac/Prof/Dia (Qtde=1)",      # Nova opção
-            "SIGH: 1 por Lançamento Original do BD (Qtde=1)", # NOVA OPÇÃO
-            "Sem Deduplicação (Qtde=1)"                       # Descrição ajustada
-        ], width=45, state="readonly") # Aumentado width se necessário
-        self.metodo_deduplicacao_combo.current(0) # Ou o default que você preferir
-        self.metodo_deduplicacao_combo.grid(row=2, column=1, columnspan=3, padx=5, pady=3, sticky="ew")
-
-        bpa_config_fields = [ ("Órgão Responsável:", "orgao_resp_entry", "APAE DE COLINAS DO TOCANTINS", 35), ("Sigla Órgão:", "sigla_orgao_entry", "APAE", 8), ("CNPJ/CPF Estab.:", "cgc_cpf_entry", "25062282000182", 18), ("Órgão Destino:", "orgao_destino_entry", "SECRETARIA MUNICIPAL DE SAUDE", 35), ("Indicador Destino (M/E):", "indicador_destino_combo", ["M", "E"], 5), ("Versão Sistema BPA:", "versao_sistema_entry", "V04.10", 10), ("CNES Estabelecimento:", "cnes_entry", "2560372", 10) ]
-        for i, (label_text, attr_name, default_val, width) in enumerate(bpa_config_fields):
-            row, col_offset = divmod(i, 2)
-            ttk.Label(self.frame_config, text=label_text).grid(row=row, column=col_offset*2, padx=5, pady=3, sticky="w")
-            if isinstance(default_val, list): combo = ttk.Combobox(self.frame_config, values=default_val, width=width, state="readonly"); combo.set(default_val[0]); combo.grid(row=row, column=col_offset*2 + 1, padx=5, pady=3, sticky="ew"); setattr(self, attr_name, combo)
-            else: entry = ttk.Entry(self.frame_config, width=width); entry.insert(0, default_val); entry.grid(row=row, column=col_offset*2 + 1, padx=5, pady=3, sticky="ew"); setattr(self, attr_name, entry)
-        self.btn_consultar_dados = ttk.Button(self.frame_acoes, text="Consultar Dados do BD", command=self.iniciar_consulta_dados, state="disabled")
-        self.btn_consultar_dados.grid(row=0, column=0, padx=10, pady=10, ipady=5, sticky="ew")
-        
-        self.btn_exportar_txt = ttk.Button(self.frame_acoes, text="Exportar Arquivo BPA (.TXT)", command=self.exportar_arquivo_txt, state="disabled")
-        self.btn_exportar_txt.grid(row=0, column=1, padx=10, pady=10, ipady=5, sticky="ew")
-        
-        self.btn_exportar_csv = ttk.Button(self.frame_acoes, text="Exportar para CSV", command=self.exportar_arquivo_csv, state="disabled")
-        self.btn_exportar_csv.grid(row=0, column=2, padx=10, pady=10, ipady=5, sticky="ew")
-        
-        self.btn_exportar_xlsx = ttk.Button(self.frame_acoes, text="Exportar para Excel (.xlsx)", command=self.exportar_arquivo_xlsx, state="disabled")
-        self.btn_exportar_xlsx.grid(row=0, column=3, padx=10, pady=10, ipady=5, sticky="ew")
+    exporter = BPAExporter()
+    params_bd = exporter.carregar_config_ini(args.config)
+    if args.particoes:
+        exporter.config['particoes_extracao'] = args.particoes
+    if args.processos is not None:
+        exporter.config['processos_construcao'] = args.processos
+    if args.motor:
+        exporter.config['motor_processamento'] = args.motor
+    if args.dedup not in exporter.metodos_deduplicacao():
+        resumo['mensagem'] = f"Método de deduplicação desconhecido: {args.dedup} (use {', '.join(exporter.metodos_deduplicacao())})"
+        return resumo
+    if not cronometrar('conexao', exporter.conectar_bd, **params_bd):
+        resumo['mensagem'] = 'Falha ao conectar ao banco de dados.'
+        return resumo
+    try:
+        if args.streaming:
+            linhas = cronometrar('exportacao_txt', exporter.exportar_txt_streaming, args.inicio, args.fim, args.competencia,
+                                 args.saida, args.criterio, args.dedup, formatar_no_sql=args.formatar_no_sql,
+                                 deduplicar_no_sql=args.dedup_no_sql)
+            if linhas is None:
+                resumo['mensagem'] = 'Falha ao gerar o arquivo BPA.'
+                return resumo
+            resumo['linhas'] = linhas
+            resumo['arquivos']['txt'] = exporter._caminho_arquivo_bpa(args.competencia, args.saida)
+        else:
+            if args.incremental:
+                # Já volta deduplicado e numerado (só os profissionais alterados são renumerados)
+                registros = cronometrar('consulta_incremental', exporter.consultar_dados_incremental, args.inicio, args.fim,
+                                        args.competencia, args.criterio, args.dedup, reiniciar=args.reiniciar_incremental)
+            else:
+                if args.dedup_no_sql:
+                    registros = cronometrar('consulta', exporter.consultar_dados_completo, args.inicio, args.fim, args.competencia,
+                                            args.criterio, formatar_no_sql=True, metodo_dedup=args.dedup)
+                    resumo['registros_processados'] = len(registros)
+                else:
+                    registros = cronometrar('consulta', exporter.consultar_dados_completo, args.inicio, args.fim, args.competencia,
+                                            args.criterio, formatar_no_sql=args.formatar_no_sql)
+                    resumo['registros_processados'] = len(registros)
+                    registros = cronometrar('deduplicacao', exporter.aplicar_deduplicacao, registros, args.dedup)
+                registros = cronometrar('numeracao', exporter._atribuir_folha_sequencia_final, registros)
+            resumo['linhas'] = len(registros)
+            resumo['quantidade_total'] = sum(int(reg.get('prd_qt') or 0) for reg in registros)
+            if not registros:
+                resumo['mensagem'] = 'A consulta não retornou registros.'
+                return resumo
+            if not cronometrar('gravacao_txt', exporter.gerar_arquivo_txt, args.competencia, registros, args.saida):
+                resumo['mensagem'] = 'Falha ao gerar o arquivo BPA.'
+                return resumo
+            resumo['arquivos']['txt'] = exporter._caminho_arquivo_bpa(args.competencia, args.saida)
+            if args.csv and cronometrar('gravacao_csv', exporter.gerar_arquivo_csv, registros, args.csv):
+                resumo['arquivos']['csv'] = args.csv
+            if args.xlsx and cronometrar('gravacao_xlsx', exporter.gerar_arquivo_xlsx, registros, args.xlsx):
+                resumo['arquivos']['xlsx'] = args.xlsx
+        resumo['status'] = 'ok'
+        return resumo
+    finally:
+        exporter.desconectar()
+        tempos['total'] = round(time.perf_counter() - inicio_total, 3)
 
-        # NOVO: Labels para exibir totais
-        ttk.Label(self.frame_acoes, text="Registros BPA-I Finais:").grid(row=1, column=0, padx=(10,0), pady=5, sticky="e")
-        self.lbl_total_registros_valor = ttk.Label(self.frame_acoes, text="0", font=('Helvetica', 10, 'bold'))
-        self.lbl_total_registros_valor.grid(row=1, column=1, padx=(0,10), pady=5, sticky="w")
-        
-        ttk.Label(self.frame_acoes, text="Total de Procedimentos (Qtde):").grid(row=1, column=2, padx=(10,0), pady=5, sticky="e")
-        self.lbl_total_quantidade_valor = ttk.Label(self.frame_acoes, text="0", font=('Helvetica', 10, 'bold'))
-        self.lbl_total_quantidade_valor.grid(row=1, column=3, padx=(0,10), pady=5, sticky="w")
-
-        # Configurar colunas do frame_acoes para expandir igualmente
-        for i_col in range(4): self.frame_acoes.columnconfigure(i_col, weight=1)
-
-        self.log_text_area = tk.Text(self.frame_log, height=10, wrap=tk.WORD, font=('Courier New', 9)); self.log_text_area.pack(side=tk.LEFT, fill="both", expand=True, padx=(0,0))
-        log_scrollbar = ttk.Scrollbar(self.frame_log, orient="vertical", command=self.log_text_area.yview); log_scrollbar.pack(side=tk.RIGHT, fill="y")
-        self.log_text_area.config(yscrollcommand=log_scrollbar.set, state="disabled")
-        self.registros_bpa_processados = []
-        self._log_message("Interface iniciada. Preencha os dados de conexão e clique em 'Conectar'.")
-        
 
-    def _log_message(self, message):
-        self.log_text_area.config(state="normal")
-        timestamp = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        self.log_text_area.insert(tk.END, f"[{timestamp}] {message}\n")
-        self.log_text_area.see(tk.END)
-        self.log_text_area.config(state="disabled")
-        self.root.update_idletasks()
+def main():
+    """Função principal: sem argumentos inicia a GUI; 'exportar' e 'sugerir-indices' rodam sem interface."""
+    import argparse
+    parser = argparse.ArgumentParser(description='Exportador BPA-I (CER IV). Sem comando, abre a interface gráfica.')
+    subparsers = parser.add_subparsers(dest='comando')
+
+    p_exportar = subparsers.add_parser('exportar', help='Gera o arquivo BPA-I sem interface e imprime um resumo JSON (com tempos) no stdout.')
+    p_exportar.add_argument('--config', default=ARQUIVO_CONFIG_PADRAO, help='Arquivo de configuração. Padrão: config.ini ao lado do programa')
+    p_exportar.add_argument('--inicio', type=_data_iso, required=True, help='Data inicial do período (AAAA-MM-DD)')
+    p_exportar.add_argument('--fim', type=_data_iso, required=True, help='Data final do período (AAAA-MM-DD)')
+    p_exportar.add_argument('--competencia', required=True, help='Competência AAAAMM')
+    p_exportar.add_argument('--criterio', default='lancamento', choices=['lancamento', 'conta', 'atendimento', 'competencia'])
+    p_exportar.add_argument('--dedup', default='completo',
+                            help=f"Método de deduplicação: {', '.join(METODOS_DEDUPLICACAO)} ou um de [DEDUPLICACAO] no config.ini")
+    p_exportar.add_argument('--saida', required=True, help='Caminho do arquivo BPA (a extensão vira a do mês: JAN, FEV, ...)')
+    p_exportar.add_argument('--csv', help='Também grava os registros em CSV')
+    p_exportar.add_argument('--xlsx', help='Também grava os registros em XLSX (requer pandas)')
+    p_exportar.add_argument('--streaming', action='store_true', help='Pipeline em streaming, sem manter os registros em memória (só o TXT)')
+    p_exportar.add_argument('--formatar-no-sql', action='store_true', help='Formata os campos BPA-I no próprio PostgreSQL')
+    p_exportar.add_argument('--dedup-no-sql', action='store_true',
+                            help='Deduplica na própria consulta (GROUP BY da chave); requer --formatar-no-sql')
+    p_exportar.add_argument('--incremental', action='store_true',
+                            help='Monta só os lançamentos novos ou alterados desde a última execução do mesmo período (estado local em SQLite)')
+    p_exportar.add_argument('--reiniciar-incremental', action='store_true',
+                            help='Com --incremental, descarta o estado guardado e refaz a extração completa')
+    p_exportar.add_argument('--particoes', type=int, help='Partições da extração paralela (modo streaming)')
+    p_exportar.add_argument('--processos', type=int, help='Processos na montagem dos registros (0 = um por núcleo)')
+    p_exportar.add_argument('--motor', choices=BPAExporter.MOTORES_PROCESSAMENTO, help='Motor de processamento das linhas do banco')
+
+    p_indices = subparsers.add_parser('sugerir-indices', help='Lista os índices recomendados para a consulta do BPA-I que faltam no banco.')
+    p_indices.add_argument('--config', default=ARQUIVO_CONFIG_PADRAO)
+    args = parser.parse_args()
+
+    if args.comando == 'exportar':
+        if len(args.competencia) != 6 or not args.competencia.isdigit():
+            parser.error('--competencia deve estar no formato AAAAMM')
+        if args.incremental and (args.streaming or args.formatar_no_sql):
+            parser.error('--incremental não está disponível com --streaming/--formatar-no-sql')
+        if args.reiniciar_incremental and not args.incremental:
+            parser.error('--reiniciar-incremental requer --incremental')
+        if args.dedup_no_sql and not args.formatar_no_sql:
+            parser.error('--dedup-no-sql requer --formatar-no-sql')
+        if args.streaming and (args.csv or args.xlsx):
+            parser.error('--csv/--xlsx não estão disponíveis com --streaming')
+        # stdout fica só para o JSON; as mensagens do exportador vão para stderr
+        with contextlib.redirect_stdout(sys.stderr):
+            resumo = exportar_linha_de_comando(args)
+        print(json.dumps(resumo, ensure_ascii=False))
+        sys.exit(0 if resumo['status'] == 'ok' else 1)
+
+    if args.comando == 'sugerir-indices':
+        exporter = BPAExporter()
+        if exporter.conectar_bd(**exporter.carregar_config_ini(args.config)):
+            exporter.sugerir_indices()
+        return
 
-    def conectar_bd(self):
-        try:
-            db_params = { "db_name": self.db_name.get(), "user": self.db_user.get(), "password": self.db_password.get(), "host": self.db_host.get(), "port": self.db_port.get() }
-            self._log_message(f"Tentando conectar ao banco: {db_params['db_name']}@{db_params['host']}...")
-            if self.exporter.conectar_bd(**db_params):
-                self._log_message("Conexão com o banco de dados estabelecida com sucesso!")
-                messagebox.showinfo("Conexão Bem-Sucedida", "Conexão ao banco de dados estabelecida!")
-                self.btn_consultar_dados.config(state="normal")
-            else:
-                self._log_message("Falha ao conectar ao banco. Verifique as credenciais e o console.")
-                messagebox.showerror("Erro de Conexão", "Não foi possível conectar ao banco de dados. Verifique o log.")
-        except Exception as e:
-            self._log_message(f"Erro inesperado durante a conexão: {str(e)}")
-            messagebox.showerror("Erro Crítico", f"Ocorreu um erro crítico ao tentar conectar: {str(e)}")
-
-    def _atualizar_config_exporter(self):
-        self.exporter.config['orgao_responsavel'] = self.orgao_resp_entry.get()
-        self.exporter.config['sigla_orgao'] = self.sigla_orgao_entry.get()
-        self.exporter.config['cgc_cpf'] = self.cgc_cpf_entry.get()
-        self.exporter.config['orgao_destino'] = self.orgao_destino_entry.get()
-        self.exporter.config['indicador_destino'] = self.indicador_destino_combo.get()
-        self.exporter.config['versao_sistema'] = self.versao_sistema_entry.get()
-        self.exporter.config['cnes'] = self.cnes_entry.get()
-        self.exporter.config['default_ibge_paciente'] = self.exporter.config.get('default_ibge_paciente', '000000')
-        self.exporter.config['default_cep_paciente'] = self.exporter.config.get('default_cep_paciente', '00000000')
-        self.exporter.config['default_ine'] = self.exporter.config.get('default_ine', '0000000000')
-
-    def iniciar_consulta_dados(self):
-        """Handler para o botão de consultar dados."""
-        try:
-            # Resetar labels de totais no início da consulta
-            self.lbl_total_registros_valor.config(text="Calculando...")
-            self.lbl_total_quantidade_valor.config(text="Calculando...")
-            self.root.update_idletasks()
-
-            data_inicio_val = self.data_inicio_entry.get_date()
-            data_fim_val = self.data_fim_entry.get_date()
-            competencia_val = self.competencia_entry.get()
-
-            if not competencia_val or len(competencia_val) != 6 or not competencia_val.isdigit():
-                messagebox.showerror("Entrada Inválida", "Competência deve estar no formato AAAAMM (ex: 202305).")
-                self.lbl_total_registros_valor.config(text="0") # Reset em caso de erro de entrada
-                self.lbl_total_quantidade_valor.config(text="0")
-                return
-
-            criterio_selecionado_gui = self.criterio_data_combo.get()
-            map_criterio_gui_interno = {
-                "Data do Lançamento (Recomendado)": "lancamento",
-                "Data da Conta (Início)": "conta",
-                "Competência da Conta": "competencia",
-                "Data do Atendimento (Ficha)": "atendimento"
-            }
-            criterio_interno = map_criterio_gui_interno.get(criterio_selecionado_gui, "atendimento")
-            
-            metodo_dedup_gui = self.metodo_deduplicacao_combo.get()
-            map_dedup_gui_interno = {
-                "Método Completo (Agrega Qtde por Proc/Pac/etc)": "completo",
-                "Método Simples (Agrega Qtde por Proc/Pac/Data)": "simples",
-                "Novo: 1 Proc por Pac/Prof/Dia (Qtde=1)": "novo_manter_primeiro",
-                "SIGH: 1 por Lançamento Original do BD (Qtde=1)": "por_id_lancamento", # <<< CORRIGIDO
-                "Sem Deduplicação (Qtde=1)": "nenhum"
-            }
-            metodo_dedup_interno = map_dedup_gui_interno.get(metodo_dedup_gui, "completo")
+    try:
+        import bpa_gui
+    except ImportError as e:
+        print(f"Erro: Dependência não encontrada: {e}\nPor favor, instale as dependências: pip install pandas sqlalchemy psycopg2-binary tkcalendar colorama")
+        return
+    bpa_gui.main()
 
 
-            self._log_message(f"Iniciando consulta: Período {data_inicio_val.strftime('%d/%m/%Y')} a {data_fim_val.strftime('%d/%m/%Y')}, Competência {competencia_val}")
-            self._log_message(f"Critério de data selecionado: {criterio_selecionado_gui} (interno: {criterio_interno})")
-            self._log_message(f"Método de deduplicação: {metodo_dedup_gui} (interno: {metodo_dedup_interno})")
-            
-            self._atualizar_config_exporter()
+# --- Montagem dos registros em processos (BPAExporter._construir_registros_em_processos) ---
 
-            self.btn_consultar_dados.config(state="disabled")
-            self.btn_exportar_txt.config(state="disabled")
-            self.btn_exportar_csv.config(state="disabled")
-            self.btn_exportar_xlsx.config(state="disabled")
-            self.root.update_idletasks()
+_contexto_processo_construcao = None # (exporter, competencia, mapeamento_proc, tabela_proc_cid) do processo de trabalho
 
-            registros_processados_sem_numeracao = self.exporter.consultar_dados_completo(
-                data_inicio_val, data_fim_val, competencia_val, criterio_interno
-            )
-            
-            if registros_processados_sem_numeracao:
-                self._log_message(f"Consulta retornou {len(registros_processados_sem_numeracao)} registros processados (antes da deduplicação e numeração).")
-                
-                registros_deduplicados = self.exporter.aplicar_deduplicacao(
-                    registros_processados_sem_numeracao, metodo_dedup_interno
-                )
-                self._log_message(f"Após deduplicação, {len(registros_deduplicados)} registros.")
 
-                self.registros_bpa_processados = self.exporter._atribuir_folha_sequencia_final(registros_deduplicados)
-                
-                num_registros_finais = len(self.registros_bpa_processados)
-                self._log_message(f"{num_registros_finais} registros finais com folha/sequência atribuídas para exportação.")
-                
-                # Calcular e exibir a soma das quantidades e o total de registros
-                total_quantidade_procedimentos = 0
-                if self.registros_bpa_processados: # Verifica se a lista não está vazia
-                    for reg_dict in self.registros_bpa_processados:
-                        try:
-                            total_quantidade_procedimentos += int(reg_dict.get('prd_qt', '0'))
-                        except ValueError:
-                            self._log_message(f"Aviso: Valor inválido para prd_qt em um registro: {reg_dict.get('prd_qt')}")
-                
-                self.lbl_total_registros_valor.config(text=str(num_registros_finais))
-                self.lbl_total_quantidade_valor.config(text=str(total_quantidade_procedimentos))
-                self._log_message(f"Soma total de quantidades (prd_qt) dos procedimentos: {total_quantidade_procedimentos}")
-
-                messagebox.showinfo("Consulta Concluída", f"Consulta finalizada. {num_registros_finais} registros prontos para exportar.")
-                self.btn_exportar_txt.config(state="normal")
-                self.btn_exportar_csv.config(state="normal")
-                self.btn_exportar_xlsx.config(state="normal")
-            else:
-                self._log_message("Nenhum registro encontrado para os filtros aplicados.")
-                messagebox.showwarning("Nenhum Registro", "A consulta não retornou registros.")
-                self.lbl_total_registros_valor.config(text="0")
-                self.lbl_total_quantidade_valor.config(text="0")
+def _iniciar_processo_construcao(classe_exportador, config, competencia, mapeamento_proc, tabela_proc_cid):
+    """Initializer do pool: recebe as tabelas de mapeamento uma única vez por processo."""
+    global _contexto_processo_construcao
+    exporter = classe_exportador()
+    exporter.config.update(config)
+    _contexto_processo_construcao = (exporter, competencia, mapeamento_proc, tabela_proc_cid)
 
-        except Exception as e:
-            self._log_message(f"Erro durante a consulta de dados: {str(e)}")
-            messagebox.showerror("Erro na Consulta", f"Ocorreu um erro: {str(e)}\nVerifique o log para detalhes.")
-            import traceback
-            self._log_message(traceback.format_exc())
-            self.lbl_total_registros_valor.config(text="Erro") # Indicar erro nos labels
-            self.lbl_total_quantidade_valor.config(text="Erro")
-        finally:
-            self.btn_consultar_dados.config(state="normal")
 
-    def exportar_arquivo_txt(self):
-        # ... (código do exportar_arquivo_txt permanece o mesmo) ...
-        if not self.registros_bpa_processados: messagebox.showwarning("Sem Dados", "Não há dados consultados para exportar."); return
-        competencia_val = self.competencia_entry.get()
-        try:
-            mes_num = int(competencia_val[-2:]); extensoes_bpa = ['JAN', ..., 'DEZ']; extensao_sugerida = extensoes_bpa[mes_num - 1] if 0 < mes_num <= 12 else competencia_val[-2:]
-        except: extensao_sugerida = "TXT"
-        cnes_str = self.cnes_entry.get().zfill(7); mes_comp_str = competencia_val[4:6]; ano_comp_ult_dig_str = competencia_val[3:4]
-        nome_arquivo_sugerido = f"PA{cnes_str}{mes_comp_str}{ano_comp_ult_dig_str}"
-        caminho_arquivo_selecionado = filedialog.asksaveasfilename(initialfile=f"{nome_arquivo_sugerido}.{extensao_sugerida}", defaultextension=f".{extensao_sugerida}", filetypes=[(f"Arquivos BPA (.{extensao_sugerida})", f"*.{extensao_sugerida}"), ("Todos os Arquivos", "*.*")], title="Salvar Arquivo BPA-I TXT" )
-        if not caminho_arquivo_selecionado: self._log_message("Exportação TXT cancelada."); return
-        self._log_message(f"Iniciando exportação para TXT: {caminho_arquivo_selecionado}"); self._atualizar_config_exporter()
-        if self.exporter.gerar_arquivo_txt(competencia_val, self.registros_bpa_processados, caminho_arquivo_selecionado):
-            self._log_message(f"Arquivo BPA TXT gerado: {caminho_arquivo_selecionado.replace(os.path.splitext(caminho_arquivo_selecionado)[1], '.'+extensao_sugerida) if '.' not in os.path.basename(caminho_arquivo_selecionado) else caminho_arquivo_selecionado}")
-            messagebox.showinfo("Exportação TXT Concluída", "Arquivo BPA-I TXT gerado com sucesso!")
-        else: self._log_message("Falha ao gerar arquivo BPA TXT."); messagebox.showerror("Erro na Exportação TXT", "Falha ao gerar arquivo TXT.")
-
-
-    def exportar_arquivo_csv(self):
-        # ... (código do exportar_arquivo_csv permanece o mesmo) ...
-        if not self.registros_bpa_processados: messagebox.showwarning("Sem Dados", "Não há dados consultados para exportar."); return
-        caminho_arquivo_selecionado = filedialog.asksaveasfilename(initialfile=f"BPA_export_{self.competencia_entry.get()}.csv", defaultextension=".csv", filetypes=[("Arquivos CSV", "*.csv"), ("Todos os Arquivos", "*.*")], title="Salvar Arquivo CSV")
-        if not caminho_arquivo_selecionado: self._log_message("Exportação CSV cancelada."); return
-        self._log_message(f"Iniciando exportação para CSV: {caminho_arquivo_selecionado}")
-        if self.exporter.gerar_arquivo_csv(self.registros_bpa_processados, caminho_arquivo_selecionado):
-            self._log_message(f"Arquivo CSV gerado: {caminho_arquivo_selecionado}"); messagebox.showinfo("Exportação CSV Concluída", "Arquivo CSV gerado!")
-        else: self._log_message("Falha ao gerar CSV."); messagebox.showerror("Erro na Exportação CSV", "Falha ao gerar arquivo CSV.")
-
-    def exportar_arquivo_xlsx(self):
-        # ... (código do exportar_arquivo_xlsx permanece o mesmo) ...
-        if not self.registros_bpa_processados: messagebox.showwarning("Sem Dados", "Não há dados consultados para exportar."); return
-        caminho_arquivo_selecionado = filedialog.asksaveasfilename(initialfile=f"BPA_export_{self.competencia_entry.get()}.xlsx", defaultextension=".xlsx", filetypes=[("Arquivos Excel", "*.xlsx"), ("Todos os Arquivos", "*.*")], title="Salvar Arquivo Excel (.xlsx)")
-        if not caminho_arquivo_selecionado: self._log_message("Exportação XLSX cancelada."); return
-        self._log_message(f"Iniciando exportação para XLSX: {caminho_arquivo_selecionado}")
-        if self.exporter.gerar_arquivo_xlsx(self.registros_bpa_processados, caminho_arquivo_selecionado):
-            self._log_message(f"Arquivo Excel XLSX gerado: {caminho_arquivo_selecionado}"); messagebox.showinfo("Exportação XLSX Concluída", "Arquivo XLSX gerado!")
-        else: self._log_message("Falha ao gerar XLSX."); messagebox.showerror("Erro na Exportação XLSX", "Falha ao gerar arquivo XLSX.")
+def _construir_bloco_em_processo(registros_bd):
+    """Monta um bloco no processo de trabalho. Retorna (campos, valores de cada registro, mapeamentos faltantes)."""
+    exporter, competencia, mapeamento_proc, tabela_proc_cid = _contexto_processo_construcao
+    exporter.mapeamentos_faltantes_log = set()
+    registros = exporter._construir_registros_em_serie(registros_bd, competencia, mapeamento_proc, tabela_proc_cid)
+    # Tuplas de valores em vez dos objetos: a volta ao processo principal fica bem mais barata de serializar
+    campos = tuple(registros[0].keys())
+    return campos, list(map(operator.attrgetter(*campos), registros)), exporter.mapeamentos_faltantes_log
 
 
-def main():
-    """Função principal para iniciar a GUI."""
-    try:
-        import pandas as pd; import sqlalchemy; import tkcalendar
-    except ImportError as e:
-        print(f"Erro: Dependência não encontrada: {e}\nPor favor, instale as dependências: pip install pandas sqlalchemy psycopg2-binary tkcalendar colorama")
-        return
-    
-    app_root = tk.Tk()
-    gui_app = BPAExporterGUI(app_root)
-    app_root.mainloop()
+def __getattr__(nome):
+    # Compatibilidade: BPAExporterGUI agora fica em bpa_gui (carregado só quando usado)
+    if nome == 'BPAExporterGUI':
+        from bpa_gui import BPAExporterGUI
+        return BPAExporterGUI
+    raise AttributeError(f"module {__name__!r} has no attribute {nome!r}")
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,415 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Interface gráfica (Tk) do exportador BPA-I.
+Fica separada de bpa_exporter para que o uso em linha de comando não carregue tkinter/tkcalendar.
+"""
+
+import os
+import datetime
+import queue
+import threading
+import tkinter as tk
+from tkinter import ttk, filedialog, messagebox
+from tkcalendar import DateEntry
+
+from bpa_exporter import BPAExporter, OperacaoCancelada
+
+
+class BPAExporterGUI:
+    def __init__(self, root_window):
+        self.root = root_window
+        self.root.title("Exportador BPA-I (SIGH Profissional)")
+        self.root.geometry("950x720") # Aumentei um pouco a altura para o novo label
+        self.exporter = BPAExporter()
+        # Consulta e exportação rodam numa thread; o exporter só enfileira mensagens e progresso,
+        # e a fila é esvaziada na thread do Tk por _processar_fila_gui (root.after).
+        self._fila_gui = queue.Queue()
+        self._operacao_em_andamento = False
+        self.exporter.gui_log_callback = self._log_message_async
+        self.exporter.progresso_callback = lambda etapa, feitos, total: self._fila_gui.put(('progresso', etapa, feitos, total))
+
+        
+        style = ttk.Style()
+        style.theme_use('clam') 
+        style.configure("TLabel", padding=3, font=('Helvetica', 10))
+        style.configure("TButton", padding=3, font=('Helvetica', 10))
+        style.configure("TEntry", padding=3, font=('Helvetica', 10))
+        style.configure("TCombobox", padding=3, font=('Helvetica', 10))
+        style.configure("TLabelframe.Label", font=('Helvetica', 10, 'bold'))
+        
+        self.frame_conexao = ttk.LabelFrame(root_window, text="1. Conexão ao Banco de Dados")
+        self.frame_conexao.pack(fill="x", padx=10, pady=5, ipady=5)
+        
+        
+        self.frame_filtros = ttk.LabelFrame(root_window, text="2. Filtros e Deduplicação")
+        self.frame_filtros.pack(fill="x", padx=10, pady=5, ipady=5)
+        
+        self.frame_config = ttk.LabelFrame(root_window, text="3. Configurações do Arquivo BPA-I")
+        self.frame_config.pack(fill="x", padx=10, pady=5, ipady=5)
+        
+        self.frame_acoes = ttk.LabelFrame(root_window, text="4. Ações e Totais") # Nome do frame ajustado
+        self.frame_acoes.pack(fill="x", padx=10, pady=5, ipady=5)
+        
+        self.frame_log = ttk.LabelFrame(root_window, text="Log de Eventos")
+        self.frame_log.pack(fill="both", expand=True, padx=10, pady=5)
+
+        conn_fields = [ ("Banco:", "db_name", "bd0553"), ("Usuário:", "db_user", "postgres"), ("Senha:", "db_password", "postgres", True), ("Host:", "db_host", "localhost"), ("Porta:", "db_port", "5432") ]
+        for i, (label_text, attr_name, default_val, *is_password) in enumerate(conn_fields):
+            row, col_offset = divmod(i, 3)
+            ttk.Label(self.frame_conexao, text=label_text).grid(row=row, column=col_offset*2, padx=5, pady=3, sticky="w")
+            entry = ttk.Entry(self.frame_conexao, width=18)
+            if is_password and is_password[0]: entry.config(show="*")
+            entry.insert(0, default_val); entry.grid(row=row, column=col_offset*2 + 1, padx=5, pady=3, sticky="ew"); setattr(self, attr_name, entry)
+        self.btn_conectar = ttk.Button(self.frame_conexao, text="Conectar ao BD", command=self.conectar_bd)
+        self.btn_conectar.grid(row=len(conn_fields)//3, column=6, padx=10, pady=5, rowspan=max(1, (len(conn_fields)-1)//3 + 1 - (len(conn_fields)//3) ), sticky="ew")
+        ttk.Label(self.frame_filtros, text="Data Início:").grid(row=0, column=0, padx=5, pady=3, sticky="w")
+        self.data_inicio_entry = DateEntry(self.frame_filtros, width=12, date_pattern='dd/mm/yyyy', font=('Helvetica', 10)); self.data_inicio_entry.grid(row=0, column=1, padx=5, pady=3, sticky="ew")
+        ttk.Label(self.frame_filtros, text="Data Fim:").grid(row=0, column=2, padx=5, pady=3, sticky="w")
+        self.data_fim_entry = DateEntry(self.frame_filtros, width=12, date_pattern='dd/mm/yyyy', font=('Helvetica', 10)); self.data_fim_entry.grid(row=0, column=3, padx=5, pady=3, sticky="ew")
+        ttk.Label(self.frame_filtros, text="Competência (AAAAMM):").grid(row=0, column=4, padx=5, pady=3, sticky="w")
+        self.competencia_entry = ttk.Entry(self.frame_filtros, width=10); self.competencia_entry.insert(0, datetime.datetime.now().strftime("%Y%m")); self.competencia_entry.grid(row=0, column=5, padx=5, pady=3, sticky="ew")
+        ttk.Label(self.frame_filtros, text="Critério de Data para Filtro:").grid(row=1, column=0, padx=5, pady=3, sticky="w")
+        self.criterio_data_combo = ttk.Combobox(self.frame_filtros, values=["Data do Lançamento (Recomendado)", "Data da Conta (Início)", "Competência da Conta", "Data do Atendimento (Ficha)"], width=30, state="readonly"); self.criterio_data_combo.current(0); self.criterio_data_combo.grid(row=1, column=1, columnspan=3, padx=5, pady=3, sticky="ew")
+        ttk.Label(self.frame_filtros, text="Deduplicação de Registros:").grid(row=2, column=0, padx=5, pady=3, sticky="w")
+        self.metodo_deduplicacao_combo = ttk.Combobox(self.frame_filtros, values=[
+            "Método Completo (Agrega Qtde por Proc/Pac/etc)", # Descrição ajustada
+            "Método Simples (Agrega Qtde por Proc/Pac/Data)", # Descrição ajustada
+            "Novo: 1 Proc por Pac/Prof/Dia (Qtde=1)",      # Nova opção
+            "SIGH: 1 por Lançamento Original do BD (Qtde=1)", # NOVA OPÇÃO
+            "Sem Deduplicação (Qtde=1)"                       # Descrição ajustada
+        ], width=45, state="readonly") # Aumentado width se necessário
+        self.metodo_deduplicacao_combo.current(0) # Ou o default que você preferir
+        self.metodo_deduplicacao_combo.grid(row=2, column=1, columnspan=3, padx=5, pady=3, sticky="ew")
+        # Cache da consulta (bpa_cache_consulta): repetir a consulta para testar outra deduplicação não volta ao banco
+        self.usar_cache_var = tk.BooleanVar(value=bool(self.exporter.config.get('usar_cache_consultas')))
+        ttk.Checkbutton(self.frame_filtros, text="Reaproveitar consulta anterior (cache)", variable=self.usar_cache_var,
+                        command=self._alternar_cache_consultas).grid(row=1, column=4, columnspan=2, padx=5, pady=3, sticky="w")
+        self.btn_limpar_cache = ttk.Button(self.frame_filtros, text="Limpar cache", command=self.limpar_cache_consultas)
+        self.btn_limpar_cache.grid(row=2, column=4, columnspan=2, padx=5, pady=3, sticky="w")
+
+        bpa_config_fields = [ ("Órgão Responsável:", "orgao_resp_entry", "APAE DE COLINAS DO TOCANTINS", 35), ("Sigla Órgão:", "sigla_orgao_entry", "APAE", 8), ("CNPJ/CPF Estab.:", "cgc_cpf_entry", "25062282000182", 18), ("Órgão Destino:", "orgao_destino_entry", "SECRETARIA MUNICIPAL DE SAUDE", 35), ("Indicador Destino (M/E):", "indicador_destino_combo", ["M", "E"], 5), ("Versão Sistema BPA:", "versao_sistema_entry", "V04.10", 10), ("CNES Estabelecimento:", "cnes_entry", "2560372", 10) ]
+        for i, (label_text, attr_name, default_val, width) in enumerate(bpa_config_fields):
+            row, col_offset = divmod(i, 2)
+            ttk.Label(self.frame_config, text=label_text).grid(row=row, column=col_offset*2, padx=5, pady=3, sticky="w")
+            if isinstance(default_val, list): combo = ttk.Combobox(self.frame_config, values=default_val, width=width, state="readonly"); combo.set(default_val[0]); combo.grid(row=row, column=col_offset*2 + 1, padx=5, pady=3, sticky="ew"); setattr(self, attr_name, combo)
+            else: entry = ttk.Entry(self.frame_config, width=width); entry.insert(0, default_val); entry.grid(row=row, column=col_offset*2 + 1, padx=5, pady=3, sticky="ew"); setattr(self, attr_name, entry)
+        self.btn_consultar_dados = ttk.Button(self.frame_acoes, text="Consultar Dados do BD", command=self.iniciar_consulta_dados, state="disabled")
+        self.btn_consultar_dados.grid(row=0, column=0, padx=10, pady=10, ipady=5, sticky="ew")
+        
+        self.btn_exportar_txt = ttk.Button(self.frame_acoes, text="Exportar Arquivo BPA (.TXT)", command=self.exportar_arquivo_txt, state="disabled")
+        self.btn_exportar_txt.grid(row=0, column=1, padx=10, pady=10, ipady=5, sticky="ew")
+        
+        self.btn_exportar_csv = ttk.Button(self.frame_acoes, text="Exportar para CSV", command=self.exportar_arquivo_csv, state="disabled")
+        self.btn_exportar_csv.grid(row=0, column=2, padx=10, pady=10, ipady=5, sticky="ew")
+        
+        self.btn_exportar_xlsx = ttk.Button(self.frame_acoes, text="Exportar para Excel (.xlsx)", command=self.exportar_arquivo_xlsx, state="disabled")
+        self.btn_exportar_xlsx.grid(row=0, column=3, padx=10, pady=10, ipady=5, sticky="ew")
+
+        # NOVO: Labels para exibir totais
+        ttk.Label(self.frame_acoes, text="Registros BPA-I Finais:").grid(row=1, column=0, padx=(10,0), pady=5, sticky="e")
+        self.lbl_total_registros_valor = ttk.Label(self.frame_acoes, text="0", font=('Helvetica', 10, 'bold'))
+        self.lbl_total_registros_valor.grid(row=1, column=1, padx=(0,10), pady=5, sticky="w")
+        
+        ttk.Label(self.frame_acoes, text="Total de Procedimentos (Qtde):").grid(row=1, column=2, padx=(10,0), pady=5, sticky="e")
+        self.lbl_total_quantidade_valor = ttk.Label(self.frame_acoes, text="0", font=('Helvetica', 10, 'bold'))
+        self.lbl_total_quantidade_valor.grid(row=1, column=3, padx=(0,10), pady=5, sticky="w")
+
+        self.barra_progresso = ttk.Progressbar(self.frame_acoes, orient="horizontal", mode="determinate", maximum=100)
+        self.barra_progresso.grid(row=2, column=0, columnspan=2, padx=10, pady=5, sticky="ew")
+        self.lbl_progresso = ttk.Label(self.frame_acoes, text="")
+        self.lbl_progresso.grid(row=2, column=2, padx=5, pady=5, sticky="w")
+        self.btn_cancelar = ttk.Button(self.frame_acoes, text="Cancelar", command=self.cancelar_operacao, state="disabled")
+        self.btn_cancelar.grid(row=2, column=3, padx=10, pady=5, sticky="ew")
+
+        # Configurar colunas do frame_acoes para expandir igualmente
+        for i_col in range(4): self.frame_acoes.columnconfigure(i_col, weight=1)
+
+        self.log_text_area = tk.Text(self.frame_log, height=10, wrap=tk.WORD, font=('Courier New', 9)); self.log_text_area.pack(side=tk.LEFT, fill="both", expand=True, padx=(0,0))
+        log_scrollbar = ttk.Scrollbar(self.frame_log, orient="vertical", command=self.log_text_area.yview); log_scrollbar.pack(side=tk.RIGHT, fill="y")
+        self.log_text_area.config(yscrollcommand=log_scrollbar.set, state="disabled")
+        self.registros_bpa_processados = []
+        self._log_message("Interface iniciada. Preencha os dados de conexão e clique em 'Conectar'.")
+        self.root.after(100, self._processar_fila_gui)
+
+
+    def _log_message(self, message):
+        self.log_text_area.config(state="normal")
+        timestamp = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        self.log_text_area.insert(tk.END, f"[{timestamp}] {message}\n")
+        self.log_text_area.see(tk.END)
+        self.log_text_area.config(state="disabled")
+
+    def _log_message_async(self, message):
+        """Versão de _log_message que pode ser chamada da thread de trabalho."""
+        self._fila_gui.put(('log', message))
+
+    ETAPAS_PROGRESSO = {'buscados': "Linhas lidas do banco", 'processados': "Registros processados", 'gravados': "Linhas gravadas"}
+
+    def _processar_fila_gui(self):
+        """Esvazia a fila da thread de trabalho (log, progresso e fim da operação) e se reagenda."""
+        ultimo_progresso = None
+        try:
+            while True:
+                item = self._fila_gui.get_nowait()
+                if item[0] == 'log':
+                    self._log_message(item[1])
+                elif item[0] == 'progresso':
+                    ultimo_progresso = item[1:]
+                else:
+                    if ultimo_progresso:
+                        self._mostrar_progresso(*ultimo_progresso)
+                        ultimo_progresso = None
+                    self._finalizar_operacao(*item)
+        except queue.Empty:
+            pass
+        if ultimo_progresso:
+            self._mostrar_progresso(*ultimo_progresso)
+        self.root.after(100, self._processar_fila_gui)
+
+    def _mostrar_progresso(self, etapa, feitos, total):
+        texto = self.ETAPAS_PROGRESSO.get(etapa, etapa)
+        if total:
+            self.barra_progresso.config(mode="determinate")
+            self.barra_progresso['value'] = min(100, 100.0 * feitos / total)
+            self.lbl_progresso.config(text=f"{texto}: {feitos} de {total}")
+        else:
+            self.barra_progresso.config(mode="indeterminate")
+            self.barra_progresso.step(5)
+            self.lbl_progresso.config(text=f"{texto}: {feitos}")
+
+    def _executar_em_segundo_plano(self, descricao, tarefa, ao_concluir, ao_falhar=None):
+        """Roda tarefa() numa thread; ao_concluir(resultado) ou ao_falhar() rodam depois na thread do Tk."""
+        if self._operacao_em_andamento:
+            return
+        self._operacao_em_andamento = True
+        self.exporter.limpar_cancelamento()
+        self.barra_progresso.config(mode="determinate"); self.barra_progresso['value'] = 0
+        self.lbl_progresso.config(text=f"{descricao}...")
+        for botao in (self.btn_conectar, self.btn_consultar_dados, self.btn_exportar_txt, self.btn_exportar_csv, self.btn_exportar_xlsx):
+            botao.config(state="disabled")
+        self.btn_cancelar.config(state="normal")
+
+        def trabalho():
+            try:
+                self._fila_gui.put(('ok', descricao, ao_concluir, ao_falhar, tarefa()))
+            except OperacaoCancelada:
+                self._fila_gui.put(('cancelado', descricao, ao_concluir, ao_falhar, None))
+            except Exception as e:
+                import traceback
+                self._fila_gui.put(('erro', descricao, ao_concluir, ao_falhar, (e, traceback.format_exc())))
+        threading.Thread(target=trabalho, name=f"bpa-{descricao}", daemon=True).start()
+
+    def _finalizar_operacao(self, situacao, descricao, ao_concluir, ao_falhar, resultado):
+        self._operacao_em_andamento = False
+        self.btn_cancelar.config(state="disabled")
+        self.btn_conectar.config(state="normal")
+        self.btn_consultar_dados.config(state="normal" if self.exporter.engine is not None else "disabled")
+        estado_exportacao = "normal" if self.registros_bpa_processados else "disabled"
+        for botao in (self.btn_exportar_txt, self.btn_exportar_csv, self.btn_exportar_xlsx):
+            botao.config(state=estado_exportacao)
+        if situacao == 'ok':
+            self.lbl_progresso.config(text=f"{descricao}: concluído")
+            ao_concluir(resultado)
+            return
+        self.barra_progresso.config(mode="determinate"); self.barra_progresso['value'] = 0
+        if situacao == 'cancelado':
+            self.lbl_progresso.config(text=f"{descricao}: cancelado")
+            self._log_message(f"{descricao}: operação cancelada pelo usuário.")
+        else:
+            erro, detalhes = resultado
+            self.lbl_progresso.config(text=f"{descricao}: erro")
+            self._log_message(f"Erro durante {descricao.lower()}: {str(erro)}")
+            self._log_message(detalhes)
+            messagebox.showerror("Erro", f"Ocorreu um erro: {str(erro)}\nVerifique o log para detalhes.")
+        if ao_falhar:
+            ao_falhar()
+
+    def cancelar_operacao(self):
+        if self._operacao_em_andamento:
+            self._log_message("Cancelando a operação (a consulta no servidor será interrompida)...")
+            self.btn_cancelar.config(state="disabled")
+            self.exporter.cancelar()
+
+    def conectar_bd(self):
+        try:
+            db_params = { "db_name": self.db_name.get(), "user": self.db_user.get(), "password": self.db_password.get(), "host": self.db_host.get(), "port": self.db_port.get() }
+            self._log_message(f"Tentando conectar ao banco: {db_params['db_name']}@{db_params['host']}...")
+            if self.exporter.conectar_bd(**db_params):
+                self._log_message("Conexão com o banco de dados estabelecida com sucesso!")
+                messagebox.showinfo("Conexão Bem-Sucedida", "Conexão ao banco de dados estabelecida!")
+                self.btn_consultar_dados.config(state="normal")
+            else:
+                self._log_message("Falha ao conectar ao banco. Verifique as credenciais e o console.")
+                messagebox.showerror("Erro de Conexão", "Não foi possível conectar ao banco de dados. Verifique o log.")
+        except Exception as e:
+            self._log_message(f"Erro inesperado durante a conexão: {str(e)}")
+            messagebox.showerror("Erro Crítico", f"Ocorreu um erro crítico ao tentar conectar: {str(e)}")
+
+    def _alternar_cache_consultas(self):
+        self.exporter.config['usar_cache_consultas'] = self.usar_cache_var.get()
+        if self.usar_cache_var.get():
+            self._log_message("Cache de consultas ativado. Só lançamentos novos invalidam o resultado guardado: após "
+                              "corrigir lançamentos, pacientes, contas ou endereços no SIGH, use 'Limpar cache'.")
+        else:
+            self._log_message("Cache de consultas desativado: cada consulta vai ao banco.")
+
+    def limpar_cache_consultas(self):
+        removidas = self.exporter.limpar_cache_consultas()
+        self._log_message(f"Cache de consultas limpo ({removidas} entradas removidas).")
+
+    def _atualizar_config_exporter(self):
+        self.exporter.config['usar_cache_consultas'] = self.usar_cache_var.get()
+        self.exporter.config['orgao_responsavel'] = self.orgao_resp_entry.get()
+        self.exporter.config['sigla_orgao'] = self.sigla_orgao_entry.get()
+        self.exporter.config['cgc_cpf'] = self.cgc_cpf_entry.get()
+        self.exporter.config['orgao_destino'] = self.orgao_destino_entry.get()
+        self.exporter.config['indicador_destino'] = self.indicador_destino_combo.get()
+        self.exporter.config['versao_sistema'] = self.versao_sistema_entry.get()
+        self.exporter.config['cnes'] = self.cnes_entry.get()
+        self.exporter.config['default_ibge_paciente'] = self.exporter.config.get('default_ibge_paciente', '000000')
+        self.exporter.config['default_cep_paciente'] = self.exporter.config.get('default_cep_paciente', '00000000')
+        self.exporter.config['default_ine'] = self.exporter.config.get('default_ine', '0000000000')
+
+    def iniciar_consulta_dados(self):
+        """Handler para o botão de consultar dados: valida os filtros e roda a consulta em segundo plano."""
+        data_inicio_val = self.data_inicio_entry.get_date()
+        data_fim_val = self.data_fim_entry.get_date()
+        competencia_val = self.competencia_entry.get()
+
+        if not competencia_val or len(competencia_val) != 6 or not competencia_val.isdigit():
+            messagebox.showerror("Entrada Inválida", "Competência deve estar no formato AAAAMM (ex: 202305).")
+            self.lbl_total_registros_valor.config(text="0") # Reset em caso de erro de entrada
+            self.lbl_total_quantidade_valor.config(text="0")
+            return
+
+        criterio_selecionado_gui = self.criterio_data_combo.get()
+        map_criterio_gui_interno = {
+            "Data do Lançamento (Recomendado)": "lancamento",
+            "Data da Conta (Início)": "conta",
+            "Competência da Conta": "competencia",
+            "Data do Atendimento (Ficha)": "atendimento"
+        }
+        criterio_interno = map_criterio_gui_interno.get(criterio_selecionado_gui, "atendimento")
+        
+        metodo_dedup_gui = self.metodo_deduplicacao_combo.get()
+        map_dedup_gui_interno = {
+            "Método Completo (Agrega Qtde por Proc/Pac/etc)": "completo",
+            "Método Simples (Agrega Qtde por Proc/Pac/Data)": "simples",
+            "Novo: 1 Proc por Pac/Prof/Dia (Qtde=1)": "novo_manter_primeiro",
+            "SIGH: 1 por Lançamento Original do BD (Qtde=1)": "por_id_lancamento", # <<< CORRIGIDO
+            "Sem Deduplicação (Qtde=1)": "nenhum"
+        }
+        metodo_dedup_interno = map_dedup_gui_interno.get(metodo_dedup_gui, "completo")
+
+        # Resetar labels de totais no início da consulta
+        self.lbl_total_registros_valor.config(text="Calculando...")
+        self.lbl_total_quantidade_valor.config(text="Calculando...")
+        self._log_message(f"Iniciando consulta: Período {data_inicio_val.strftime('%d/%m/%Y')} a {data_fim_val.strftime('%d/%m/%Y')}, Competência {competencia_val}")
+        self._log_message(f"Critério de data selecionado: {criterio_selecionado_gui} (interno: {criterio_interno})")
+        self._log_message(f"Método de deduplicação: {metodo_dedup_gui} (interno: {metodo_dedup_interno})")
+        
+        self._atualizar_config_exporter()
+        self.registros_bpa_processados = []
+
+        def consultar():
+            # Roda na thread de trabalho: não tocar em widgets aqui, só em _log_message_async.
+            registros_processados_sem_numeracao = self.exporter.consultar_dados_completo(
+                data_inicio_val, data_fim_val, competencia_val, criterio_interno
+            )
+            if not registros_processados_sem_numeracao:
+                return [], 0
+            self._log_message_async(f"Consulta retornou {len(registros_processados_sem_numeracao)} registros processados (antes da deduplicação e numeração).")
+            registros_deduplicados = self.exporter.aplicar_deduplicacao(
+                registros_processados_sem_numeracao, metodo_dedup_interno
+            )
+            self._log_message_async(f"Após deduplicação, {len(registros_deduplicados)} registros.")
+            registros_finais = self.exporter._atribuir_folha_sequencia_final(registros_deduplicados)
+
+            # Calcular a soma das quantidades
+            total_quantidade_procedimentos = 0
+            for reg_dict in registros_finais:
+                try:
+                    total_quantidade_procedimentos += int(reg_dict.get('prd_qt', '0'))
+                except ValueError:
+                    self._log_message_async(f"Aviso: Valor inválido para prd_qt em um registro: {reg_dict.get('prd_qt')}")
+            return registros_finais, total_quantidade_procedimentos
+
+        def concluir(resultado):
+            registros_finais, total_quantidade_procedimentos = resultado
+            if not registros_finais:
+                self._log_message("Nenhum registro encontrado para os filtros aplicados.")
+                messagebox.showwarning("Nenhum Registro", "A consulta não retornou registros.")
+                self.lbl_total_registros_valor.config(text="0")
+                self.lbl_total_quantidade_valor.config(text="0")
+                return
+            self.registros_bpa_processados = registros_finais
+            num_registros_finais = len(registros_finais)
+            self._log_message(f"{num_registros_finais} registros finais com folha/sequência atribuídas para exportação.")
+            self.lbl_total_registros_valor.config(text=str(num_registros_finais))
+            self.lbl_total_quantidade_valor.config(text=str(total_quantidade_procedimentos))
+            self._log_message(f"Soma total de quantidades (prd_qt) dos procedimentos: {total_quantidade_procedimentos}")
+            for botao in (self.btn_exportar_txt, self.btn_exportar_csv, self.btn_exportar_xlsx):
+                botao.config(state="normal")
+            messagebox.showinfo("Consulta Concluída", f"Consulta finalizada. {num_registros_finais} registros prontos para exportar.")
+
+        def falhar():
+            self.lbl_total_registros_valor.config(text="Erro") # Indicar erro nos labels
+            self.lbl_total_quantidade_valor.config(text="Erro")
+
+        self._executar_em_segundo_plano("Consulta", consultar, concluir, falhar)
+
+    def exportar_arquivo_txt(self):
+        # ... (código do exportar_arquivo_txt permanece o mesmo) ...
+        if not self.registros_bpa_processados: messagebox.showwarning("Sem Dados", "Não há dados consultados para exportar."); return
+        competencia_val = self.competencia_entry.get()
+        try:
+            extensao_sugerida = os.path.splitext(self.exporter._caminho_arquivo_bpa(competencia_val, "PA"))[1][1:]
+        except ValueError: extensao_sugerida = "TXT"
+        cnes_str = self.cnes_entry.get().zfill(7); mes_comp_str = competencia_val[4:6]; ano_comp_ult_dig_str = competencia_val[3:4]
+        nome_arquivo_sugerido = f"PA{cnes_str}{mes_comp_str}{ano_comp_ult_dig_str}"
+        caminho_arquivo_selecionado = filedialog.asksaveasfilename(initialfile=f"{nome_arquivo_sugerido}.{extensao_sugerida}", defaultextension=f".{extensao_sugerida}", filetypes=[(f"Arquivos BPA (.{extensao_sugerida})", f"*.{extensao_sugerida}"), ("Todos os Arquivos", "*.*")], title="Salvar Arquivo BPA-I TXT" )
+        if not caminho_arquivo_selecionado: self._log_message("Exportação TXT cancelada."); return
+        self._log_message(f"Iniciando exportação para TXT: {caminho_arquivo_selecionado}"); self._atualizar_config_exporter()
+        registros = self.registros_bpa_processados
+        def concluir(gerado):
+            if gerado:
+                self._log_message(f"Arquivo BPA TXT gerado: {self.exporter._caminho_arquivo_bpa(competencia_val, caminho_arquivo_selecionado)}")
+                messagebox.showinfo("Exportação TXT Concluída", "Arquivo BPA-I TXT gerado com sucesso!")
+            else: self._log_message("Falha ao gerar arquivo BPA TXT."); messagebox.showerror("Erro na Exportação TXT", "Falha ao gerar arquivo TXT.")
+        self._executar_em_segundo_plano("Exportação TXT", lambda: self.exporter.gerar_arquivo_txt(competencia_val, registros, caminho_arquivo_selecionado), concluir)
+
+
+    def exportar_arquivo_csv(self):
+        # ... (código do exportar_arquivo_csv permanece o mesmo) ...
+        if not self.registros_bpa_processados: messagebox.showwarning("Sem Dados", "Não há dados consultados para exportar."); return
+        caminho_arquivo_selecionado = filedialog.asksaveasfilename(initialfile=f"BPA_export_{self.competencia_entry.get()}.csv", defaultextension=".csv", filetypes=[("Arquivos CSV", "*.csv"), ("Todos os Arquivos", "*.*")], title="Salvar Arquivo CSV")
+        if not caminho_arquivo_selecionado: self._log_message("Exportação CSV cancelada."); return
+        self._log_message(f"Iniciando exportação para CSV: {caminho_arquivo_selecionado}")
+        registros = self.registros_bpa_processados
+        def concluir(gerado):
+            if gerado: self._log_message(f"Arquivo CSV gerado: {caminho_arquivo_selecionado}"); messagebox.showinfo("Exportação CSV Concluída", "Arquivo CSV gerado!")
+            else: self._log_message("Falha ao gerar CSV."); messagebox.showerror("Erro na Exportação CSV", "Falha ao gerar arquivo CSV.")
+        self._executar_em_segundo_plano("Exportação CSV", lambda: self.exporter.gerar_arquivo_csv(registros, caminho_arquivo_selecionado), concluir)
+
+    def exportar_arquivo_xlsx(self):
+        # ... (código do exportar_arquivo_xlsx permanece o mesmo) ...
+        if not self.registros_bpa_processados: messagebox.showwarning("Sem Dados", "Não há dados consultados para exportar."); return
+        caminho_arquivo_selecionado = filedialog.asksaveasfilename(initialfile=f"BPA_export_{self.competencia_entry.get()}.xlsx", defaultextension=".xlsx", filetypes=[("Arquivos Excel", "*.xlsx"), ("Todos os Arquivos", "*.*")], title="Salvar Arquivo Excel (.xlsx)")
+        if not caminho_arquivo_selecionado: self._log_message("Exportação XLSX cancelada."); return
+        self._log_message(f"Iniciando exportação para XLSX: {caminho_arquivo_selecionado}")
+        registros = self.registros_bpa_processados
+        def concluir(gerado):
+            if gerado: self._log_message(f"Arquivo Excel XLSX gerado: {caminho_arquivo_selecionado}"); messagebox.showinfo("Exportação XLSX Concluída", "Arquivo XLSX gerado!")
+            else: self._log_message("Falha ao gerar XLSX."); messagebox.showerror("Erro na Exportação XLSX", "Falha ao gerar arquivo XLSX.")
+        self._executar_em_segundo_plano("Exportação XLSX", lambda: self.exporter.gerar_arquivo_xlsx(registros, caminho_arquivo_selecionado), concluir)
+
+
+def main():
+    """Inicia a GUI."""
+    app_root = tk.Tk()
+    gui_app = BPAExporterGUI(app_root)
+    app_root.mainloop()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,141 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Estado da exportação incremental do BPA-I.
+Cada escopo (competência, critério, período e CNES) tem um SQLite local com a assinatura de cada
+lançamento da última extração (md5 da linha completa da consulta, com paciente, conta, ficha,
+endereço, profissional e código do procedimento), as linhas já montadas (o registro BPA-I de cada
+lançamento, antes da deduplicação, com a chave de ordenação da consulta) e a numeração final de cada
+profissional. A execução seguinte lê só (id_lancamento, assinatura) do período, busca por completo os
+lançamentos novos ou com assinatura diferente, descarta os que saíram do período e renumera apenas os
+profissionais cuja lista final mudou.
+Se a assinatura da configuração (de-paras, tabela de procedimentos e opções que entram no registro)
+mudar, o estado é descartado e a extração volta a ser completa.
+"""
+
+import os
+import json
+import time
+import pickle
+import sqlite3
+import hashlib
+import operator
+
+from bpa_registro import CAMPOS_SEM_NUMERACAO, RegistroBPAI
+from bpa_numeracao import profissional
+
+VERSAO_FORMATO = 2
+
+# Lançamentos buscados por completo (novos ou alterados desde a execução anterior)
+SQL_FILTRO_ALTERADOS = "l.id_lancamento = ANY(:ids_alterados)"
+
+
+def diretorio_padrao():
+    base = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(base, 'cer4exporter', 'incremental')
+
+
+def assinatura(*partes):
+    """sha256 das partes que determinam o conteúdo dos registros (serializadas em JSON ordenado)."""
+    conteudo = json.dumps(partes, sort_keys=True, default=str, ensure_ascii=False)
+    return hashlib.sha256(conteudo.encode('utf-8')).hexdigest()
+
+
+def filtro_alterados(ids):
+    """(condição SQL, params) dos lançamentos a buscar por completo, para _montar_consulta_completa."""
+    return SQL_FILTRO_ALTERADOS, {"ids_alterados": sorted(ids)}
+
+
+class EstadoIncremental:
+    """SQLite do escopo: tabelas estado (chave/valor), assinaturas, linhas e numeracao.
+
+    As alterações ficam numa única transação, publicada em gravar(); se a execução falhar antes disso,
+    fechar() descarta tudo e o estado anterior continua valendo.
+    """
+
+    # Campos gravados de cada registro: as linhas são guardadas antes da numeração
+    CAMPOS_GRAVADOS = CAMPOS_SEM_NUMERACAO
+
+    def __init__(self, escopo, assinatura_atual, diretorio=None):
+        diretorio = diretorio or diretorio_padrao()
+        # As linhas têm dados de pacientes: diretório só do usuário
+        os.makedirs(diretorio, mode=0o700, exist_ok=True)
+        nome = hashlib.sha256(escopo.encode('utf-8')).hexdigest()[:16]
+        self.caminho = os.path.join(diretorio, f"incremental_{nome}.sqlite")
+        self.conn = sqlite3.connect(self.caminho)
+        self.conn.executescript("""
+            CREATE TABLE IF NOT EXISTS estado (chave TEXT PRIMARY KEY, valor TEXT);
+            CREATE TABLE IF NOT EXISTS assinaturas (id_lancamento INTEGER PRIMARY KEY, assinatura TEXT);
+            CREATE TABLE IF NOT EXISTS linhas (id_lancamento INTEGER, chave BLOB, registro BLOB);
+            CREATE INDEX IF NOT EXISTS ix_linhas_id ON linhas (id_lancamento);
+            CREATE TABLE IF NOT EXISTS numeracao (posicao INTEGER PRIMARY KEY, profissional TEXT,
+                                                  id_lancamento INTEGER, prd_qt INTEGER, prd_flh TEXT, prd_seq TEXT);
+        """)
+        self._valores = operator.attrgetter(*self.CAMPOS_GRAVADOS)
+        self.escopo = escopo
+        self.assinatura = assinatura_atual
+        estado = dict(self.conn.execute("SELECT chave, valor FROM estado"))
+        self.valido = (estado.get('versao') == str(VERSAO_FORMATO) and estado.get('assinatura') == assinatura_atual
+                       and 'atualizado_em' in estado)
+        if estado and not self.valido:
+            print("Estado incremental de outra configuração (de-paras, procedimentos ou versão): extração completa.")
+            self.descartar()
+
+    def descartar(self):
+        """Esquece as assinaturas, as linhas e a numeração (a próxima gravação é de uma extração completa)."""
+        self.conn.execute("DELETE FROM estado")
+        self.conn.execute("DELETE FROM assinaturas")
+        self.conn.execute("DELETE FROM linhas")
+        self.conn.execute("DELETE FROM numeracao")
+        self.valido = False
+
+    def assinaturas_linhas(self):
+        """{id_lancamento: assinatura} da última extração ({} se o estado não vale)."""
+        if not self.valido:
+            return {}
+        return dict(self.conn.execute("SELECT id_lancamento, assinatura FROM assinaturas"))
+
+    def remover(self, ids):
+        """Apaga as linhas dos lançamentos (alterados, a buscar de novo, ou que saíram dos filtros)."""
+        self.conn.executemany("DELETE FROM linhas WHERE id_lancamento = ?", ((i,) for i in ids))
+
+    def adicionar(self, chaves, registros):
+        """Grava as linhas novas: chave de ordenação da consulta e registro BPA-I (sem folha/sequência)."""
+        self.conn.executemany(
+            "INSERT INTO linhas (id_lancamento, chave, registro) VALUES (?, ?, ?)",
+            ((registro._id_lancamento_original, pickle.dumps(chave, pickle.HIGHEST_PROTOCOL),
+              pickle.dumps(self._valores(registro), pickle.HIGHEST_PROTOCOL))
+             for chave, registro in zip(chaves, registros)))
+
+    def linhas(self):
+        """[(chave, registro)] de todas as linhas guardadas, na ordem de gravação."""
+        dados = self.conn.execute("SELECT chave, registro FROM linhas ORDER BY rowid").fetchall()
+        registros = RegistroBPAI.de_linhas(self.CAMPOS_GRAVADOS, [pickle.loads(registro) for _, registro in dados])
+        return [(pickle.loads(chave), registro) for (chave, _), registro in zip(dados, registros)]
+
+    def numeracao_anterior(self):
+        """{profissional: [(id_lancamento, prd_qt, prd_flh, prd_seq), ...]} da última exportação, em ordem."""
+        anterior = {}
+        for cns, id_lancamento, qt, flh, seq in self.conn.execute(
+                "SELECT profissional, id_lancamento, prd_qt, prd_flh, prd_seq FROM numeracao ORDER BY posicao"):
+            anterior.setdefault(cns, []).append((id_lancamento, qt, flh, seq))
+        return anterior
+
+    def gravar(self, assinaturas_linhas, registros_numerados):
+        """Publica as assinaturas dos lançamentos e a numeração final; confirma a transação."""
+        self.conn.execute("DELETE FROM assinaturas")
+        self.conn.executemany("INSERT INTO assinaturas (id_lancamento, assinatura) VALUES (?, ?)",
+                              assinaturas_linhas.items())
+        self.conn.execute("DELETE FROM numeracao")
+        self.conn.executemany(
+            "INSERT INTO numeracao (profissional, id_lancamento, prd_qt, prd_flh, prd_seq) VALUES (?, ?, ?, ?, ?)",
+            ((profissional(r), r._id_lancamento_original, r.prd_qt, r.prd_flh, r.prd_seq) for r in registros_numerados))
+        self.conn.executemany("INSERT OR REPLACE INTO estado (chave, valor) VALUES (?, ?)", [
+            ('versao', str(VERSAO_FORMATO)), ('escopo', self.escopo), ('assinatura', self.assinatura),
+            ('atualizado_em', str(time.time())),
+        ])
+        self.conn.commit()
+        self.valido = True
+
+    def fechar(self):
+        self.conn.close()
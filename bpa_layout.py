@@ -0,0 +1,140 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Layout do arquivo BPA-I (cabeçalho e registro individualizado), definido uma única vez.
+O exportador gera daqui o codificador das linhas; o validador, as posições, as fatias de leitura
+e as expressões regulares já compiladas.
+"""
+
+import re
+import operator
+
+TAMANHO_LINHA_BPA = 350
+
+# (campo, largura, lado do preenchimento, caractere de preenchimento, regras de validação)
+HEADER_LAYOUT = (
+    ('cbc_hdr_1', 2, 'direita', ' ', {'tipo': 'NUM', 'valor': '01', 'obrigatorio': True}),
+    ('cbc_hdr_2', 5, 'direita', ' ', {'tipo': 'ALFA', 'valor': '#BPA#', 'obrigatorio': True}),
+    ('cbc_mvm', 6, 'direita', ' ', {'tipo': 'NUM', 'pattern': r'^\d{6}$', 'obrigatorio': True}), # Competência AAAAMM
+    ('cbc_lin', 6, 'esquerda', '0', {'tipo': 'NUM', 'pattern': r'^\d{6}$', 'obrigatorio': True}), # Qtd Linhas
+    ('cbc_flh', 6, 'esquerda', '0', {'tipo': 'NUM', 'pattern': r'^\d{6}$', 'obrigatorio': True}), # Qtd Folhas
+    ('cbc_smt_vrf', 4, 'esquerda', '0', {'tipo': 'NUM', 'pattern': r'^\d{4}$', 'obrigatorio': True}), # Campo de controle
+    ('cbc_rsp', 30, 'direita', ' ', {'tipo': 'ALFA', 'tamanho': 30, 'obrigatorio': True}), # Nome do Responsável
+    ('cbc_sgl', 6, 'direita', ' ', {'tipo': 'ALFA', 'tamanho': 6, 'obrigatorio': True}), # Sigla do Órgão
+    ('cbc_cgccpf', 14, 'esquerda', '0', {'tipo': 'NUM', 'pattern': r'^\d{14}$', 'obrigatorio': True}), # CGC/CPF
+    ('cbc_dst', 40, 'direita', ' ', {'tipo': 'ALFA', 'tamanho': 40, 'obrigatorio': True}), # Órgão Destino
+    ('cbc_dst_in', 1, 'direita', ' ', {'tipo': 'ALFA', 'valores': ['M', 'E'], 'obrigatorio': True}), # Indicador Destino (M-Municipal, E-Estadual)
+    ('cbc_versao', 10, 'direita', ' ', {'tipo': 'ALFA', 'tamanho': 10, 'obrigatorio': True}), # Versão do Sistema
+)
+
+REGISTRO_BPA_I_LAYOUT = (
+    ('prd_ident', 2, 'direita', ' ', {'tipo': 'NUM', 'valor': '03', 'obrigatorio': True}),
+    ('prd_cnes', 7, 'direita', ' ', {'tipo': 'NUM', 'pattern': r'^\d{7}$', 'obrigatorio': True}),
+    ('prd_cmp', 6, 'direita', ' ', {'tipo': 'NUM', 'pattern': r'^\d{6}$', 'obrigatorio': True}), # Competência AAAAMM
+    ('prd_cnsmed', 15, 'direita', ' ', {'tipo': 'NUM', 'pattern': r'^\d{15}$', 'obrigatorio': True}), # CNS do Profissional
+    ('prd_cbo', 6, 'direita', ' ', {'tipo': 'ALFA', 'tamanho': 6, 'pattern': r'^[A-Z0-9]{6}$', 'obrigatorio': True}), # CBO (pode ser alfanumérico)
+    ('prd_dtaten', 8, 'direita', ' ', {'tipo': 'NUM', 'pattern': r'^\d{8}$', 'obrigatorio': True}), # Data Atendimento AAAAMMDD
+    ('prd_flh', 3, 'esquerda', '0', {'tipo': 'NUM', 'pattern': r'^\d{3}$', 'obrigatorio': True}), # Folha
+    ('prd_seq', 2, 'esquerda', '0', {'tipo': 'NUM', 'pattern': r'^\d{2}$', 'obrigatorio': True}), # Sequência na Folha
+    ('prd_pa', 10, 'direita', ' ', {'tipo': 'NUM', 'pattern': r'^\d{10}$', 'obrigatorio': True}), # Procedimento Ambulatorial
+    ('prd_cnspac', 15, 'direita', ' ', {'tipo': 'NUM', 'pattern': r'^\d{15}$', 'obrigatorio': False}), # CNS do Paciente
+    ('prd_sexo', 1, 'direita', ' ', {'tipo': 'ALFA', 'valores': ['M', 'F', 'I'], 'obrigatorio': True}), # Sexo (M/F/I - Ignorado)
+    ('prd_ibge', 6, 'direita', ' ', {'tipo': 'NUM', 'pattern': r'^\d{6}$', 'obrigatorio': True}), # Código IBGE Município Residência
+    ('prd_cid', 4, 'direita', ' ', {'tipo': 'ALFA', 'tamanho': 4, 'pattern': r'^[A-Z0-9]{3,4}$', 'obrigatorio': True}), # CID (pode ser 3 ou 4 chars)
+    ('prd_ldade', 3, 'esquerda', '0', {'tipo': 'NUM', 'pattern': r'^\d{3}$', 'obrigatorio': True}), # Idade
+    ('prd_qt', 6, 'esquerda', '0', {'tipo': 'NUM', 'pattern': r'^\d{6}$', 'obrigatorio': True}), # Quantidade
+    ('prd_caten', 2, 'direita', ' ', {'tipo': 'NUM', 'pattern': r'^\d{2}$', 'obrigatorio': False}), # Caráter Atendimento
+    ('prd_naut', 13, 'direita', ' ', {'tipo': 'NUM', 'pattern': r'^\d{13}$', 'obrigatorio': False}), # Número Autorização
+    ('prd_org', 3, 'direita', ' ', {'tipo': 'ALFA', 'valor': 'BPA', 'obrigatorio': True}), # Origem - aqui fixo BPA
+    ('prd_nmpac', 30, 'direita', ' ', {'tipo': 'ALFA', 'tamanho': 30, 'obrigatorio': True}), # Nome Paciente
+    ('prd_dtnasc', 8, 'direita', ' ', {'tipo': 'NUM', 'pattern': r'^\d{8}$', 'obrigatorio': True}), # Data Nascimento AAAAMMDD
+    ('prd_raca', 2, 'direita', ' ', {'tipo': 'NUM', 'pattern': r'^\d{2}$', 'obrigatorio': True}), # Raça/Cor
+    ('prd_etnia', 4, 'direita', ' ', {'tipo': 'NUM', 'pattern': r'^\d{4}$', 'obrigatorio': False}), # Etnia Indígena
+    ('prd_nac', 3, 'direita', ' ', {'tipo': 'NUM', 'pattern': r'^\d{3}$', 'obrigatorio': False}), # Nacionalidade
+    ('prd_srv', 3, 'direita', ' ', {'tipo': 'NUM', 'pattern': r'^\d{3}$', 'obrigatorio': False}), # Código Serviço
+    ('prd_clf', 3, 'direita', ' ', {'tipo': 'NUM', 'pattern': r'^\d{3}$', 'obrigatorio': False}), # Classificação do Serviço
+    ('prd_equipe_Seq', 8, 'direita', ' ', {'tipo': 'NUM', 'pattern': r'^\d{8}$', 'obrigatorio': False}), # Sequencial da Equipe
+    ('prd_equipe_Area', 4, 'direita', ' ', {'tipo': 'NUM', 'pattern': r'^\d{4}$', 'obrigatorio': False}), # Área da Equipe
+    ('prd_cnpj', 14, 'direita', ' ', {'tipo': 'NUM', 'pattern': r'^\d{14}$', 'obrigatorio': False}), # CNPJ do Estabelecimento
+    ('prd_cep_pcnte', 8, 'direita', ' ', {'tipo': 'NUM', 'pattern': r'^\d{8}$', 'obrigatorio': False}),
+    ('prd_lograd_pcnte', 3, 'direita', ' ', {'tipo': 'NUM', 'pattern': r'^\d{3}$', 'obrigatorio': False}),
+    ('prd_end_pcnte', 30, 'direita', ' ', {'tipo': 'ALFA', 'tamanho': 30, 'obrigatorio': False}),
+    ('prd_compl_pcnte', 10, 'direita', ' ', {'tipo': 'ALFA', 'tamanho': 10, 'obrigatorio': False}),
+    ('prd_num_pcnte', 5, 'direita', ' ', {'tipo': 'ALFA', 'tamanho': 5, 'obrigatorio': False}), # Pode ser S/N
+    ('prd_bairro_pcnte', 30, 'direita', ' ', {'tipo': 'ALFA', 'tamanho': 30, 'obrigatorio': False}),
+    ('prd_ddtel_pcnte', 11, 'direita', ' ', {'tipo': 'NUM', 'pattern': r'^\d{10,11}$', 'obrigatorio': False}), # 10 ou 11 dígitos
+    ('prd_email_pcnte', 40, 'direita', ' ', {'tipo': 'ALFA', 'tamanho': 40, 'obrigatorio': False}),
+    ('prd_ine', 10, 'direita', ' ', {'tipo': 'NUM', 'pattern': r'^\d{10}$', 'obrigatorio': True}), # INE do profissional
+    ('prd_cpf_pcnte', 11, 'direita', ' ', {'tipo': 'NUM', 'pattern': r'^\d{11}$', 'obrigatorio': False}),
+    ('prd_situacao_rua', 1, 'direita', ' ', {'tipo': 'ALFA', 'valores': ['S', 'N'], 'obrigatorio': False}),
+)
+
+# Valores usados pelo codificador quando o campo não existe no registro (os demais: caractere de preenchimento)
+PADROES_REGISTRO_BPA_I = {'prd_ident': '03'}
+
+CAMPOS_HEADER = tuple(campo for campo, _, _, _, _ in HEADER_LAYOUT)
+CAMPOS_REGISTRO_BPA_I = tuple(campo for campo, _, _, _, _ in REGISTRO_BPA_I_LAYOUT)
+
+
+def posicoes(layout):
+    """{campo: {'inicio', 'fim' (1-based, inclusivos), 'regex' (pattern compilado), regras...}}, na ordem do layout."""
+    resultado = {}
+    inicio = 1
+    for campo, largura, _, _, regras in layout:
+        config = {'inicio': inicio, 'fim': inicio + largura - 1, **regras}
+        if 'pattern' in regras:
+            config['regex'] = re.compile(regras['pattern'])
+        resultado[campo] = config
+        inicio += largura
+    return resultado
+
+
+def fatias(layout):
+    """slice de cada campo na linha (0-based), na ordem do layout."""
+    return tuple(slice(config['inicio'] - 1, config['fim']) for config in posicoes(layout).values())
+
+
+def compilar_decodificador(layout):
+    """Função linha -> tupla com o texto bruto de cada campo (uma única chamada de itemgetter)."""
+    return operator.itemgetter(*fatias(layout))
+
+
+def compilar_codificador(layout, tamanho_linha, padroes=None):
+    """Gera, uma única vez, a função registro -> linha de largura fixa para o layout dado.
+
+    Os valores são lidos de uma vez por attrgetter (RegistroBPAI completo) ou, se faltar algum
+    campo ou o registro for um dict, por registro.get com os valores padrão do layout.
+    Campos alinhados à esquerda com espaço viram um "%-Ns" de uma única string de formatação;
+    preenchimento com '0' à esquerda usa zfill (mesmo tratamento de sinal do formato original).
+    Como no formato original, um valor maior que a largura não é cortado; só a linha é truncada.
+    """
+    padroes = padroes or {}
+    formato, expressoes, leituras = [], [], []
+    for indice, (campo, largura, lado, caractere, _) in enumerate(layout):
+        leituras.append(f"g({campo!r}, {padroes.get(campo, caractere * largura)!r})")
+        valor = f"v[{indice}]"
+        if lado == 'direita' and caractere == ' ':
+            formato.append(f"%-{largura}s")
+            expressoes.append(valor)
+        else:
+            formato.append("%s")
+            if lado == 'esquerda' and caractere == '0':
+                expressoes.append(f"_str({valor}).zfill({largura})")
+            elif lado == 'esquerda':
+                expressoes.append(f"_str({valor}).rjust({largura}, {caractere!r})")
+            else:
+                expressoes.append(f"_str({valor}).ljust({largura}, {caractere!r})")
+    ajuste = f"[:{tamanho_linha}]"
+    if sum(largura for _, largura, _, _, _ in layout) < tamanho_linha:
+        ajuste = f".ljust({tamanho_linha}){ajuste}"
+    fonte = ("def codificar(registro, _str=str, _formato=_formato, _atributos=_atributos):\n"
+             "    try:\n"
+             "        v = _atributos(registro)\n"
+             "    except AttributeError:\n"
+             "        g = registro.get\n"
+             f"        v = ({', '.join(leituras)},)\n"
+             f"    return (_formato % ({', '.join(expressoes)},)){ajuste}\n")
+    namespace = {'_formato': ''.join(formato),
+                 '_atributos': operator.attrgetter(*(campo for campo, _, _, _, _ in layout))}
+    exec(compile(fonte, '<codificador BPA-I>', 'exec'), namespace)
+    return namespace['codificar']
@@ -0,0 +1,132 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Numeração de folha/sequência dos registros BPA-I.
+Cada profissional (CNS) tem as suas folhas, de até 99 registros. A numeração grava prd_flh/prd_seq no
+próprio registro, em streaming, com um contador por profissional: se um CNS reaparecer mais adiante
+(entrada fora de ordem), as folhas dele continuam de onde pararam e nunca se repetem.
+Para o arquivo sair agrupado por profissional, uma entrada sem ordem garantida passa antes por
+ordenar_por_profissional: ordenação estável pelo CNS, em memória ou externa (blocos ordenados em
+arquivos temporários, intercalados com heapq.merge).
+"""
+
+import os
+import heapq
+import pickle
+import operator
+import tempfile
+
+from bpa_registro import CAMPOS_SEM_NUMERACAO, RegistroBPAI
+
+REGISTROS_POR_FOLHA = 99
+
+# Textos de largura fixa das sequências 1..99 (prd_seq)
+_SEQUENCIAS = tuple(str(sequencia).zfill(2) for sequencia in range(1, REGISTROS_POR_FOLHA + 1))
+
+
+def profissional(registro):
+    """CNS do profissional que agrupa as folhas (mesmo critério da numeração original)."""
+    return registro.get('prd_cnsmed', ' ').strip()
+
+
+def agrupado_por_profissional(registros):
+    """True se os registros de cada profissional estão contíguos (a numeração pode seguir a ordem atual)."""
+    vistos = set()
+    atual = None
+    for registro in registros:
+        cns = profissional(registro)
+        if cns != atual:
+            if cns in vistos:
+                return False
+            vistos.add(cns)
+            atual = cns
+    return True
+
+
+def numerar(registros):
+    """Gera os registros com prd_flh/prd_seq gravados no próprio registro (sem cópia).
+
+    Espera os registros agrupados por profissional; se um CNS reaparecer depois de outro, avisa uma vez
+    e continua a numeração dele (a folha/sequência não se repete, mas o arquivo não fica agrupado).
+    """
+    contadores = {}
+    atual = None
+    posicao = 0
+    avisado = False
+    for registro in registros:
+        cns = profissional(registro)
+        if cns != atual:
+            if atual is not None:
+                contadores[atual] = posicao
+            if cns in contadores and not avisado:
+                print(f"Aviso: registros do profissional '{cns}' fora de ordem; a numeração continua de onde parou.")
+                avisado = True
+            atual = cns
+            posicao = contadores.get(cns, 0)
+        folha, sequencia = divmod(posicao, REGISTROS_POR_FOLHA)
+        posicao += 1
+        registro['prd_flh'] = str(folha + 1).zfill(3)
+        registro['prd_seq'] = _SEQUENCIAS[sequencia]
+        yield registro
+
+
+def ordenar_por_profissional(registros, limite_memoria=None, diretorio=None):
+    """Gera os registros (RegistroBPAI) ordenados pelo CNS do profissional, de forma estável: dentro de
+    cada profissional a ordem de chegada (a do ORDER BY do banco) é mantida.
+
+    limite_memoria: registros ordenados de cada vez em memória; os blocos cheios vão para arquivos
+    temporários em `diretorio` (None = pasta temporária do sistema) e são intercalados no fim.
+    None ou 0 = tudo em memória.
+    """
+    limite = limite_memoria or float('inf')
+    bloco = []
+    blocos_em_disco = []
+    try:
+        for registro in registros:
+            bloco.append(registro)
+            if len(bloco) >= limite:
+                bloco.sort(key=profissional)
+                blocos_em_disco.append(BlocoOrdenado(bloco, diretorio))
+                bloco = []
+        bloco.sort(key=profissional)
+        if not blocos_em_disco:
+            yield from bloco
+            return
+        print(f"Ordenação externa por profissional: {len(blocos_em_disco)} blocos em disco e {len(bloco)} registros em memória.")
+        # heapq.merge é estável: nos empates vem primeiro o bloco que chegou antes
+        yield from heapq.merge(*[b.registros() for b in blocos_em_disco], bloco, key=profissional)
+    finally:
+        for bloco_em_disco in blocos_em_disco:
+            bloco_em_disco.apagar()
+
+
+class BlocoOrdenado:
+    """Um bloco já ordenado da ordenação externa, num arquivo temporário (fatias de tuplas em pickle)."""
+
+    # Campos gravados: a ordenação acontece antes da numeração (folha/sequência)
+    CAMPOS_GRAVADOS = CAMPOS_SEM_NUMERACAO
+    REGISTROS_POR_FATIA = 10000
+
+    def __init__(self, registros, diretorio=None):
+        descritor, self.caminho = tempfile.mkstemp(prefix='bpa_ordenacao_', suffix='.bin', dir=diretorio)
+        valores = operator.attrgetter(*self.CAMPOS_GRAVADOS)
+        with os.fdopen(descritor, 'wb') as arquivo:
+            for inicio in range(0, len(registros), self.REGISTROS_POR_FATIA):
+                fatia = [valores(registro) for registro in registros[inicio:inicio + self.REGISTROS_POR_FATIA]]
+                pickle.dump(fatia, arquivo, pickle.HIGHEST_PROTOCOL)
+
+    def registros(self):
+        """Gera os registros do bloco na ordem gravada, lendo uma fatia por vez."""
+        with open(self.caminho, 'rb') as arquivo:
+            while True:
+                try:
+                    fatia = pickle.load(arquivo)
+                except EOFError:
+                    return
+                yield from RegistroBPAI.de_linhas(self.CAMPOS_GRAVADOS, fatia)
+
+    def apagar(self):
+        try:
+            os.remove(self.caminho)
+        except OSError:
+            pass
@@ -0,0 +1,344 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Tabela de-para de procedimentos do SIGH para o BPA-I.
+Mantém o mapeamento código curto -> SIGTAP, serviço, classificação e CID fora do código
+(CSV, SQLite ou tabela no banco), com cache no processo e detecção de alteração.
+"""
+
+import os
+import csv
+import sqlite3
+import hashlib
+import time
+from collections import OrderedDict
+
+CAMPOS_TABELA = ['codigo_curto', 'codigo_sigtap', 'servico', 'classificacao', 'cid_sugestao', 'cid_obrigatorio']
+TABELA_SQLITE = 'procedimentos_bpa'
+ARQUIVO_PADRAO = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'procedimentos_bpa.csv')
+
+# Cache no processo: origem -> TabelaProcedimentos (reaproveitado entre execuções da GUI)
+_CACHE_TABELAS = {}
+
+
+def _para_bool(valor):
+    return str(valor or '').strip().upper() in ('S', 'SIM', '1', 'TRUE', 'T', 'Y')
+
+
+class TabelaProcedimentos:
+    """Índice em memória (dict) código curto -> dados do procedimento, com versão e assinatura da origem."""
+
+    def __init__(self, origem, registros, versao, assinatura=None, competencia_sigtap=None):
+        self.origem = origem
+        self.versao = versao # hash do conteúdo (12 primeiros caracteres do sha256)
+        self.assinatura = assinatura # (mtime_ns, tamanho) do arquivo, quando a origem é arquivo
+        self.competencia_sigtap = competencia_sigtap
+        self.indice = {}
+        for reg in registros:
+            codigo = str(reg.get('codigo_curto') or '').strip()
+            if not codigo:
+                continue
+            self.indice[codigo] = {
+                'codigo_sigtap': str(reg.get('codigo_sigtap') or '').strip(),
+                'servico': str(reg.get('servico') or '').strip(),
+                'classificacao': str(reg.get('classificacao') or '').strip(),
+                'cid_sugestao': str(reg.get('cid_sugestao') or '').strip(),
+                'cid_obrigatorio': _para_bool(reg.get('cid_obrigatorio')),
+            }
+
+    def get(self, codigo_curto, default=None):
+        return self.indice.get(codigo_curto, default)
+
+    def __len__(self):
+        return len(self.indice)
+
+    def como_dict(self):
+        """Dict no formato de carregar_tabela_procedimentos_cid (o próprio índice, sem cópia)."""
+        return self.indice
+
+    def salvar_csv(self, caminho):
+        """Grava o índice em CSV (mesmo formato lido por carregar_tabela_procedimentos)."""
+        with open(caminho, 'w', newline='', encoding='utf-8') as f:
+            f.write("# Tabela de-para dos procedimentos do SIGH (sigh.procedimentos.codigo_procedimento) para o BPA-I.\n")
+            f.write("# cid_obrigatorio: S/N. Linhas iniciadas por # são ignoradas.\n")
+            if self.competencia_sigtap:
+                f.write(f"# competencia_sigtap={self.competencia_sigtap}\n")
+            escritor = csv.writer(f, lineterminator='\n')
+            escritor.writerow(CAMPOS_TABELA)
+            for codigo, info in self.indice.items():
+                escritor.writerow([codigo, info['codigo_sigtap'], info['servico'], info['classificacao'],
+                                   info['cid_sugestao'], 'S' if info['cid_obrigatorio'] else 'N'])
+
+
+def _ler_csv(caminho, conteudo):
+    competencia_sigtap = None
+    linhas_dados = []
+    for linha in conteudo.decode('utf-8-sig').splitlines():
+        if linha.startswith('#'):
+            if linha[1:].strip().startswith('competencia_sigtap='):
+                competencia_sigtap = linha.split('=', 1)[1].strip()
+            continue
+        if linha.strip():
+            linhas_dados.append(linha)
+    return list(csv.DictReader(linhas_dados)), competencia_sigtap
+
+
+def _ler_sqlite(caminho):
+    conexao = sqlite3.connect(caminho)
+    try:
+        conexao.row_factory = sqlite3.Row
+        cursor = conexao.execute(f"SELECT {', '.join(CAMPOS_TABELA)} FROM {TABELA_SQLITE}")
+        return [dict(row) for row in cursor.fetchall()]
+    finally:
+        conexao.close()
+
+
+def carregar_tabela_procedimentos(caminho=None, forcar=False):
+    """Carrega a tabela de um arquivo CSV ou SQLite, reaproveitando o cache do processo.
+
+    A revalidação é barata: se mtime/tamanho não mudaram, devolve a tabela em cache; se mudaram,
+    o conteúdo é relido e só reindexado quando o hash também mudou.
+    """
+    caminho = os.path.abspath(caminho or ARQUIVO_PADRAO)
+    stat = os.stat(caminho)
+    assinatura = (stat.st_mtime_ns, stat.st_size)
+
+    em_cache = _CACHE_TABELAS.get(caminho)
+    if em_cache is not None and not forcar and em_cache.assinatura == assinatura:
+        return em_cache
+
+    with open(caminho, 'rb') as f:
+        conteudo = f.read()
+    versao = hashlib.sha256(conteudo).hexdigest()[:12]
+    if em_cache is not None and not forcar and em_cache.versao == versao:
+        em_cache.assinatura = assinatura # Só o mtime mudou (ex.: arquivo salvo sem alterações)
+        return em_cache
+
+    competencia_sigtap = None
+    if caminho.lower().endswith(('.sqlite', '.sqlite3', '.db')):
+        registros = _ler_sqlite(caminho)
+    else:
+        registros, competencia_sigtap = _ler_csv(caminho, conteudo)
+
+    tabela = TabelaProcedimentos(caminho, registros, versao, assinatura, competencia_sigtap)
+    _CACHE_TABELAS[caminho] = tabela
+    print(f"Tabela de procedimentos carregada de {caminho}: {len(tabela)} códigos (versão {versao}).")
+    return tabela
+
+
+def carregar_tabela_procedimentos_bd(conn, nome_tabela, forcar=False):
+    """Carrega a tabela de uma tabela do banco (mesmas colunas do CSV).
+
+    A detecção de alteração usa um md5 do conteúdo calculado no próprio banco.
+    """
+    from sqlalchemy import text
+    versao_bd = conn.execute(text(
+        f"SELECT md5(string_agg(t::text, ',' ORDER BY t.codigo_curto)) FROM {nome_tabela} AS t"
+    )).scalar() or ''
+    chave_cache = f"bd:{nome_tabela}"
+    em_cache = _CACHE_TABELAS.get(chave_cache)
+    if em_cache is not None and not forcar and em_cache.versao == versao_bd[:12]:
+        return em_cache
+
+    result = conn.execute(text(f"SELECT {', '.join(CAMPOS_TABELA)} FROM {nome_tabela}"))
+    registros = [dict(row._mapping) for row in result]
+    tabela = TabelaProcedimentos(chave_cache, registros, versao_bd[:12])
+    _CACHE_TABELAS[chave_cache] = tabela
+    print(f"Tabela de procedimentos carregada do banco ({nome_tabela}): {len(tabela)} códigos (versão {tabela.versao}).")
+    return tabela
+
+
+class CacheCodigosProcedimento:
+    """Cache LRU com TTL de sigh.procedimentos: id_procedimento -> codigo_procedimento.
+
+    Guarda também os ids inexistentes no banco (valor None), para que só ids nunca vistos
+    voltem a ser consultados. invalidar() descarta tudo ou apenas os ids informados.
+    """
+
+    def __init__(self, max_itens=50000, ttl_segundos=3600):
+        self.max_itens = max_itens
+        self.ttl_segundos = ttl_segundos
+        self._itens = OrderedDict() # id (str) -> (codigo ou None, instante da carga)
+        self.acertos = 0
+        self.faltas = 0
+
+    def __len__(self):
+        return len(self._itens)
+
+    def consultar(self, ids):
+        """Devolve ({id: codigo} dos ids em cache e válidos, [ids que precisam ser buscados])."""
+        agora = time.monotonic()
+        encontrados, faltantes = {}, []
+        for id_proc in ids:
+            item = self._itens.get(id_proc)
+            if item is not None and (self.ttl_segundos is None or agora - item[1] < self.ttl_segundos):
+                self._itens.move_to_end(id_proc)
+                self.acertos += 1
+                if item[0] is not None:
+                    encontrados[id_proc] = item[0]
+            else:
+                if item is not None:
+                    del self._itens[id_proc]
+                self.faltas += 1
+                faltantes.append(id_proc)
+        return encontrados, faltantes
+
+    def guardar(self, ids_buscados, mapeamento):
+        """Registra o resultado de uma busca; ids buscados e não encontrados ficam como None."""
+        agora = time.monotonic()
+        for id_proc in ids_buscados:
+            self._itens[id_proc] = (mapeamento.get(id_proc), agora)
+            self._itens.move_to_end(id_proc)
+        while self.max_itens and len(self._itens) > self.max_itens:
+            self._itens.popitem(last=False)
+
+    def invalidar(self, ids=None):
+        if ids is None:
+            self._itens.clear()
+            return
+        for id_proc in ids:
+            self._itens.pop(str(id_proc), None)
+
+
+def buscar_codigos_procedimentos(conn, ids, tamanho_bloco=1000):
+    """Busca codigo_procedimento de sigh.procedimentos em blocos, com id_procedimento = ANY(array).
+
+    ids são strings; quando todos são numéricos o array vai como inteiros (usa o índice da PK),
+    senão a comparação é feita no texto do id.
+    """
+    from sqlalchemy import text
+    ids = list(ids)
+    numericos = all(i.isdigit() for i in ids)
+    sql = text(
+        "SELECT id_procedimento, codigo_procedimento FROM sigh.procedimentos "
+        + ("WHERE id_procedimento = ANY(:ids)" if numericos else "WHERE id_procedimento::text = ANY(:ids)")
+    )
+    mapeamento = {}
+    for inicio in range(0, len(ids), tamanho_bloco):
+        bloco = ids[inicio:inicio + tamanho_bloco]
+        parametro = [int(i) for i in bloco] if numericos else bloco
+        for row in conn.execute(sql, {'ids': parametro}):
+            mapeamento[str(row.id_procedimento)] = str(row.codigo_procedimento)
+    return mapeamento
+
+
+def exportar_para_sqlite(tabela, caminho_sqlite):
+    """Grava a tabela em um arquivo SQLite (tabela procedimentos_bpa)."""
+    conexao = sqlite3.connect(caminho_sqlite)
+    try:
+        conexao.execute(f"DROP TABLE IF EXISTS {TABELA_SQLITE}")
+        conexao.execute(f"CREATE TABLE {TABELA_SQLITE} (codigo_curto TEXT PRIMARY KEY, codigo_sigtap TEXT, servico TEXT, "
+                        f"classificacao TEXT, cid_sugestao TEXT, cid_obrigatorio INTEGER)")
+        conexao.executemany(
+            f"INSERT INTO {TABELA_SQLITE} VALUES (?, ?, ?, ?, ?, ?)",
+            [(codigo, info['codigo_sigtap'], info['servico'], info['classificacao'], info['cid_sugestao'],
+              1 if info['cid_obrigatorio'] else 0) for codigo, info in tabela.indice.items()]
+        )
+        conexao.commit()
+    finally:
+        conexao.close()
+
+
+# --- Importação das tabelas oficiais do SIGTAP (arquivos TXT da competência) ---
+
+def _ler_layout_sigtap(caminho_layout):
+    """Lê o arquivo <tabela>_layout.txt do SIGTAP (Coluna,Tamanho,Inicio,Fim,Tipo) -> {coluna: (ini, fim)}."""
+    colunas = {}
+    with open(caminho_layout, 'r', encoding='latin-1') as f:
+        for linha in csv.reader(f):
+            if not linha or linha[0].strip().lower() == 'coluna':
+                continue
+            colunas[linha[0].strip().upper()] = (int(linha[2]) - 1, int(linha[3]))
+    return colunas
+
+
+def _ler_tabela_sigtap(diretorio, nome_tabela, colunas_desejadas):
+    """Gera dicts com as colunas desejadas de um TXT de largura fixa do SIGTAP."""
+    layout = _ler_layout_sigtap(os.path.join(diretorio, f"{nome_tabela}_layout.txt"))
+    fatias = [(coluna, layout[coluna]) for coluna in colunas_desejadas]
+    with open(os.path.join(diretorio, f"{nome_tabela}.txt"), 'r', encoding='latin-1') as f:
+        for linha in f:
+            yield {coluna: linha[ini:fim].strip() for coluna, (ini, fim) in fatias}
+
+
+def importar_sigtap(tabela, diretorio_sigtap):
+    """Atualiza a tabela com os dados oficiais de uma competência do SIGTAP.
+
+    Usa tb_procedimento, rl_procedimento_servico e rl_procedimento_cid (com seus *_layout.txt):
+    preenche serviço/classificação vazios, marca cid_obrigatorio quando o SIGTAP lista CIDs para
+    o procedimento e sugere o primeiro CID principal quando não há sugestão.
+    Retorna um dict com o resumo da importação.
+    """
+    codigos_sigtap = {info['codigo_sigtap'] for info in tabela.indice.values()}
+
+    procedimentos_validos = set()
+    competencia = None
+    for reg in _ler_tabela_sigtap(diretorio_sigtap, 'tb_procedimento', ['CO_PROCEDIMENTO', 'DT_COMPETENCIA']):
+        procedimentos_validos.add(reg['CO_PROCEDIMENTO'])
+        competencia = competencia or reg['DT_COMPETENCIA']
+
+    servicos = {}
+    for reg in _ler_tabela_sigtap(diretorio_sigtap, 'rl_procedimento_servico', ['CO_PROCEDIMENTO', 'CO_SERVICO', 'CO_CLASSIFICACAO']):
+        if reg['CO_PROCEDIMENTO'] in codigos_sigtap:
+            servicos.setdefault(reg['CO_PROCEDIMENTO'], (reg['CO_SERVICO'], reg['CO_CLASSIFICACAO']))
+
+    cids = {}
+    for reg in _ler_tabela_sigtap(diretorio_sigtap, 'rl_procedimento_cid', ['CO_PROCEDIMENTO', 'CO_CID', 'ST_PRINCIPAL']):
+        if reg['CO_PROCEDIMENTO'] in codigos_sigtap:
+            lista = cids.setdefault(reg['CO_PROCEDIMENTO'], [])
+            if reg['ST_PRINCIPAL'] == 'S':
+                lista.insert(0, reg['CO_CID'])
+            else:
+                lista.append(reg['CO_CID'])
+
+    resumo = {'competencia': competencia, 'inexistentes': [], 'atualizados': 0}
+    for codigo_curto, info in tabela.indice.items():
+        codigo_sigtap = info['codigo_sigtap']
+        if codigo_sigtap not in procedimentos_validos:
+            resumo['inexistentes'].append((codigo_curto, codigo_sigtap))
+            continue
+        antes = dict(info)
+        if codigo_sigtap in servicos:
+            if not info['servico']:
+                info['servico'] = servicos[codigo_sigtap][0]
+            if not info['classificacao']:
+                info['classificacao'] = servicos[codigo_sigtap][1]
+        if cids.get(codigo_sigtap):
+            info['cid_obrigatorio'] = True
+            if not info['cid_sugestao']:
+                info['cid_sugestao'] = cids[codigo_sigtap][0]
+        if info != antes:
+            resumo['atualizados'] += 1
+
+    tabela.competencia_sigtap = competencia
+    print(f"Importação SIGTAP {competencia}: {resumo['atualizados']} procedimentos atualizados, "
+          f"{len(resumo['inexistentes'])} códigos SIGTAP não encontrados na competência.")
+    return resumo
+
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser(description='Manutenção da tabela de-para de procedimentos do BPA-I.')
+    parser.add_argument('--arquivo', default=ARQUIVO_PADRAO, help='Tabela de procedimentos (CSV ou SQLite). Padrão: procedimentos_bpa.csv')
+    subparsers = parser.add_subparsers(dest='comando', required=True)
+    p_sigtap = subparsers.add_parser('importar-sigtap', help='Atualiza a tabela com os TXT oficiais de uma competência do SIGTAP.')
+    p_sigtap.add_argument('diretorio', help='Diretório com tb_procedimento.txt, rl_procedimento_servico.txt, rl_procedimento_cid.txt e os *_layout.txt')
+    p_sqlite = subparsers.add_parser('exportar-sqlite', help='Grava a tabela em um arquivo SQLite.')
+    p_sqlite.add_argument('destino')
+    args = parser.parse_args()
+
+    tabela = carregar_tabela_procedimentos(args.arquivo)
+    if args.comando == 'importar-sigtap':
+        resumo = importar_sigtap(tabela, args.diretorio)
+        for codigo_curto, codigo_sigtap in resumo['inexistentes']:
+            print(f"  Aviso: código curto '{codigo_curto}' aponta para SIGTAP {codigo_sigtap}, inexistente na competência.")
+        if args.arquivo.lower().endswith(('.sqlite', '.sqlite3', '.db')):
+            exportar_para_sqlite(tabela, args.arquivo)
+        else:
+            tabela.salvar_csv(args.arquivo)
+    elif args.comando == 'exportar-sqlite':
+        exportar_para_sqlite(tabela, args.destino)
+        print(f"Tabela gravada em {args.destino}")
+
+if __name__ == "__main__":
+    main()
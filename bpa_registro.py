@@ -0,0 +1,136 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Representação compacta de uma linha BPA-I.
+RegistroBPAI guarda os campos em __slots__ (sem um dict por registro) e aceita o mesmo acesso
+de dicionário usado pelo exportador: reg['prd_qt'], reg.get(...), keys()/items(), copy().
+prd_qt é um inteiro; formatar_quantidade() dá o texto de largura fixa dos arquivos.
+"""
+
+import functools
+
+from bpa_layout import CAMPOS_REGISTRO_BPA_I, REGISTRO_BPA_I_LAYOUT
+
+# Campos na ordem do layout (bpa_layout.REGISTRO_BPA_I_LAYOUT), mais o id do lançamento de origem
+CAMPOS_LAYOUT = CAMPOS_REGISTRO_BPA_I
+CAMPOS = CAMPOS_LAYOUT + ('_id_lancamento_original',)
+
+# Campos de um registro antes da numeração (folha/sequência só são gravadas no fim)
+CAMPOS_SEM_NUMERACAO = tuple(c for c in CAMPOS if c not in ('prd_flh', 'prd_seq'))
+
+# Ordem de keys()/items(): a mesma dos dicts que o exportador montava (folha/sequência entravam por
+# último, na numeração), para que CSV/XLSX continuem com as colunas na mesma posição.
+_ORDEM_CHAVES = CAMPOS_SEM_NUMERACAO + ('prd_flh', 'prd_seq')
+_CAMPOS_VALIDOS = frozenset(CAMPOS)
+
+# prd_qt fica inteiro durante o processamento (somas da deduplicação) e só vira '000003' na gravação
+LARGURA_QUANTIDADE = next(largura for campo, largura, _, _, _ in REGISTRO_BPA_I_LAYOUT if campo == 'prd_qt')
+
+
+def quantidade(valor):
+    """prd_qt como inteiro: aceita o inteiro interno ou o texto do arquivo ('000003'); valor inválido conta 0."""
+    if type(valor) is int:
+        return valor
+    texto = str(valor).replace('.', '')
+    return int(texto) if texto.isdigit() else 0
+
+
+def formatar_quantidade(valor):
+    """prd_qt como gravado no arquivo (mesmo preenchimento do TXT)."""
+    return str(valor).zfill(LARGURA_QUANTIDADE)
+
+
+@functools.lru_cache(maxsize=None)
+def _construtor_em_lote(campos):
+    """Função (classe, linhas) -> lista de registros, com a atribuição dos campos gerada uma vez."""
+    invalidos = [campo for campo in campos if campo not in _CAMPOS_VALIDOS]
+    if invalidos:
+        raise KeyError(invalidos[0])
+    variaveis = [f"v{indice}" for indice in range(len(campos))]
+    atribuicoes = ''.join(f"        registro.{campo} = {variavel}\n" for campo, variavel in zip(campos, variaveis))
+    fonte = ("def construir(classe, linhas):\n"
+             "    novo = classe.__new__\n"
+             "    registros = []\n"
+             "    adicionar = registros.append\n"
+             f"    for {', '.join(variaveis)}, in linhas:\n"
+             "        registro = novo(classe)\n"
+             f"{atribuicoes}"
+             "        adicionar(registro)\n"
+             "    return registros\n")
+    namespace = {}
+    exec(fonte, namespace)
+    return namespace['construir']
+
+
+class RegistroBPAI:
+    """Uma linha BPA-I. Campos ainda não atribuídos (p.ex. prd_flh antes da numeração) ficam ausentes."""
+
+    __slots__ = CAMPOS
+
+    def __init__(self, **campos):
+        for campo, valor in campos.items():
+            setattr(self, campo, valor)
+
+    @classmethod
+    def de_dict(cls, dados):
+        """Cria o registro a partir de um dict; chaves fora do layout são ignoradas."""
+        registro = cls()
+        for campo, valor in dados.items():
+            if campo in _CAMPOS_VALIDOS:
+                setattr(registro, campo, valor)
+        return registro
+
+    @classmethod
+    def de_linhas(cls, campos, linhas):
+        """Cria os registros a partir de tuplas de valores na ordem de `campos`."""
+        return _construtor_em_lote(tuple(campos))(cls, linhas)
+
+    def __getitem__(self, campo):
+        try:
+            return getattr(self, campo)
+        except (AttributeError, TypeError):
+            raise KeyError(campo) from None
+
+    def __setitem__(self, campo, valor):
+        if campo not in _CAMPOS_VALIDOS:
+            raise KeyError(campo)
+        setattr(self, campo, valor)
+
+    def __contains__(self, campo):
+        return campo in _CAMPOS_VALIDOS and hasattr(self, campo)
+
+    def get(self, campo, padrao=None):
+        return getattr(self, campo, padrao) if campo in _CAMPOS_VALIDOS else padrao
+
+    def keys(self):
+        return [campo for campo in _ORDEM_CHAVES if hasattr(self, campo)]
+
+    def values(self):
+        return [getattr(self, campo) for campo in self.keys()]
+
+    def items(self):
+        return [(campo, getattr(self, campo)) for campo in self.keys()]
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.keys())
+
+    def copy(self):
+        novo = RegistroBPAI.__new__(RegistroBPAI)
+        for campo in CAMPOS:
+            if hasattr(self, campo):
+                setattr(novo, campo, getattr(self, campo))
+        return novo
+
+    def como_dict(self):
+        return dict(self.items())
+
+    def __eq__(self, outro):
+        if isinstance(outro, (RegistroBPAI, dict)):
+            return self.como_dict() == dict(outro.items())
+        return NotImplemented
+
+    def __repr__(self):
+        return f"RegistroBPAI({self.como_dict()!r})"
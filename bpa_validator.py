@@ -14,69 +14,21 @@ import datetime
 import math
 from colorama import init, Fore, Style
 
+from bpa_layout import HEADER_LAYOUT, REGISTRO_BPA_I_LAYOUT, posicoes, compilar_decodificador
+
 # Inicializar colorama para saída colorida no terminal
 init(autoreset=True)
 
 class BPAValidator:
     def __init__(self):
-        # Definição do layout do header
-        self.header_layout = {
-            'cbc_hdr_1': {'inicio': 1, 'fim': 2, 'tipo': 'NUM', 'valor': '01', 'obrigatorio': True},
-            'cbc_hdr_2': {'inicio': 3, 'fim': 7, 'tipo': 'ALFA', 'valor': '#BPA#', 'obrigatorio': True},
-            'cbc_mvm': {'inicio': 8, 'fim': 13, 'tipo': 'NUM', 'pattern': r'^\d{6}$', 'obrigatorio': True}, # Competência AAAAMM
-            'cbc_lin': {'inicio': 14, 'fim': 19, 'tipo': 'NUM', 'pattern': r'^\d{6}$', 'obrigatorio': True}, # Qtd Linhas
-            'cbc_flh': {'inicio': 20, 'fim': 25, 'tipo': 'NUM', 'pattern': r'^\d{6}$', 'obrigatorio': True}, # Qtd Folhas
-            'cbc_smt_vrf': {'inicio': 26, 'fim': 29, 'tipo': 'NUM', 'pattern': r'^\d{4}$', 'obrigatorio': True}, # Sequencial de remessa
-            'cbc_rsp': {'inicio': 30, 'fim': 59, 'tipo': 'ALFA', 'tamanho': 30, 'obrigatorio': True}, # Nome do Responsável
-            'cbc_sgl': {'inicio': 60, 'fim': 65, 'tipo': 'ALFA', 'tamanho': 6, 'obrigatorio': True}, # Sigla do Órgão
-            'cbc_cgccpf': {'inicio': 66, 'fim': 79, 'tipo': 'NUM', 'pattern': r'^\d{14}$', 'obrigatorio': True}, # CGC/CPF
-            'cbc_dst': {'inicio': 80, 'fim': 119, 'tipo': 'ALFA', 'tamanho': 40, 'obrigatorio': True}, # Órgão Destino
-            'cbc_dst_in': {'inicio': 120, 'fim': 120, 'tipo': 'ALFA', 'valores': ['M', 'E'], 'obrigatorio': True}, # Indicador Destino (M-Municipal, E-Estadual)
-            'cbc_versao': {'inicio': 121, 'fim': 130, 'tipo': 'ALFA', 'tamanho': 10, 'obrigatorio': True} # Versão do Sistema
-        }
-        
-        # Definição do layout do registro BPA-I (Individualizado)
-        self.registro_bpa_i_layout = {
-            'prd_ident': {'inicio': 1, 'fim': 2, 'tipo': 'NUM', 'valor': '03', 'obrigatorio': True},
-            'prd_cnes': {'inicio': 3, 'fim': 9, 'tipo': 'NUM', 'pattern': r'^\d{7}$', 'obrigatorio': True},
-            'prd_cmp': {'inicio': 10, 'fim': 15, 'tipo': 'NUM', 'pattern': r'^\d{6}$', 'obrigatorio': True}, # Competência AAAAMM
-            'prd_cnsmed': {'inicio': 16, 'fim': 30, 'tipo': 'NUM', 'pattern': r'^\d{15}$', 'obrigatorio': True}, # CNS do Profissional
-            'prd_cbo': {'inicio': 31, 'fim': 36, 'tipo': 'ALFA', 'tamanho': 6, 'pattern': r'^[A-Z0-9]{6}$', 'obrigatorio': True}, # CBO (pode ser alfanumérico)
-            'prd_dtaten': {'inicio': 37, 'fim': 44, 'tipo': 'NUM', 'pattern': r'^\d{8}$', 'obrigatorio': True}, # Data Atendimento AAAAMMDD
-            'prd_flh': {'inicio': 45, 'fim': 47, 'tipo': 'NUM', 'pattern': r'^\d{3}$', 'obrigatorio': True}, # Folha
-            'prd_seq': {'inicio': 48, 'fim': 49, 'tipo': 'NUM', 'pattern': r'^\d{2}$', 'obrigatorio': True}, # Sequência na Folha
-            'prd_pa': {'inicio': 50, 'fim': 59, 'tipo': 'NUM', 'pattern': r'^\d{10}$', 'obrigatorio': True}, # Procedimento Ambulatorial
-            'prd_cnspac': {'inicio': 60, 'fim': 74, 'tipo': 'NUM', 'pattern': r'^\d{15}$', 'obrigatorio': False}, # CNS do Paciente
-            'prd_sexo': {'inicio': 75, 'fim': 75, 'tipo': 'ALFA', 'valores': ['M', 'F', 'I'], 'obrigatorio': True}, # Sexo (M/F/I - Ignorado)
-            'prd_ibge': {'inicio': 76, 'fim': 81, 'tipo': 'NUM', 'pattern': r'^\d{6}$', 'obrigatorio': True}, # Código IBGE Município Residência
-            'prd_cid': {'inicio': 82, 'fim': 85, 'tipo': 'ALFA', 'tamanho': 4, 'pattern': r'^[A-Z0-9]{3,4}$', 'obrigatorio': True}, # CID (pode ser 3 ou 4 chars)
-            'prd_ldade': {'inicio': 86, 'fim': 88, 'tipo': 'NUM', 'pattern': r'^\d{3}$', 'obrigatorio': True}, # Idade
-            'prd_qt': {'inicio': 89, 'fim': 94, 'tipo': 'NUM', 'pattern': r'^\d{6}$', 'obrigatorio': True}, # Quantidade
-            'prd_caten': {'inicio': 95, 'fim': 96, 'tipo': 'NUM', 'pattern': r'^\d{2}$', 'obrigatorio': False}, # Caráter Atendimento
-            'prd_naut': {'inicio': 97, 'fim': 109, 'tipo': 'NUM', 'pattern': r'^\d{13}$', 'obrigatorio': False}, # Número Autorização
-            'prd_org': {'inicio': 110, 'fim': 112, 'tipo': 'ALFA', 'valor': 'BPA', 'obrigatorio': True}, # Origem (BPA,BPI,RAAS,APAC) - aqui fixo BPA
-            'prd_nmpac': {'inicio': 113, 'fim': 142, 'tipo': 'ALFA', 'tamanho': 30, 'obrigatorio': True}, # Nome Paciente
-            'prd_dtnasc': {'inicio': 143, 'fim': 150, 'tipo': 'NUM', 'pattern': r'^\d{8}$', 'obrigatorio': True}, # Data Nascimento Paciente AAAAMMDD
-            'prd_raca': {'inicio': 151, 'fim': 152, 'tipo': 'NUM', 'pattern': r'^\d{2}$', 'obrigatorio': True}, # Raça/Cor
-            'prd_etnia': {'inicio': 153, 'fim': 156, 'tipo': 'NUM', 'pattern': r'^\d{4}$', 'obrigatorio': False}, # Etnia Indígena
-            'prd_nac': {'inicio': 157, 'fim': 159, 'tipo': 'NUM', 'pattern': r'^\d{3}$', 'obrigatorio': False}, # Nacionalidade
-            'prd_srv': {'inicio': 160, 'fim': 162, 'tipo': 'NUM', 'pattern': r'^\d{3}$', 'obrigatorio': False}, # Código Serviço
-            'prd_clf': {'inicio': 163, 'fim': 165, 'tipo': 'NUM', 'pattern': r'^\d{3}$', 'obrigatorio': False}, # Código Classificação do Serviço
-            'prd_equipe_Seq': {'inicio': 166, 'fim': 173, 'tipo': 'NUM', 'pattern': r'^\d{8}$', 'obrigatorio': False}, # Sequencial da Equipe (INE)
-            'prd_equipe_Area': {'inicio': 174, 'fim': 177, 'tipo': 'NUM', 'pattern': r'^\d{4}$', 'obrigatorio': False}, # Área da Equipe
-            'prd_cnpj': {'inicio': 178, 'fim': 191, 'tipo': 'NUM', 'pattern': r'^\d{14}$', 'obrigatorio': False}, # CNPJ do Estabelecimento (se terceirizado)
-            'prd_cep_pcnte': {'inicio': 192, 'fim': 199, 'tipo': 'NUM', 'pattern': r'^\d{8}$', 'obrigatorio': False},
-            'prd_lograd_pcnte': {'inicio': 200, 'fim': 202, 'tipo': 'NUM', 'pattern': r'^\d{3}$', 'obrigatorio': False},
-            'prd_end_pcnte': {'inicio': 203, 'fim': 232, 'tipo': 'ALFA', 'tamanho': 30, 'obrigatorio': False},
-            'prd_compl_pcnte': {'inicio': 233, 'fim': 242, 'tipo': 'ALFA', 'tamanho': 10, 'obrigatorio': False},
-            'prd_num_pcnte': {'inicio': 243, 'fim': 247, 'tipo': 'ALFA', 'tamanho': 5, 'obrigatorio': False}, # Pode ser S/N
-            'prd_bairro_pcnte': {'inicio': 248, 'fim': 277, 'tipo': 'ALFA', 'tamanho': 30, 'obrigatorio': False},
-            'prd_ddtel_pcnte': {'inicio': 278, 'fim': 288, 'tipo': 'NUM', 'pattern': r'^\d{10,11}$', 'obrigatorio': False}, # 10 ou 11 digitos
-            'prd_email_pcnte': {'inicio': 289, 'fim': 328, 'tipo': 'ALFA', 'tamanho': 40, 'obrigatorio': False},
-            'prd_ine': {'inicio': 329, 'fim': 338, 'tipo': 'NUM', 'pattern': r'^\d{10}$', 'obrigatorio': True}, # INE do profissional que realizou o atendimento
-            'prd_cpf_pcnte': {'inicio': 339, 'fim': 349, 'tipo': 'NUM', 'pattern': r'^\d{11}$', 'obrigatorio': False},
-            'prd_situacao_rua': {'inicio': 350, 'fim': 350, 'tipo': 'ALFA', 'valores':, 'obrigatorio': False}
-        }
+        # Layouts do header e do registro BPA-I: {campo: {'inicio', 'fim', 'tipo', ..., 'regex'}} (bpa_layout)
+        self.header_layout = posicoes(HEADER_LAYOUT)
+        self.registro_bpa_i_layout = posicoes(REGISTRO_BPA_I_LAYOUT)
+
+        # Pré-calculados uma vez: tamanhos mínimos e o decodificador (fatias) da linha completa
+        self._min_len_header = max(c['fim'] for c in self.header_layout.values())
+        self._min_len_registro = max(c['fim'] for c in self.registro_bpa_i_layout.values())
+        self._decodificar_registro = compilar_decodificador(REGISTRO_BPA_I_LAYOUT)
         
         self.stats = {} 
         self._reset_stats()
@@ -88,7 +40,7 @@ class BPAValidator:
             'total_registros_bpa_i': 0,
             'registros_validos': 0,
             'registros_invalidos': 0,
-            'erros':,
+            'erros': [],
             'competencia': 'N/A',
             'num_linhas_declarado_hdr': 0,
             'num_folhas_declarado_hdr': 0
@@ -96,7 +48,7 @@ class BPAValidator:
 
     def _validar_campo(self, valor_campo_bruto, config, num_linha=None, nome_campo_log=None):
         """Valida um único campo com base na sua configuração. Retorna uma lista de erros."""
-        erros_campo =
+        erros_campo = []
         obrigatorio = config.get('obrigatorio', False)
         tipo = config.get('tipo', 'ALFA')
         
@@ -118,7 +70,8 @@ class BPAValidator:
             if val_comp not in config['valores']:
                 erros_campo.append(f"{prefixo_erro}valor '{valor_campo_bruto}' (comparado como '{val_comp}') não está entre os permitidos {config['valores']}")
         elif 'pattern' in config:
-            if not re.fullmatch(config['pattern'], valor_campo_proc):
+            regex = config.get('regex')
+            if not (regex.fullmatch(valor_campo_proc) if regex else re.fullmatch(config['pattern'], valor_campo_proc)):
                 erros_campo.append(f"{prefixo_erro}valor '{valor_campo_bruto}' (processado como '{valor_campo_proc}') não corresponde ao padrão '{config['pattern']}'")
         elif 'tamanho' in config and tipo == 'ALFA':
             if len(valor_campo_proc) > config['tamanho']:
@@ -144,8 +97,8 @@ class BPAValidator:
 
     def validar_header(self, linha):
         """Valida a linha de cabeçalho. Retorna (True/False, lista_de_erros)."""
-        erros =
-        min_len_header = max(c['fim'] for c in self.header_layout.values())
+        erros = []
+        min_len_header = self._min_len_header
         if len(linha) < min_len_header:
             erros.append(f"Tamanho da linha de cabeçalho ({len(linha)}) é menor que o esperado ({min_len_header} caracteres).")
             return False, erros
@@ -161,8 +114,8 @@ class BPAValidator:
 
     def validar_registro_bpa_i(self, linha, num_linha):
         """Valida uma linha de registro BPA-I. Retorna (True/False, lista_de_erros)."""
-        erros =
-        min_len_registro = max(c['fim'] for c in self.registro_bpa_i_layout.values())
+        erros = []
+        min_len_registro = self._min_len_registro
 
         if len(linha) < 2 or linha[0:2]!= '03': # Checagem básica do identificador
             erros.append(f"Linha {num_linha}: Identificador de registro inválido. Esperado '03', encontrado '{linha[0:2] if len(linha) >=2 else 'N/A'}'.")
@@ -171,6 +124,11 @@ class BPAValidator:
         if len(linha) < min_len_registro:
             erros.append(f"Linha {num_linha}: Tamanho da linha ({len(linha)}) é menor que o esperado ({min_len_registro} caracteres). Alguns campos podem estar ausentes ou truncados.")
             # Continua a validar os campos possíveis mesmo com linha curta, erros serão adicionados por _validar_campo
+        else:
+            # Linha completa: todas as fatias de uma vez, sem recalcular posições campo a campo
+            for (nome_campo, config), valor_campo_bruto in zip(self.registro_bpa_i_layout.items(), self._decodificar_registro(linha)):
+                erros.extend(self._validar_campo(valor_campo_bruto, config, num_linha=num_linha, nome_campo_log=nome_campo))
+            return len(erros) == 0, erros
 
         for nome_campo, config in self.registro_bpa_i_layout.items():
             inicio, fim = config['inicio'] - 1, config['fim']
@@ -209,9 +167,10 @@ class BPAValidator:
                             self.stats['erros'].extend([f"Cabeçalho (Linha 1): {e}" for e in erros_hdr])
                         
                         # Extrair informações do cabeçalho para estatísticas e consistência
-                        if len(linha) >= 13: self.stats['competencia'] = linha[7:13]
-                        if len(linha) >= 19 and linha[13:19].isdigit(): self.stats['num_linhas_declarado_hdr'] = int(linha[13:19])
-                        if len(linha) >= 25 and linha[19:25].isdigit(): self.stats['num_folhas_declarado_hdr'] = int(linha[19:25])
+                        mvm, lin, flh = (self.header_layout[c] for c in ('cbc_mvm', 'cbc_lin', 'cbc_flh'))
+                        if len(linha) >= mvm['fim']: self.stats['competencia'] = linha[mvm['inicio'] - 1:mvm['fim']]
+                        if len(linha) >= lin['fim'] and linha[lin['inicio'] - 1:lin['fim']].isdigit(): self.stats['num_linhas_declarado_hdr'] = int(linha[lin['inicio'] - 1:lin['fim']])
+                        if len(linha) >= flh['fim'] and linha[flh['inicio'] - 1:flh['fim']].isdigit(): self.stats['num_folhas_declarado_hdr'] = int(linha[flh['inicio'] - 1:flh['fim']])
                         continue 
 
                     # Validar registros BPA-I (linhas de dados)
@@ -291,7 +250,7 @@ class BPAValidator:
             print(f"Total de Registros BPA-I Encontrados: {self.stats.get('total_registros_bpa_i', 'N/A')}")
             print(f"Registros BPA-I Válidos: {self.stats.get('registros_validos', 'N/A')}")
             print(f"Registros BPA-I Inválidos (ou com erros): {self.stats.get('registros_invalidos', 'N/A')}")
-            print(f"Total de Erros Detalhados Acumulados: {len(self.stats.get('erros',))}")
+            print(f"Total de Erros Detalhados Acumulados: {len(self.stats.get('erros', []))}")
             
             if not self.stats.get('erros'):
                 print(f"\n{Fore.GREEN}SUCESSO: O arquivo parece estar em conformidade com o layout BPA-I.{Style.RESET_ALL}")
@@ -0,0 +1,225 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Motor colunar do processamento BPA-I (motor_processamento = 'vetorizado').
+Transpõe as linhas brutas do banco em colunas e aplica as regras de
+BPAExporter._construir_registro_bpa_i coluna a coluna, em vez de registro a registro:
+- campos de texto (profissional, paciente, endereço, procedimento, CID...) são calculados uma vez por
+  valor distinto da coluna e espalhados com um dict (o mesmo paciente, procedimento ou CBO se repete
+  em muitos lançamentos de uma competência);
+- a idade sai de aritmética de arrays NumPy sobre ano/mês/dia das duas datas;
+- os registros são criados em lote (RegistroBPAI.de_linhas) a partir das colunas prontas.
+Importado só quando esse motor é escolhido (requer NumPy).
+"""
+
+import gc
+import numbers
+import operator
+
+import numpy as np
+
+from bpa_registro import RegistroBPAI
+
+# Colunas da consulta principal lidas pelo motor
+COLUNAS_BD = (
+    'id_lancamento', 'cod_proc', 'cns_med', 'tp_funcao', 'nm_paciente', 'data_nasc', 'data_atendimento',
+    'conta_dt_inicio', 'cnspac_paciente', 'cnspac_ficha', 'sexo', 'mun_num_ibge', 'cod_raca',
+    'cod_etnia_paciente', 'cpf_paciente', 'e_pac_cep', 'e_pac_tp_logradouro', 'e_pac_logradouro_nome',
+    'e_complemento', 'e_numero', 'e_pac_bairro_nome', 'fone_cel_1', 'fone_res_1', 'email_paciente',
+    'lanc_cod_cid', 'diagnostico', 'conta_numero_guia', 'numero_guia', 'ine_da_equipe_no_banco',
+)
+
+# Campos na ordem em que construir_registros_vetorizado monta as colunas
+CAMPOS_SAIDA = (
+    'prd_ident', 'prd_cnes', 'prd_cmp', 'prd_cnsmed', 'prd_cbo', 'prd_dtaten', 'prd_pa', 'prd_cnspac',
+    'prd_sexo', 'prd_ibge', 'prd_cid', 'prd_ldade', 'prd_qt', 'prd_caten', 'prd_naut', 'prd_org',
+    'prd_nmpac', 'prd_dtnasc', 'prd_raca', 'prd_etnia', 'prd_nac', 'prd_srv', 'prd_clf',
+    'prd_equipe_Seq', 'prd_equipe_Area', 'prd_cnpj', 'prd_cep_pcnte', 'prd_lograd_pcnte',
+    'prd_end_pcnte', 'prd_compl_pcnte', 'prd_num_pcnte', 'prd_bairro_pcnte', 'prd_ddtel_pcnte',
+    'prd_email_pcnte', 'prd_ine', 'prd_cpf_pcnte', 'prd_situacao_rua', '_id_lancamento_original',
+)
+
+
+def _colunas(registros_bd):
+    """{coluna: lista de valores} a partir das linhas (dicts) do banco."""
+    obter = operator.itemgetter(*COLUNAS_BD)
+    try:
+        linhas = list(map(obter, registros_bd))
+    except KeyError: # linha sem alguma coluna: mesmo resultado de reg.get(coluna)
+        linhas = [tuple(reg.get(coluna) for coluna in COLUNAS_BD) for reg in registros_bd]
+    return dict(zip(COLUNAS_BD, map(list, zip(*linhas))))
+
+
+def _ou(valores, alternativas):
+    """`valor or alternativa` linha a linha."""
+    return [valor or alternativa for valor, alternativa in zip(valores, alternativas)]
+
+
+def _por_valor(valores, funcao):
+    """[funcao(v) for v in valores], calculando `funcao` uma vez por valor distinto.
+
+    Valores iguais de tipos numéricos diferentes não se confundem (1, 1.0 e True dão textos diferentes
+    com str()): com mais de um tipo numérico na coluna, a chave é (tipo, valor). Valor não hashável:
+    linha a linha.
+    """
+    if sum(issubclass(tipo, numbers.Number) for tipo in set(map(type, valores))) <= 1:
+        chaves = valores
+    else:
+        chaves = list(zip(map(type, valores), valores))
+    try:
+        resultados = dict.fromkeys(chaves)
+    except TypeError:
+        return [funcao(valor) for valor in valores]
+    if chaves is valores:
+        for chave in resultados:
+            resultados[chave] = funcao(chave)
+    else:
+        for chave in resultados:
+            resultados[chave] = funcao(chave[1])
+    return list(map(resultados.__getitem__, chaves))
+
+
+def _texto_ajustado(largura, padrao=''):
+    """Função de valor: `str(valor or padrao).strip().ljust(largura)[:largura]`."""
+    return lambda valor: str(valor or padrao).strip().ljust(largura)[:largura]
+
+
+def _partes_data(datas):
+    """(ano, mês, dia, presente) como arrays NumPy; datas ausentes ficam com presente=False."""
+    partes = np.array(_por_valor(datas, lambda d: (d.year, d.month, d.day) if d else (0, 0, 0)),
+                      dtype=np.int64).reshape(-1, 3)
+    return partes[:, 0], partes[:, 1], partes[:, 2], partes[:, 0] != 0
+
+
+def _idades(datas_nasc, datas_atendimento):
+    """prd_ldade de cada linha: anos completos na data do atendimento, limitados a 0..130, com 3 dígitos."""
+    ano_nasc, mes_nasc, dia_nasc, tem_nasc = _partes_data(datas_nasc)
+    ano_aten, mes_aten, dia_aten, tem_aten = _partes_data(datas_atendimento)
+    antes_do_aniversario = (mes_aten < mes_nasc) | ((mes_aten == mes_nasc) & (dia_aten < dia_nasc))
+    idade = np.where(tem_nasc & tem_aten, ano_aten - ano_nasc - antes_do_aniversario, 0)
+    textos = [str(anos).zfill(3) for anos in range(131)]
+    return list(map(textos.__getitem__, np.clip(idade, 0, 130).tolist()))
+
+
+def construir_registros_vetorizado(exporter, registros_bd, competencia, mapeamento_proc, tabela_proc_cid):
+    """Equivalente colunar de [exporter._construir_registro_bpa_i(reg, ...) for reg in registros_bd].
+
+    Preserva a ordem de registros_bd e acumula em exporter.mapeamentos_faltantes_log os
+    procedimentos sem entrada na tabela, como o motor por linha.
+    """
+    if not registros_bd:
+        return []
+    # As colunas e os registros criados em massa disparariam várias passadas do coletor de ciclos sobre
+    # toda a memória (metade do tempo em 200 mil linhas); nada aqui forma ciclos, então ele fica pausado.
+    coletor_ativo = gc.isenabled()
+    gc.disable()
+    try:
+        return _construir(exporter, registros_bd, competencia, mapeamento_proc, tabela_proc_cid)
+    finally:
+        if coletor_ativo:
+            gc.enable()
+
+
+def _construir(exporter, registros_bd, competencia, mapeamento_proc, tabela_proc_cid):
+    config = exporter.config
+    col = _colunas(registros_bd)
+    n = len(registros_bd)
+
+    # --- Profissional, paciente e datas ---
+    cns_med = _por_valor(col['cns_med'], lambda valor: str(valor or '').strip().ljust(15))
+    cbo = _por_valor(col['tp_funcao'], lambda valor: exporter.obter_cbo_por_funcao(valor).ljust(6))
+    nome_paciente = _por_valor(col['nm_paciente'], _texto_ajustado(30, 'PACIENTE NAO IDENTIFICADO'))
+
+    data_atendimento = _ou(col['data_atendimento'], col['conta_dt_inicio'])
+    data_nasc_str = _por_valor(col['data_nasc'], lambda d: d.strftime('%Y%m%d') if d else '19000101')
+    data_atend_str = _por_valor(data_atendimento, lambda d: d.strftime('%Y%m%d') if d else competencia + "01")
+    idade = _idades(col['data_nasc'], data_atendimento)
+
+    cnspac = _por_valor(_ou(col['cnspac_paciente'], col['cnspac_ficha']), lambda valor: str(valor or '').strip().ljust(15))
+    sexo = _por_valor(col['sexo'], lambda valor: 'F' if str(valor or '').strip() == '3' else 'M')
+    cod_ibge = _por_valor(col['mun_num_ibge'], _texto_ajustado(6, config.get('default_ibge_paciente', '000000')))
+
+    raca = _por_valor(col['cod_raca'], lambda valor: exporter._obter_codigo_raca(valor).ljust(2))
+    etnia_val = _por_valor(col['cod_etnia_paciente'], lambda valor: str(valor or '').strip())
+    etnia = [(e.zfill(4) if e else '    ') if r == '05' else '    ' for r, e in zip(raca, etnia_val)]
+
+    cpf_paciente = _por_valor(col['cpf_paciente'],
+                              lambda valor: str(valor or '').replace('.', '').replace('-', '').strip().ljust(11))
+
+    # --- Endereço e contato ---
+    cep_padrao = config.get('default_cep_paciente', '00000000').ljust(8)
+    def cep(valor):
+        cep_val = str(valor or '').strip().replace('.', '').replace('-', '')
+        return cep_val.zfill(8) if cep_val else cep_padrao
+
+    def telefone(valor):
+        numeros = ''.join(filter(str.isdigit, str(valor or '').strip()))
+        return numeros.ljust(11)[:11] if numeros else ' '.ljust(11)
+
+    cep_pcnte = _por_valor(col['e_pac_cep'], cep)
+    logradouro_tipo = _por_valor(col['e_pac_tp_logradouro'], exporter._obter_codigo_tipo_logradouro)
+    endereco_nome = _por_valor(col['e_pac_logradouro_nome'], _texto_ajustado(30))
+    complemento = _por_valor(col['e_complemento'], _texto_ajustado(10))
+    numero = _por_valor(col['e_numero'], _texto_ajustado(5))
+    bairro = _por_valor(col['e_pac_bairro_nome'], _texto_ajustado(30))
+    fone = _por_valor(_ou(col['fone_cel_1'], col['fone_res_1']), telefone)
+    email = _por_valor(col['email_paciente'], _texto_ajustado(40))
+
+    # --- Procedimento: uma resolução por cod_proc distinto ---
+    def resolver_procedimento(cod_proc_bd):
+        sigtap, servico, classificacao, cid_obrigatorio, cid_sugestao = '0301010013', '135', '001', False, None
+        if cod_proc_bd and str(cod_proc_bd).strip():
+            codigo_mapeado = mapeamento_proc.get(str(cod_proc_bd))
+            if codigo_mapeado:
+                proc_info = tabela_proc_cid.get(codigo_mapeado)
+                if not proc_info:
+                    if codigo_mapeado != '72':
+                        exporter.mapeamentos_faltantes_log.add((codigo_mapeado, str(cod_proc_bd)))
+                else:
+                    sigtap = proc_info['codigo_sigtap']
+                    servico = proc_info.get('servico', servico)
+                    classificacao = proc_info.get('classificacao', classificacao)
+                    cid_obrigatorio = proc_info.get('cid_obrigatorio', False)
+                    cid_sugestao = proc_info.get('cid_sugestao')
+        return sigtap.ljust(10), servico.zfill(3), classificacao.zfill(3), bool(cid_obrigatorio), cid_sugestao
+
+    procedimentos = _por_valor(col['cod_proc'], resolver_procedimento)
+    cod_proc_sigtap, servico, classificacao, _, _ = map(list, zip(*procedimentos))
+
+    # --- CID: lançamento, diagnóstico, sugestão da tabela e fallback conforme a obrigatoriedade ---
+    def resolver_cid(chave):
+        lanc_cod_cid, diagnostico, tem_cid_bruto, cid_obrigatorio, cid_sugestao = chave
+        # A sugestão da tabela só vale quando o lançamento não trouxe CID nem diagnóstico (valores brutos)
+        cid_sugestao = None if tem_cid_bruto else cid_sugestao
+        cid_fallback = 'Z000' if cid_obrigatorio else '    '
+        cid_val = (lanc_cod_cid or diagnostico or cid_sugestao or cid_fallback).upper()
+        if not lanc_cod_cid and not diagnostico and not (cid_sugestao and cid_sugestao.strip()):
+            cid_val = cid_fallback
+        cid = cid_val.replace('.', '').ljust(4)[:4]
+        return cid if cid != '    ' else cid_fallback.ljust(4)
+
+    lanc_cod_cid = _por_valor(col['lanc_cod_cid'], lambda valor: str(valor or '').strip())
+    diagnostico = _por_valor(col['diagnostico'], lambda valor: str(valor or '').strip())
+    tem_cid_bruto = [bool(lanc or diag) for lanc, diag in zip(col['lanc_cod_cid'], col['diagnostico'])]
+    chaves_cid = [(lanc, diag, bruto, proc[3], proc[4])
+                  for lanc, diag, bruto, proc in zip(lanc_cod_cid, diagnostico, tem_cid_bruto, procedimentos)]
+    cid = _por_valor(chaves_cid, resolver_cid)
+
+    numero_guia = _por_valor(_ou(col['conta_numero_guia'], col['numero_guia']), _texto_ajustado(13))
+    ine_padrao = config.get('default_ine', '0000000000')
+    prd_ine = _por_valor(col['ine_da_equipe_no_banco'], lambda valor: str(valor or ine_padrao).ljust(10))
+    prd_cnpj_val = config.get('cgc_cpf', '') if config.get('indicador_destino') == 'E' else ''
+    prd_cnpj = prd_cnpj_val.ljust(14) if prd_cnpj_val else ' '.ljust(14)
+
+    def constante(valor):
+        return [valor] * n
+
+    colunas = (
+        constante('03'), constante(config.get('cnes', '0000000').ljust(7)), constante(competencia),
+        cns_med, cbo, data_atend_str, cod_proc_sigtap, cnspac, sexo, cod_ibge, cid, idade,
+        constante(1), constante('01'), numero_guia, constante('BPA'), nome_paciente, data_nasc_str,
+        raca, etnia, constante('010'), servico, classificacao, constante(' ' * 8), constante(' ' * 4),
+        constante(prd_cnpj), cep_pcnte, logradouro_tipo, endereco_nome, complemento, numero, bairro,
+        fone, email, prd_ine, cpf_paciente, constante(' '), col['id_lancamento'],
+    )
+    return RegistroBPAI.de_linhas(CAMPOS_SAIDA, zip(*colunas))